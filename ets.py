@@ -4,18 +4,259 @@ build, etc, of all actively maintained ETS packages, and allows arbitrary
 shell commands to be run on all packages.
 """
 
+import gzip
+import heapq
+import json
+import os
+import shutil
 import sys
 import subprocess
+import sysconfig
+import tarfile
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import ets_depends
 
 usage = """\
-Usage: ets -h | --help | clone [--ssh] | COMMAND [args] | ALIAS [args]
+Usage: ets -h | --help | [options] clone [clone options] [git clone args]
+       | [options] mirror [mirror options]
+       | [options] status --summary [--json]
+       | [options] wheel [pip wheel args]
+       | [options] test [test options]
+       | [options] bundle create [bundle options]
+       | [options] bundle apply [--remote NAME] PATH
+       | [options] worktree add [git options] BRANCH DIR
+       | [options] worktree list | [options] worktree remove [--force] DIR
+       | [options] daemon [--poll SECONDS] [--rebuild ALIAS]
+       | [options] COMMAND [args] | [options] ALIAS [args]
    -h, --help  Print this message.
 
+   Options, which must precede the command:
+   -j N, --jobs N
+               Run the command in up to N packages concurrently. The output
+               of each package is buffered and printed as one block when the
+               command finishes in that package. The default is 1, which runs
+               the packages one at a time with output going directly to the
+               terminal.
+               The setup, build, install and develop aliases start each
+               package as soon as its ETS dependencies have finished.
+               These aliases skip the packages downstream of any package in
+               which the command fails, whatever the number of jobs.
+   -C DIR, --root DIR
+               Run in the workspace DIR, holding the package checkouts,
+               instead of the current directory. Relative paths given to
+               the command, and the state files kept by ets, are taken
+               relative to DIR.
+   --only PKG[,PKG...]
+               Process only the named packages.
+   --downstream-of PKG[,PKG...]
+               Process only the named packages and the packages which depend
+               on them, directly or indirectly.
+   --changed-since REF
+               Process only the packages with commits since the git ref REF,
+               eg. origin/master or a tag, and the packages which depend on
+               them. A package in which REF does not exist is selected.
+               These options may be combined, in which case only the
+               packages selected by all of them are processed.
+   --force     Run the build, install and develop aliases in every package.
+               By default, these aliases skip each package whose git HEAD and
+               working copy are unchanged since the alias last succeeded in
+               it, unless one of its ETS dependencies is being rebuilt. The
+               state of each package is recorded in the file .ets_state.json
+               in the current directory.
+   --stream    Print each line of output as soon as it is produced, prefixed
+               with the package name, instead of one block per package.
+   --log-dir DIR
+               Also write the full output of each package to DIR/PKG.log.
+   --compress-logs
+               Compress the log files with gzip, as DIR/PKG.log.gz.
+   --metrics FILE
+               Append the wall time, CPU user and system time, peak memory
+               (max RSS) and exit status of the command in each package to
+               FILE, as one line of JSON per package.
+   --trace FILE
+               Write a Chrome trace of the run to FILE, showing the command in
+               each package as a span on a timeline. Open it in
+               https://ui.perfetto.dev or chrome://tracing.
+   --keep-going
+               When the command fails in a package, carry on with the
+               remaining packages. This is the default.
+   --fail-fast When the command fails in a package, start no further
+               packages.
+   -l LOAD, --max-load LOAD
+               With -j N, the build alias runs a GNU make style jobserver,
+               holding N job tokens which are shared between the packages
+               being built and the parallel compile jobs within each of them:
+               a package is started only once a token is free, and is built
+               with 'build --parallel=M' when it is given M tokens. The
+               jobserver is passed to the build through MAKEFLAGS. No further
+               tokens are handed out while the load average is at least LOAD.
+               The default of 0 disables the load check.
+   --job-memory MB
+               Hand out no more jobserver tokens than fit in the available
+               memory at MB megabytes per job. The default is 512, and 0
+               disables the memory check.
+   --batch     Make the install and develop aliases install all the
+               packages with a single 'pip install --no-build-isolation'
+               command, in editable mode for develop, instead of running
+               setup.py in each package. The dependencies of the whole suite
+               are then resolved once, and the ETS requirements are met by the
+               checkouts. Any further alias arguments are passed to pip.
+   --find-links DIR
+               With --batch, also look for the dependencies in DIR, eg. a
+               local wheel directory, as with pip's --find-links.
+   --index-url URL
+               With --batch, use the package index at URL instead of PyPI.
+   --wheelhouse DIR
+               The wheelhouse used by the wheel command and the install
+               alias. Defaults to $ETS_WHEELHOUSE, or ~/.cache/ets/wheels.
+   --no-wheels Make the install alias build every package from source.
+   A summary of the status and run time of each package, followed by the
+   slowest packages with their CPU time and peak memory, is printed at the
+   end, and the exit status is non-zero if the command did not succeed in
+   every package.
+
    clone       Clone the entire Enthought Tool Suite into the current working
                directory, each actively maintained package placed in its own
                sub-directory.
                By default, the https github access URLs are used.
-               The --ssh option changes this to SSH.
+               With -j N, up to N packages are cloned concurrently.
+               The clone options are:
+               --ssh       Use the SSH github access URLs.
+               --url TEMPLATE
+                           Use the URL given by TEMPLATE, with %%s replaced by
+                           the package name, eg. file:///srv/git/%%s.git
+               --mirror-dir DIR
+                           Borrow objects from the local mirrors in DIR, as
+                           made by 'ets mirror'. A package whose mirror exists
+                           is cloned with --reference-if-able, so only the
+                           objects missing from the mirror are downloaded,
+                           and later fetches also skip the objects which the
+                           mirror holds. The clones depend on the mirror
+                           for those objects, so do not delete, prune or
+                           gc a mirror which is still borrowed from.
+                           Defaults to $ETS_MIRROR_DIR, or
+                           ~/.cache/ets/mirrors.
+               --depth N   Make shallow clones, holding only the last N
+                           commits of a single branch. Later 'ets fetch' and
+                           'ets pull' runs only download the commits added
+                           since, and leave the older history out.
+               --filter SPEC
+                           Make partial clones, eg. --filter=blob:none
+                           downloads file contents only when needed. git
+                           records the filter, so later fetches use it too.
+               --branch NAME, -b NAME
+                           Check out branch NAME instead of the default.
+               --sparse    Initialize a sparse checkout, holding only the
+                           files at the top level of each package.
+               Any further arguments are passed to git clone.
+
+   mirror      Create or update a bare mirror of each package in the mirror
+               directory. A new mirror is made with 'git clone --mirror', and
+               an existing one is refreshed with a single incremental fetch.
+               Deleted branches and tags are kept in the mirror, rather than
+               pruned, since clones may still borrow their objects.
+               With -j N, up to N packages are mirrored concurrently.
+               The --ssh, --url and --mirror-dir options are as for clone.
+
+   bundle create
+               Write a git bundle of the branches and tags of each package,
+               for copying to hosts without network access. Each bundle
+               holds only the commits added since the package's previous
+               bundle, as recorded in the file .ets_bundle_sync.json in the
+               current directory. A package with no new commits gets no
+               bundle, and a package whose only changes are new branches or
+               tags on commits already sent has them listed in the
+               manifest.json written with the bundles. The bundle options
+               are:
+               --output DIR, -o DIR
+                           Write the bundles to DIR, by default ets-bundles.
+               --archive FILE
+                           Write the bundles and manifest into the single tar
+                           archive FILE instead, compressed if FILE ends with
+                           .gz or .tgz.
+               --full      Bundle the whole history of each package,
+                           ignoring the recorded sync points.
+   bundle apply PATH
+               Fetch the bundles in the directory or archive PATH, as
+               written by 'bundle create', into the existing packages. The
+               branches become the remote-tracking branches of the remote
+               given by --remote NAME, by default origin, so that they may be
+               merged as usual.
+
+   worktree add BRANCH DIR
+               Create the workspace DIR, whose package directories are git
+               worktrees of the packages in this workspace, with BRANCH
+               checked out. The worktrees share the object store of these
+               checkouts, so a workspace for another branch takes seconds and
+               little disk space. A BRANCH which exists only on the remote is
+               checked out as a new tracking branch. Any options, eg. --detach
+               or -b NEW, are passed to git worktree add. Run ets in the new
+               workspace with -C DIR.
+   worktree list
+               List the worktrees of each package.
+   worktree remove DIR
+               Remove the worktrees of the workspace DIR, and then DIR itself.
+               Worktrees with uncommitted changes are kept, unless --force
+               is given.
+
+   status --summary [--json]
+               Print one table summarizing the git status of every package:
+               its branch, the commits ahead of and behind its upstream
+               branch, and the numbers of staged, modified, untracked and
+               conflicted files. The packages are queried concurrently, using
+               'git status --porcelain=v2'. With --json, the summary is
+               printed as JSON instead. Without these options, status runs
+               the plain 'git status' alias.
+               If an ets daemon is serving the workspace, the summary is
+               taken from its cache instead, unless --no-daemon or
+               --changed-since is given.
+
+   daemon      Keep the git status of every package up to date, and serve it
+               to 'ets status --summary' through the socket .ets_daemon.sock
+               in the workspace, until interrupted. Each package is scanned
+               again as soon as it changes, as reported by inotify on Linux.
+               The daemon options are:
+               --poll SECONDS
+                           Scan every package each SECONDS instead, as is
+                           also done where inotify is not available.
+               --rebuild ALIAS
+                           Run the build, install or develop alias in the
+                           workspace whenever the working tree of a package
+                           changes. Unchanged packages are skipped as usual.
+
+   wheel       Build a wheel of each package into the wheelhouse, in
+               dependency order, using 'pip wheel --no-deps
+               --no-build-isolation'. The wheels are keyed by the package's
+               git commit, plus the hash of its working tree if it has
+               uncommitted changes, and by the Python implementation, ABI and
+               platform. A package whose wheel is already in the wheelhouse
+               is not rebuilt, unless --force is given. Any further arguments
+               are passed to pip wheel.
+               Without further arguments, the install alias installs each
+               package from its wheel in the wheelhouse, if there is one for
+               the package's current commit and this Python, and builds only
+               the other packages from source.
+
+   test        Run the unittest suites of the packages, discovered in each
+               package's sub-directory, in up to N worker processes with -j N.
+               The packages whose tests took longest in earlier runs are
+               started first, as recorded in the file .ets_test_durations.json
+               in the current directory. The test options are:
+               --shards PKG=N[,PKG=N...]
+                           Split the tests of each named package into N
+                           shards, run by separate workers. The test classes
+                           are dealt between the shards by their recorded
+                           durations.
+               --pattern PATTERN
+                           The pattern of the test module names, by default
+                           test*.py.
+               --junit-xml FILE
+                           Write the results of all the tests to the JUnit XML
+                           file FILE, by default ets_tests.xml.
 
    COMMAND     Run this shell command, with any following arguments, inside
                each package's sub-directory. If any command arguments must be
@@ -38,10 +279,51 @@ Usage: ets -h | --help | clone [--ssh] | COMMAND [args] | ALIAS [args]
          ets clone
          ets develop
 
+      Rebuild just what a change to traits can break:
+         ets --downstream-of traits build
+
+      Set up a development environment from a local wheel directory:
+         ets --batch --find-links ~/wheels develop --no-index
+
+      Test a release branch alongside master, sharing the clones:
+         ets worktree add release-4.0 ../ets-4.0
+         ets -C ../ets-4.0 -j 8 test
+
+      Keep the status hot for a dashboard, and rebuild on every change:
+         ets daemon --rebuild develop &
+         ets status --summary --json
+
       Update all packages from master:
          ets pull
 
-   The ETS packages referenced, in order of processing, are:\n%s"""
+      Fetch all packages, 8 at a time:
+         ets -j 8 fetch
+
+      Shallow, partial clone for a build-only checkout:
+         ets -j 8 clone --depth 1 --filter=blob:none
+
+      Build wheels once, then install quickly in each new environment:
+         ets -j 8 wheel
+         ets install
+
+      Run all the tests, splitting the largest suites:
+         ets -j 8 test --shards traits=4,traitsui=2
+
+      Carry the new commits to an offline host, and merge them there:
+         ets bundle create --archive ets.tar
+         ets bundle apply ets.tar
+         ets git merge --ff-only
+
+      Refresh the local mirrors, then clone from them:
+         ets -j 8 mirror
+         ets -j 8 clone
+
+   The ETS packages referenced are listed below. Commands are run in the
+   packages in dependency order, as extracted from the setup files of each
+   package by ets_depends. A dependency cycle is reported as an error, and
+   packages which have not been cloned are reported and skipped. The
+   environment variable ETS_PACKAGES may list other packages to process
+   instead, separated by spaces or commas.\n%s"""
 
 aliases = """\n
       pull     git pull
@@ -58,7 +340,7 @@ aliases = """\n
 
 """\
 ======================================================================
-ETS installation dependencies (documentation only).
+ETS installation dependencies.
 Derived from ets_depends.log, holding the output of ets_depends.py.
 Dependent packages are listed below and to the right of their dependencies.
 ======================================================================
@@ -71,15 +353,19 @@ traits
         traitsui
             enable
                 chaco
+                    enable-mapping
                 graphcanvas
             apptools
                 mayavi
                 envisage
+        qt_binder
 
 Notes:
-1. This string is for documentation only. Unlike the ets_package_names string
-   below, this  is not used programatically. However, string ets_package_names
-   *is* manually derived from the info in this string.
+1. This string is for documentation only. The same information is held in
+   the ets_dependencies dict below, which is used for any package whose
+   dependencies cannot be extracted from its setup files. The processing
+   order is computed from the dependencies, rather than taken from the
+   ets_package_names string.
 2. This string does not list ETS run-time, nor any non-ETS, dependencies.
 3. To avoid clutter, this string does not list redundant dependencies. For
    example, it does not list traits dependencies for packages which depend on
@@ -94,9 +380,62 @@ ets_package_names = """\
       envisage           chaco              mayavi
       graphcanvas        qt_binder          enable-mapping"""
 
+# The packages may be replaced by those listed in the ETS_PACKAGES environment
+# variable, eg. by the synthetic packages of ets_bench.py.
+if os.environ.get('ETS_PACKAGES'):
+    ets_package_names = os.environ['ETS_PACKAGES'].replace(',', ' ')
+
+# The direct ETS installation dependencies of each package, as documented
+# above.
+ets_dependencies = {
+    'casuarius': [],
+    'encore': [],
+    'traits': [],
+    'codetools': ['traits'],
+    'scimath': ['traits'],
+    'pyface': ['traits'],
+    'traitsui': ['pyface'],
+    'enable': ['traitsui'],
+    'chaco': ['enable'],
+    'enable-mapping': ['chaco'],
+    'graphcanvas': ['enable'],
+    'apptools': ['traitsui'],
+    'mayavi': ['apptools'],
+    'envisage': ['apptools'],
+    'qt_binder': ['pyface'],
+}
+
+# Aliases whose packages must be processed after their dependencies.
+scheduled_aliases = ['setup', 'build', 'install', 'develop']
+
+# Aliases which may install all the packages with a single pip command.
+batch_aliases = ['install', 'develop']
+
+# Aliases which skip the packages unchanged since their last successful run.
+incremental_aliases = ['build', 'install', 'develop']
+
+# The statuses of a package in which the command succeeded, or did not need
+# to be run.
+succeeded = ('ok', 'unchanged', 'cached')
+
+# The file recording the state of each package when an incremental alias
+# last succeeded in it.
+state_file = '.ets_state.json'
+
+# The file recording the branches and tags of each package sent in its last
+# git bundle, and the name of the manifest written alongside the bundles.
+sync_file = '.ets_bundle_sync.json'
+bundle_manifest = 'manifest.json'
+
 ets_ssh = "git@github.com:enthought/%s.git"
 ets_https = "https://github.com/enthought/%s.git"
 
+default_mirror_dir = os.environ.get('ETS_MIRROR_DIR') or os.path.join(
+    os.path.expanduser('~'), '.cache', 'ets', 'mirrors')
+
+default_wheelhouse = os.environ.get('ETS_WHEELHOUSE') or os.path.join(
+    os.path.expanduser('~'), '.cache', 'ets', 'wheels')
+
 alias_dict = {}
 for line in aliases.split('\n'):
     tokens = line.split()
@@ -104,42 +443,1653 @@ for line in aliases.split('\n'):
         alias_dict[tokens[0]] = tokens[1:]
 
 
+# Options which may precede the command: option -> (key, takes a value), or
+# (key, False, value) for a flag which sets its key to the given value.
+ets_options = {
+    '-j': ('jobs', True),
+    '--jobs': ('jobs', True),
+    '--force': ('force', False),
+    '-C': ('root', True),
+    '--root': ('root', True),
+    '--only': ('only', True),
+    '--downstream-of': ('downstream_of', True),
+    '--changed-since': ('changed_since', True),
+    '--stream': ('stream', False),
+    '--log-dir': ('log_dir', True),
+    '--compress-logs': ('compress_logs', False),
+    '--metrics': ('metrics', True),
+    '--trace': ('trace', True),
+    '--keep-going': ('fail_fast', False, False),
+    '--fail-fast': ('fail_fast', False, True),
+    '--wheelhouse': ('wheelhouse', True),
+    '--batch': ('batch', False),
+    '--find-links': ('find_links', True),
+    '--index-url': ('index_url', True),
+    '--no-wheels': ('use_wheels', False, False),
+    '-l': ('max_load', True),
+    '--max-load': ('max_load', True),
+    '--job-memory': ('job_memory', True),
+}
+
+default_options = {
+    'jobs': 1,
+    'force': False,
+    'root': '',
+    'only': '',
+    'downstream_of': '',
+    'changed_since': '',
+    'stream': False,
+    'log_dir': '',
+    'compress_logs': False,
+    'metrics': '',
+    'trace': '',
+    'fail_fast': False,
+    'wheelhouse': default_wheelhouse,
+    'batch': False,
+    'find_links': '',
+    'index_url': '',
+    'use_wheels': True,
+    'max_load': 0.0,
+    'job_memory': 512,
+}
+
+# Options which select the summary mode of the status alias.
+status_options = {
+    '--summary': ('summary', False),
+    '--json': ('json', False),
+    '--no-daemon': ('daemon', False, False),
+}
+
+default_status_options = {
+    'summary': False,
+    'json': False,
+    'daemon': True,
+}
+
+# Options which may follow the bundle command.
+bundle_options = {
+    '--output': ('output', True),
+    '-o': ('output', True),
+    '--archive': ('archive', True),
+    '--full': ('full', False),
+    '--remote': ('remote', True),
+}
+
+default_bundle_options = {
+    'output': 'ets-bundles',
+    'archive': '',
+    'full': False,
+    'remote': 'origin',
+}
+
+# Options which may follow the mirror command.
+mirror_options = {
+    '--ssh': ('ssh', False),
+    '--url': ('url', True),
+    '--mirror-dir': ('mirror_dir', True),
+}
+
+default_mirror_options = {
+    'ssh': False,
+    'url': '',
+    'mirror_dir': default_mirror_dir,
+}
+
+# Options which may follow the clone command.
+clone_options = dict(mirror_options)
+clone_options.update({
+    '--depth': ('depth', True),
+    '--filter': ('filter', True),
+    '--branch': ('branch', True),
+    '-b': ('branch', True),
+    '--sparse': ('sparse', False),
+})
+
+default_clone_options = dict(default_mirror_options)
+default_clone_options.update({
+    'depth': 0,
+    'filter': '',
+    'branch': '',
+    'sparse': False,
+})
+
+
+def parse_options(args, option_table, defaults, passthrough=False):
+    """Consume the leading options in *args* which are listed in
+    *option_table*. Returns a dict of option values and the remaining
+    arguments. Raises ValueError for an unknown or malformed option, unless
+    *passthrough* is set, in which case all of *args* are scanned and the
+    unknown arguments are returned in order.
+    """
+    options = dict(defaults)
+    args = list(args)
+    unknown = []
+    while args and (args[0].startswith('-') or passthrough):
+        arg = args.pop(0)
+        if arg == '--':
+            break
+        name, value = arg, None
+        if arg.startswith('--') and '=' in arg:
+            name, value = arg.split('=', 1)
+        elif not arg.startswith('--') and len(arg) > 2:
+            name, value = arg[:2], arg[2:]
+        if name not in option_table:
+            if passthrough:
+                unknown.append(arg)
+                continue
+            raise ValueError("unknown option %r" % arg)
+        key, takes_value = option_table[name][:2]
+        if takes_value:
+            if value is None:
+                if not args:
+                    raise ValueError("option %s requires a value" % name)
+                value = args.pop(0)
+            if isinstance(defaults.get(key), int):
+                try:
+                    value = int(value)
+                except ValueError:
+                    raise ValueError("option %s requires an integer" % name)
+            elif isinstance(defaults.get(key), float):
+                try:
+                    value = float(value)
+                except ValueError:
+                    raise ValueError("option %s requires a number" % name)
+            options[key] = value
+        elif value is not None:
+            raise ValueError("option %s does not take a value" % name)
+        else:
+            options[key] = (option_table[name][2]
+                            if len(option_table[name]) > 2 else True)
+    return options, unknown + args
+
+
+class DependencyCycleError(ValueError):
+    """ Raised when the dependencies between packages form a cycle.
+    """
+
+    def __init__(self, cycle):
+        ValueError.__init__(self, "dependency cycle: %s" % ' -> '.join(cycle))
+        self.cycle = cycle
+
+
+class DependencyGraph(object):
+    """ The installation dependencies between a set of ETS packages.
+    """
+
+    def __init__(self, dependencies, packages=None):
+        """ Create the graph of *dependencies*, a dict mapping each package
+        name to the names of its direct dependencies. If *packages* is given,
+        the graph is restricted to those packages, and dependencies on any
+        other package are treated as already satisfied.
+        """
+        if packages is None:
+            packages = list(dependencies)
+        self.packages = list(packages)
+        self.dependencies = {}
+        self.dependents = {}
+        for name in self.packages:
+            self.dependencies[name] = [
+                dep for dep in dependencies.get(name, ())
+                if dep in packages]
+            self.dependents.setdefault(name, [])
+            for dep in self.dependencies[name]:
+                self.dependents.setdefault(dep, []).append(name)
+        self._order = None
+
+    def order(self):
+        """ Return the packages in an order in which each package follows
+        all of its dependencies, otherwise keeping the order in which the
+        packages were given. The order is computed once and cached. Raises
+        DependencyCycleError if there is no such order.
+        """
+        if self._order is None:
+            position = dict((name, i) for i, name in enumerate(self.packages))
+            waiting = dict((name, len(deps))
+                           for name, deps in self.dependencies.items())
+            ready = [(position[name], name) for name in self.packages
+                     if not waiting[name]]
+            order = []
+            while ready:
+                name = heapq.heappop(ready)[1]
+                order.append(name)
+                for dependent in self.dependents[name]:
+                    waiting[dependent] -= 1
+                    if not waiting[dependent]:
+                        heapq.heappush(ready, (position[dependent], dependent))
+            if len(order) < len(self.packages):
+                raise DependencyCycleError(self._find_cycle(waiting))
+            self._order = order
+        return list(self._order)
+
+    def _find_cycle(self, waiting):
+        """ Return a dependency cycle among the packages which are *waiting*
+        for dependencies, as a list of names starting and ending with the
+        same package.
+        """
+        name = min((name for name in self.packages if waiting[name]),
+                   key=self.packages.index)
+        path = []
+        while name not in path:
+            path.append(name)
+            name = [dep for dep in self.dependencies[name] if waiting[dep]][0]
+        return path[path.index(name):] + [name]
+
+    def upstream(self, names):
+        """ Return the set of *names* together with every package on which
+        they depend, directly or indirectly.
+        """
+        result = set()
+        todo = [name for name in names if name in self.dependencies]
+        while todo:
+            name = todo.pop()
+            if name not in result:
+                result.add(name)
+                todo.extend(self.dependencies[name])
+        return result
+
+    def subgraph(self, names):
+        """ Return the DependencyGraph of the packages *names*, in which each
+        package depends on the packages among *names* which it depends on
+        directly, or indirectly through packages which are left out.
+        """
+        names = [name for name in self.packages if name in names]
+        dependencies = dict(
+            (name, [dep for dep in self.upstream([name])
+                    if dep != name and dep in names])
+            for name in names)
+        return DependencyGraph(dependencies, names)
+
+    def downstream(self, names):
+        """ Return the set of *names* together with every package which
+        depends on them, directly or indirectly.
+        """
+        result = set()
+        todo = [name for name in names if name in self.dependencies]
+        while todo:
+            name = todo.pop()
+            if name not in result:
+                result.add(name)
+                todo.extend(self.dependents[name])
+        return result
+
+
+def package_graph(packages, root='.'):
+    """Return the DependencyGraph of *packages*, as extracted from the setup
+    files of their checkouts in directory *root*. A package whose setup files
+    are missing, or give no requirements, is given the dependencies
+    documented in ets_dependencies instead.
+    """
+    metadata = ets_depends.read_packages(packages, root)
+    extracted = ets_depends.dependency_graph(metadata)
+    dependencies = {}
+    for ets_pkg_name in packages:
+        info = metadata.get(ets_pkg_name)
+        if info is not None and info['install_requires']:
+            dependencies[ets_pkg_name] = extracted[ets_pkg_name]
+        else:
+            dependencies[ets_pkg_name] = ets_dependencies.get(ets_pkg_name, [])
+    return DependencyGraph(dependencies, packages)
+
+
+def package_list(value):
+    """Return the package names in *value*, a comma separated list. Raises
+    ValueError for an unknown package name.
+    """
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names
+               if name not in ets_package_names.split()]
+    if unknown:
+        raise ValueError("unknown package %s" % ', '.join(unknown))
+    return names
+
+
+def requested_packages(options, graph=None):
+    """Return the names of the ETS packages requested by the --only and
+    --downstream-of options in the ets *options*, or of all ETS packages.
+    The packages downstream of others are found in *graph*, which defaults
+    to the dependencies documented in ets_dependencies. Raises ValueError
+    for an unknown package name.
+    """
+    packages = ets_package_names.split()
+    if options['only']:
+        only = package_list(options['only'])
+        packages = [name for name in packages if name in only]
+    if options['downstream_of']:
+        if graph is None:
+            graph = DependencyGraph(ets_dependencies)
+        downstream = graph.downstream(package_list(options['downstream_of']))
+        packages = [name for name in packages if name in downstream]
+    return packages
+
+
+def has_commits_since(ets_pkg_name, ref, root='.'):
+    """Return whether the package's HEAD has any commits which are not
+    reachable from *ref*, or None if *ref* does not exist in the package.
+    """
+    try:
+        count = subprocess.check_output(
+            ['git', 'rev-list', '--count', ref + '..HEAD'],
+            cwd=os.path.join(root, ets_pkg_name), stderr=subprocess.DEVNULL,
+            universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return int(count) > 0
+
+
+def select_packages(options, root='.'):
+    """Return the DependencyGraph of the packages selected by the ets
+    *options*, after reporting and leaving out any package which has not
+    been checked out in directory *root*. With the --changed-since option,
+    only the packages with commits since the given ref, and the packages
+    downstream of them, are selected. Raises ValueError for an unknown
+    package name, and DependencyCycleError if the packages cannot be
+    ordered.
+    """
+    packages = requested_packages(options)
+    missing = [name for name in packages
+               if not os.path.isdir(os.path.join(root, name))]
+    if missing:
+        print("Skipping missing packages: %s\n" % ', '.join(missing))
+
+    # The packages are selected from the graph of every package which has
+    # been checked out, so that the packages downstream of others are
+    # found, and the dependencies through packages which are left out are
+    # kept.
+    present = [name for name in ets_package_names.split()
+               if os.path.isdir(os.path.join(root, name))]
+    graph = package_graph(present, root)
+    graph.order()
+    packages = requested_packages(options, graph)
+    if options['changed_since']:
+        ref = options['changed_since']
+        with ThreadPoolExecutor(max_workers=max(1, len(present))) as executor:
+            changes = list(executor.map(
+                lambda name: has_commits_since(name, ref, root), present))
+        unknown = [name for name, change in zip(present, changes)
+                   if change is None]
+        if unknown:
+            print("Selecting packages without %s: %s\n"
+                  % (ref, ', '.join(unknown)))
+        changed = [name for name, change in zip(present, changes)
+                   if change is not False]
+        downstream = graph.downstream(changed)
+        packages = [name for name in packages if name in downstream]
+    return graph.subgraph(packages)
+
+
+def working_tree_hash(ets_pkg_name):
+    """Return the git tree hash of the package's working copy, including
+    uncommitted changes and untracked files which are not ignored. A copy of
+    the package's index is used, so that git can skip the files whose stat
+    information is unchanged, and the real index is left alone.
+    """
+    git = ['git', '-C', ets_pkg_name]
+    index = subprocess.check_output(
+        git + ['rev-parse', '--git-path', 'index'],
+        universal_newlines=True).strip()
+    index = os.path.join(ets_pkg_name, index)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_index = os.path.join(tmp, 'index')
+        if os.path.exists(index):
+            shutil.copyfile(index, tmp_index)
+        env = dict(os.environ, GIT_INDEX_FILE=tmp_index)
+        subprocess.check_call(git + ['add', '--all'], env=env)
+        return subprocess.check_output(git + ['write-tree'], env=env,
+                                       universal_newlines=True).strip()
+
+
+def package_state(ets_pkg_name):
+    """Return a dict holding the package's git HEAD and working tree hash,
+    or None if they cannot be determined.
+    """
+    try:
+        head = subprocess.check_output(
+            ['git', '-C', ets_pkg_name, 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+        return {'head': head, 'tree': working_tree_hash(ets_pkg_name)}
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_state(path=state_file):
+    """Return the package states recorded in the state file *path*."""
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_state(state, path=state_file):
+    """Write the package states to the state file *path*."""
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(state, fp, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def wheel_tag():
+    """Return the tag of the wheels built by this Python, combining its
+    implementation, ABI and platform, eg.
+    cpython-311-x86_64-linux-gnu-linux_x86_64.
+    """
+    abi = sysconfig.get_config_var('SOABI') or sys.implementation.cache_tag
+    platform = sysconfig.get_platform().replace('-', '_').replace('.', '_')
+    return '%s-%s' % (abi, platform)
+
+
+def wheel_key(ets_pkg_name):
+    """Return the key of the package's wheels in the wheelhouse: its git
+    HEAD commit, followed by the hash of its working tree if that has
+    uncommitted changes. Returns None if the key cannot be determined.
+    """
+    state = package_state(ets_pkg_name)
+    if state is None:
+        return None
+    try:
+        head_tree = subprocess.check_output(
+            ['git', '-C', ets_pkg_name, 'rev-parse', 'HEAD^{tree}'],
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if state['tree'] == head_tree:
+        return state['head']
+    return '%s-%s' % (state['head'], state['tree'])
+
+
+def wheel_path(ets_pkg_name, key, wheelhouse):
+    """Return the directory of the wheelhouse which holds the package's
+    wheels for *key* and this Python.
+    """
+    return os.path.join(os.path.abspath(wheelhouse), ets_pkg_name,
+                        wheel_tag(), key)
+
+
+def cached_wheels(ets_pkg_name, key, wheelhouse):
+    """Return the paths of the package's wheels in the wheelhouse for *key*,
+    or an empty list if there are none.
+    """
+    if key is None:
+        return []
+    path = wheel_path(ets_pkg_name, key, wheelhouse)
+    if not os.path.isdir(path):
+        return []
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+                  if name.endswith('.whl'))
+
+
+class WheelBuilds(object):
+    """ The tasks which build a wheel of each package into the wheelhouse,
+    for use with run_tasks. A package whose wheel is already in the
+    wheelhouse is not rebuilt, unless *force* is set.
+
+    Each wheel is built into a temporary directory, which is moved into
+    place only if the build succeeds, so the wheelhouse never holds a
+    partial build.
+    """
+
+    def __init__(self, wheelhouse, extra_args, force=False):
+        self.wheelhouse = wheelhouse
+        self.extra_args = extra_args
+        self.force = force
+        self.keys = {}
+        self.build_dirs = {}
+
+    def task(self, ets_pkg_name):
+        """ Return the package's task, as called by run_tasks when the
+        package is started.
+        """
+        def start():
+            key = self.keys[ets_pkg_name] = wheel_key(ets_pkg_name)
+            if key is None:
+                return {'status': 'failed',
+                        'detail': 'cannot determine the git commit'}
+            wheels = cached_wheels(ets_pkg_name, key, self.wheelhouse)
+            if wheels and not self.force:
+                return {'status': 'cached',
+                        'detail': os.path.basename(wheels[0])}
+            parent = os.path.dirname(
+                wheel_path(ets_pkg_name, key, self.wheelhouse))
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            build_dir = tempfile.mkdtemp(prefix='.tmp-', dir=parent)
+            self.build_dirs[ets_pkg_name] = build_dir
+            cmd = [sys.executable, '-m', 'pip', 'wheel', '--no-deps',
+                   '--no-build-isolation', '--wheel-dir', build_dir]
+            return cmd + self.extra_args + ['.'], ets_pkg_name
+        return start
+
+    def finished(self, ets_pkg_name, result):
+        """ Move the package's new wheel into the wheelhouse, if it was
+        built successfully, and remove its temporary build directory.
+        """
+        build_dir = self.build_dirs.pop(ets_pkg_name, None)
+        if build_dir is None:
+            return
+        if result['status'] == 'ok':
+            path = wheel_path(ets_pkg_name, self.keys[ets_pkg_name],
+                              self.wheelhouse)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.replace(build_dir, path)
+            wheels = cached_wheels(ets_pkg_name, self.keys[ets_pkg_name],
+                                   self.wheelhouse)
+            if wheels:
+                result['detail'] = os.path.basename(wheels[0])
+        else:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+
+def available_memory():
+    """Return the memory available for new processes in MB, or None if it
+    cannot be determined.
+    """
+    try:
+        with open('/proc/meminfo') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+class Jobserver(object):
+    """ A GNU make style jobserver, holding a budget of *size* job tokens
+    in a pipe.
+
+    Each running package holds at least one token, and may be given
+    further tokens for the parallel jobs of its own build, so the packages
+    and the compile jobs within them share the one budget. The pipe is
+    passed to the commands through MAKEFLAGS, so that any make run by a
+    build also draws its jobs from the budget.
+
+    No new tokens are handed out while the load average is at least
+    *max_load*, nor more than fit in the available memory at *job_memory*
+    MB per job, unless nothing is running. Either check is disabled by a
+    value of 0.
+    """
+
+    def __init__(self, size, max_load=0, job_memory=0,
+                 parallel_option=None):
+        self.size = size
+        self.max_load = max_load
+        self.job_memory = job_memory
+        self.parallel_option = parallel_option
+        self.read_fd, self.write_fd = os.pipe()
+        os.write(self.write_fd, b'+' * size)
+        self.fds = (self.read_fd, self.write_fd)
+        # Where possible, tokens are taken through a non-blocking descriptor
+        # of our own, so the one inherited by the commands stays blocking,
+        # as make expects.
+        try:
+            self.poll_fd = os.open('/proc/self/fd/%d' % self.read_fd,
+                                   os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            self.poll_fd = os.dup(self.read_fd)
+            os.set_blocking(self.poll_fd, False)
+
+    def close(self):
+        for fd in (self.poll_fd, self.read_fd, self.write_fd):
+            os.close(fd)
+
+    def limit(self, wanted, running):
+        """ Return how many of the *wanted* tokens may be handed out now,
+        while *running* packages hold tokens.
+        """
+        if self.max_load and os.getloadavg()[0] >= self.max_load:
+            wanted = 0
+        if self.job_memory:
+            memory = available_memory()
+            if memory is not None:
+                wanted = min(wanted, memory // self.job_memory)
+        if not running:
+            wanted = max(wanted, 1)
+        return wanted
+
+    def acquire(self, wanted, running):
+        """ Take up to *wanted* tokens from the pipe, as allowed by the load
+        and memory checks. Returns the tokens, which may be empty.
+        """
+        wanted = self.limit(wanted, running)
+        tokens = b''
+        while len(tokens) < wanted:
+            try:
+                data = os.read(self.poll_fd, wanted - len(tokens))
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            tokens += data
+        return tokens
+
+    def release(self, tokens):
+        """ Return the *tokens* to the pipe."""
+        if tokens:
+            os.write(self.write_fd, tokens)
+
+    def command(self, cmd, tokens):
+        """ Return *cmd*, running with the number of parallel jobs given by
+        the *tokens* it holds.
+        """
+        if self.parallel_option and len(tokens) > 1:
+            return cmd + ['%s=%d' % (self.parallel_option, len(tokens))]
+        return cmd
+
+    def environ(self):
+        """ Return the environment of the commands, through which make finds
+        the jobserver.
+        """
+        return dict(os.environ, MAKEFLAGS='-j%d --jobserver-fds=%d,%d '
+                    '--jobserver-auth=%d,%d' % ((self.size,) + self.fds * 2))
+
+
+class PackageOutput(object):
+    """ Runs the package commands and writes their output to the terminal,
+    and optionally to a log file per package.
+
+    In 'direct' mode the command writes straight to the terminal. In 'block'
+    mode its output is spooled to a temporary file and printed as a single
+    block once the command has finished. In 'stream' mode each line is
+    printed as soon as it is read, prefixed with the package name. In every
+    mode but 'direct', the output is copied line by line to the package's
+    log file in *log_dir*, which is gzip compressed if *compress* is set.
+
+    The wall time, CPU time and peak memory of each command are added to its
+    result. If *metrics* is given, they are also appended to that file as a
+    line of JSON, and if *trace* is given, each command is shown as a span in
+    that Chrome trace file, which may be opened in Perfetto or
+    chrome://tracing.
+    """
+
+    def __init__(self, mode, log_dir=None, compress=False, metrics=None,
+                 trace=None):
+        self.mode = mode
+        self.log_dir = log_dir
+        self.compress = compress
+        self.metrics = metrics
+        self.trace = trace
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.events = []
+        self.lanes = {}
+
+    def message(self, text):
+        """ Print a line of *text* without interleaving it with any other
+        package's output.
+        """
+        with self.lock:
+            print(text)
+            sys.stdout.flush()
+
+    def open_log(self, ets_pkg_name):
+        """ Return the package's log file, opened for binary writing, or
+        None if there is no log directory.
+        """
+        if not self.log_dir:
+            return None
+        if self.compress:
+            return gzip.open(
+                os.path.join(self.log_dir, ets_pkg_name + '.log.gz'), 'wb')
+        return open(os.path.join(self.log_dir, ets_pkg_name + '.log'), 'wb')
+
+    def run(self, ets_pkg_name, cmd, cwd, env=None, pass_fds=()):
+        """ Run the package's *cmd* in directory *cwd*, with the environment
+        *env* if given, passing it the file descriptors *pass_fds*. Returns a
+        dict holding the status ('ok' or 'failed'), the return code, the
+        wall time in seconds and any error message.
+        """
+        heading = "Running command %r in package %s" % (cmd, ets_pkg_name)
+        result = {'status': 'ok', 'returncode': 0, 'detail': ''}
+        start = time.time()
+        if self.mode == 'direct':
+            print(heading)
+            try:
+                result['returncode'] = self.wait(subprocess.Popen(
+                    cmd, cwd=cwd, env=env, pass_fds=pass_fds), result)
+            except OSError as detail:
+                result['returncode'], result['detail'] = None, str(detail)
+        else:
+            if self.mode == 'stream':
+                self.message(heading)
+            log = self.open_log(ets_pkg_name)
+            spool = tempfile.TemporaryFile() if self.mode == 'block' else None
+            try:
+                result['returncode'] = self.capture(
+                    ets_pkg_name, cmd, cwd, [log, spool], result, env,
+                    pass_fds)
+            except OSError as detail:
+                result['returncode'], result['detail'] = None, str(detail)
+            finally:
+                if log is not None:
+                    log.close()
+            if spool is not None:
+                with spool, self.lock:
+                    print(heading)
+                    sys.stdout.flush()
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, sys.stdout.buffer)
+                    sys.stdout.buffer.flush()
+        result['seconds'] = time.time() - start
+
+        if result['returncode'] != 0:
+            result['status'] = 'failed'
+            if not result['detail']:
+                result['detail'] = "exit status %s" % result['returncode']
+            self.message("   Error running command in package %s:\n   %s" % (
+                ets_pkg_name, result['detail']))
+        if self.mode != 'stream':
+            self.message('')
+        self.record(ets_pkg_name, cmd, start, result)
+        return result
+
+    def wait(self, proc, result):
+        """ Wait for *proc* to finish, and return its exit status. Its CPU
+        time and peak memory use are added to *result*, where the platform
+        provides them for a single process.
+        """
+        if not hasattr(os, 'wait4'):
+            return proc.wait()
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere.
+        max_rss = usage.ru_maxrss
+        if sys.platform == 'darwin':
+            max_rss //= 1024
+        result.update({'user': usage.ru_utime, 'sys': usage.ru_stime,
+                       'max_rss_kb': max_rss})
+        return proc.returncode
+
+    def record(self, ets_pkg_name, cmd, start, result):
+        """ Write the metrics and trace of the package's *cmd*, which was
+        started at time *start* and gave *result*.
+        """
+        if not (self.metrics or self.trace):
+            return
+        entry = {'package': ets_pkg_name, 'command': cmd, 'start': start}
+        for key in ('status', 'returncode', 'seconds', 'user', 'sys',
+                    'max_rss_kb'):
+            if key in result:
+                entry[key] = result[key]
+        with self.lock:
+            if self.metrics:
+                with open(self.metrics, 'a') as fp:
+                    fp.write(json.dumps(entry) + '\n')
+            if self.trace:
+                # Each worker thread is shown as one lane of the timeline.
+                lane = self.lanes.setdefault(threading.get_ident(),
+                                             len(self.lanes) + 1)
+                self.events.append({
+                    'name': ets_pkg_name, 'cat': result['status'],
+                    'ph': 'X', 'pid': 1, 'tid': lane,
+                    'ts': int((start - self.start) * 1e6),
+                    'dur': int(result['seconds'] * 1e6), 'args': entry})
+                with open(self.trace + '.tmp', 'w') as fp:
+                    json.dump({'traceEvents': self.events,
+                               'displayTimeUnit': 'ms'}, fp)
+                os.replace(self.trace + '.tmp', self.trace)
+
+    def capture(self, ets_pkg_name, cmd, cwd, files, result, env=None,
+                pass_fds=()):
+        """ Run *cmd*, copying each line of its combined stdout and stderr to
+        the given *files* (skipping any which are None) and, in 'stream'
+        mode, to the terminal. Returns the command's exit status, and adds
+        its resource usage to *result*.
+        """
+        files = [fp for fp in files if fp is not None]
+        prefix = ('[%s] ' % ets_pkg_name).encode()
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env, pass_fds=pass_fds,
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        with proc.stdout:
+            for line in proc.stdout:
+                if not line.endswith(b'\n'):
+                    line += b'\n'
+                for fp in files:
+                    fp.write(line)
+                if self.mode == 'stream':
+                    with self.lock:
+                        sys.stdout.buffer.write(prefix + line)
+                        sys.stdout.buffer.flush()
+        return self.wait(proc, result)
+
+
+def run_tasks(tasks, graph, output, jobs=1, fail_fast=False,
+              on_finish=None, jobserver=None):
+    """Run the tasks, a dict mapping each package of *graph* to a
+    (cmd, cwd) pair, or to a function called when the package is started,
+    which returns either the pair or the package's result dict if there is
+    no command to run. The function is called in the package's worker
+    thread, so that preparing one package does not hold up the others, and
+    the package fails if it raises an exception. The commands are run
+    through *output*, in up to *jobs* packages concurrently and in the
+    order of the graph's packages.
+    Each package is started as soon as the command has succeeded in all of
+    its dependencies, and is skipped if the command failed in, or was
+    skipped for, any of them. With *fail_fast*, no further packages are
+    started once the command has failed in one. If given,
+    on_finish(name, result) is called as each package finishes, before any
+    of its dependents are started. If a *jobserver* is given, each package
+    is started only once it can take a token from it, and is also given a
+    share of the free tokens for its own parallel jobs. Returns a dict
+    mapping each package to its result dict.
+    """
+    pending = list(graph.packages)
+    results = {}
+    running = {}
+    held = {}
+
+    def status(name):
+        return results[name]['status'] if name in results else None
+
+    def ready(name):
+        return all(status(dep) in succeeded
+                   for dep in graph.dependencies[name])
+
+    def start(ets_pkg_name, tokens):
+        task = tasks[ets_pkg_name]
+        if callable(task):
+            # An error preparing one package must not abort the others.
+            try:
+                task = task()
+            except Exception as detail:
+                output.message("   Error preparing package %s:\n   %s"
+                               % (ets_pkg_name, detail))
+                return {'status': 'failed', 'detail': str(detail)}
+        if isinstance(task, dict):
+            return task
+        cmd, cwd = task
+        if jobserver is None:
+            return output.run(ets_pkg_name, cmd, cwd)
+        return output.run(ets_pkg_name, jobserver.command(cmd, tokens), cwd,
+                          jobserver.environ(), jobserver.fds)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            # Start or skip every package whose dependencies are resolved.
+            # Skipping a package may resolve its dependents, so repeat
+            # until nothing changes.
+            changed = True
+            while changed and len(running) < jobs:
+                changed = False
+                for ets_pkg_name in list(pending):
+                    if len(running) >= jobs:
+                        break
+                    deps = graph.dependencies[ets_pkg_name]
+                    blocked = [dep for dep in deps
+                               if status(dep) in ('failed', 'skipped')]
+                    if blocked:
+                        output.message(
+                            "Skipping package %s, which depends on %s\n"
+                            % (ets_pkg_name, ', '.join(blocked)))
+                        results[ets_pkg_name] = {
+                            'status': 'skipped',
+                            'detail': 'depends on ' + ', '.join(blocked)}
+                    elif ready(ets_pkg_name):
+                        tokens = b''
+                        if jobserver is not None:
+                            # Share the budget between the packages which
+                            # are running or ready to run.
+                            sharing = len(running) + len(
+                                [name for name in pending if ready(name)])
+                            tokens = jobserver.acquire(
+                                max(1, jobserver.size // sharing),
+                                len(running))
+                            if not tokens:
+                                break
+                        future = executor.submit(start, ets_pkg_name,
+                                                 tokens)
+                        running[future] = ets_pkg_name
+                        held[future] = tokens
+                    else:
+                        continue
+                    pending.remove(ets_pkg_name)
+                    changed = True
+
+            if not running:
+                if any(ready(name) for name in pending):
+                    # Only the jobserver holds back a ready package when
+                    # nothing is running, once its tokens have been lost,
+                    # eg. by a killed sub-make which never returned them.
+                    output.message("   Error: the jobserver has no tokens "
+                                   "left, so no further packages can be "
+                                   "started")
+                    for ets_pkg_name in pending:
+                        results[ets_pkg_name] = {
+                            'status': 'not run',
+                            'detail': 'no jobserver tokens left'}
+                    break
+                # Only packages in a dependency cycle remain.
+                for ets_pkg_name in pending:
+                    results[ets_pkg_name] = {'status': 'skipped',
+                                             'detail': 'dependency cycle'}
+                break
+            # With a jobserver, recheck the load and memory now and then,
+            # in case a package may be started before another finishes.
+            done, _ = wait(running, return_when=FIRST_COMPLETED,
+                           timeout=None if jobserver is None else 1.0)
+            for future in done:
+                ets_pkg_name = running.pop(future)
+                tokens = held.pop(future)
+                if jobserver is not None:
+                    jobserver.release(tokens)
+                results[ets_pkg_name] = future.result()
+                if on_finish is not None:
+                    on_finish(ets_pkg_name, results[ets_pkg_name])
+                if fail_fast and results[ets_pkg_name]['status'] == 'failed':
+                    for name in pending:
+                        results[name] = {'status': 'not run',
+                                         'detail': 'stopped by --fail-fast'}
+                    pending = []
+
+    return results
+
+
+def run_in_packages(tasks, output, jobs=1, fail_fast=False):
+    """Run the tasks, a dict mapping each package name to a (cmd, cwd) pair,
+    in the order given, in up to *jobs* packages concurrently. Returns a
+    dict mapping each package to its result dict.
+    """
+    graph = DependencyGraph({}, list(tasks))
+    return run_tasks(tasks, graph, output, jobs, fail_fast)
+
+
+def package_url(ets_pkg_name, opts):
+    """Return the URL of the package's repository, as selected by the --url
+    and --ssh options in *opts*.
+    """
+    if opts['url']:
+        return opts['url'] % ets_pkg_name
+    if opts['ssh']:
+        return ets_ssh % ets_pkg_name
+    return ets_https % ets_pkg_name
+
+
+def mirror_path(ets_pkg_name, opts):
+    """Return the path of the package's bare mirror in the mirror directory.
+    """
+    return os.path.join(opts['mirror_dir'], ets_pkg_name + '.git')
+
+
+def mirror_command(ets_pkg_name, mirror_opts):
+    """Return the git command which creates the package's mirror, or fetches
+    into it if it already exists. The fetch never prunes deleted refs,
+    since clones made with --mirror-dir borrow objects from the mirror, and
+    would be corrupted once git gc removed the objects they reference.
+    """
+    path = mirror_path(ets_pkg_name, mirror_opts)
+    if os.path.isdir(path):
+        return ['git', '--git-dir', path, 'fetch', '--no-prune', 'origin']
+    return ['git', 'clone', '--mirror', package_url(ets_pkg_name, mirror_opts),
+            path]
+
+
+def clone_command(ets_pkg_name, clone_opts, extra_args):
+    """Return the git command which clones the package with the given clone
+    options and extra git clone arguments.
+    """
+    pkg_url = package_url(ets_pkg_name, clone_opts)
+    cmd = ['git', 'clone']
+    if os.path.isdir(mirror_path(ets_pkg_name, clone_opts)):
+        cmd += ['--reference-if-able', mirror_path(ets_pkg_name, clone_opts)]
+    if clone_opts['depth']:
+        cmd += ['--depth', str(clone_opts['depth'])]
+    if clone_opts['filter']:
+        cmd += ['--filter', clone_opts['filter']]
+    if clone_opts['branch']:
+        cmd += ['--branch', clone_opts['branch']]
+    if clone_opts['sparse']:
+        cmd.append('--sparse')
+    return cmd + extra_args + [pkg_url, ets_pkg_name]
+
+
+def package_refs(ets_pkg_name):
+    """Return a dict mapping the name of each branch and tag of the package
+    to the object it points at.
+    """
+    lines = subprocess.check_output(
+        ['git', '-C', ets_pkg_name, 'for-each-ref',
+         '--format=%(objectname) %(refname)', 'refs/heads', 'refs/tags'],
+        universal_newlines=True).splitlines()
+    return dict(reversed(line.split(' ', 1)) for line in lines)
+
+
+def has_object(ets_pkg_name, sha):
+    """Return whether the package's repository holds the object *sha*."""
+    return subprocess.call(
+        ['git', '-C', ets_pkg_name, 'cat-file', '-e', sha],
+        stderr=subprocess.DEVNULL) == 0
+
+
+def has_new_objects(ets_pkg_name, basis):
+    """Return whether the package's branches and tags reach any objects
+    which are not reachable from the commits in *basis*.
+    """
+    count = subprocess.check_output(
+        ['git', '-C', ets_pkg_name, 'rev-list', '--count', '--objects',
+         '--branches', '--tags'] + ['^' + sha for sha in basis],
+        universal_newlines=True)
+    return int(count) > 0
+
+
+class BundleCreate(object):
+    """ The tasks which write a git bundle of each package into *out_dir*,
+    for use with run_tasks.
+
+    Each bundle holds the package's branches and tags, less the commits
+    which were already sent, as recorded in *sync* by the previous bundle
+    of the package. A package with no new commits gets no bundle. Nor does
+    one whose branches and tags changed without adding any objects, which
+    git refuses to bundle, and whose refs are sent in the manifest alone.
+    The sync point of each package is advanced as its bundle is written,
+    and the name, if any, and refs of each bundle are collected in
+    *manifest*.
+    """
+
+    def __init__(self, out_dir, sync, full=False):
+        self.out_dir = os.path.abspath(out_dir)
+        self.sync = sync
+        self.full = full
+        self.manifest = {}
+        self.refs = {}
+        self.bundles = {}
+
+    def task(self, ets_pkg_name):
+        """ Return the package's task, as called by run_tasks when the
+        package is started.
+        """
+        def start():
+            try:
+                refs = self.refs[ets_pkg_name] = package_refs(ets_pkg_name)
+            except (OSError, subprocess.CalledProcessError) as detail:
+                return {'status': 'failed', 'detail': str(detail)}
+            sent = {} if self.full else self.sync.get(ets_pkg_name, {})
+            if not refs or refs == sent:
+                return {'status': 'unchanged', 'detail': 'no new commits'}
+            basis = sorted(set(sha for sha in sent.values()
+                               if has_object(ets_pkg_name, sha)))
+            try:
+                new_objects = has_new_objects(ets_pkg_name, basis)
+            except (OSError, subprocess.CalledProcessError) as detail:
+                return {'status': 'failed', 'detail': str(detail)}
+            if not new_objects:
+                self.bundles[ets_pkg_name] = None
+                return {'status': 'ok', 'detail': 'no new commits'}
+            self.bundles[ets_pkg_name] = ets_pkg_name + '.bundle'
+            path = os.path.join(self.out_dir, ets_pkg_name + '.bundle')
+            return (['git', 'bundle', 'create', '--quiet', path,
+                     '--branches', '--tags'] + ['^' + sha for sha in basis],
+                    ets_pkg_name)
+        return start
+
+    def finished(self, ets_pkg_name, result):
+        """ Record the package's new sync point, and add its bundle to the
+        manifest, once the bundle has been written.
+        """
+        if result['status'] != 'ok':
+            return
+        bundle = self.bundles[ets_pkg_name]
+        self.sync[ets_pkg_name] = self.refs[ets_pkg_name]
+        self.manifest[ets_pkg_name] = {
+            'bundle': bundle, 'refs': self.refs[ets_pkg_name]}
+        if bundle is None:
+            result['detail'] = '%d refs, no new commits' % len(
+                self.refs[ets_pkg_name])
+            return
+        size = os.path.getsize(os.path.join(self.out_dir, bundle))
+        result['detail'] = '%d refs, %d bytes' % (
+            len(self.refs[ets_pkg_name]), size)
+
+
+def bundle_fetch_command(bundle, remote):
+    """Return the git command which fetches the branches and tags in
+    *bundle* into the remote-tracking branches of *remote*.
+    """
+    return ['git', 'fetch', bundle,
+            '+refs/heads/*:refs/remotes/%s/*' % remote,
+            '+refs/tags/*:refs/tags/*']
+
+
+def refs_fetch_command(refs, remote):
+    """Return the git command which points the remote-tracking branches of
+    *remote*, and the tags, at the objects given by *refs*, a dict mapping
+    branch and tag names to objects which the package already holds.
+    """
+    refspecs = []
+    for ref, sha in sorted(refs.items()):
+        if ref.startswith('refs/heads/'):
+            ref = 'refs/remotes/%s/%s' % (remote, ref[len('refs/heads/'):])
+        refspecs.append('+%s:%s' % (sha, ref))
+    return ['git', 'fetch', '.'] + refspecs
+
+
+def bundle_main(options, args):
+    """Run the bundle command, with its sub-command and options in *args*.
+    Returns the exit status.
+    """
+    if not args or args[0] not in ('create', 'apply'):
+        print("ets bundle: expected 'create' or 'apply'")
+        return 2
+    try:
+        bundle_opts, extra = parse_options(args[1:], bundle_options,
+                                           default_bundle_options)
+        if args[0] == 'create' and extra:
+            raise ValueError("unexpected arguments %s" % ' '.join(extra))
+        if args[0] == 'apply' and len(extra) != 1:
+            raise ValueError("apply takes one bundle directory or archive")
+        graph = select_packages(options)
+    except ValueError as detail:
+        print("ets bundle: %s" % detail)
+        return 2
+    packages = graph.order()
+
+    if args[0] == 'create':
+        out_dir = bundle_opts['output']
+        if bundle_opts['archive']:
+            out_dir = tempfile.mkdtemp()
+        elif not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        try:
+            sync = load_state(sync_file)
+            bundles = BundleCreate(out_dir, sync, bundle_opts['full'])
+            tasks = dict((ets_pkg_name, bundles.task(ets_pkg_name))
+                         for ets_pkg_name in packages)
+            results = run_tasks(tasks, DependencyGraph({}, packages),
+                                make_output(options), options['jobs'],
+                                options['fail_fast'], bundles.finished)
+            with open(os.path.join(out_dir, bundle_manifest), 'w') as fp:
+                json.dump(bundles.manifest, fp, indent=1, sort_keys=True)
+            if bundle_opts['archive']:
+                mode = 'w:gz' if bundle_opts['archive'].endswith(
+                    ('.gz', '.tgz')) else 'w'
+                with tarfile.open(bundle_opts['archive'], mode) as archive:
+                    for name in sorted(os.listdir(out_dir)):
+                        archive.add(os.path.join(out_dir, name), name)
+            save_state(sync, sync_file)
+        finally:
+            if bundle_opts['archive']:
+                shutil.rmtree(out_dir)
+        return report(results, packages)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = extra[0]
+        if os.path.isfile(source):
+            with tarfile.open(source) as archive:
+                archive.extractall(tmp, filter='data')
+            source = tmp
+        try:
+            with open(os.path.join(source, bundle_manifest)) as fp:
+                manifest = json.load(fp)
+        except (IOError, ValueError) as detail:
+            print("ets bundle: cannot read the bundle manifest: %s" % detail)
+            return 2
+        tasks = {}
+        for ets_pkg_name in packages:
+            if ets_pkg_name not in manifest:
+                continue
+            entry = manifest[ets_pkg_name]
+            if entry['bundle']:
+                cmd = bundle_fetch_command(
+                    os.path.abspath(os.path.join(source, entry['bundle'])),
+                    bundle_opts['remote'])
+            else:
+                cmd = refs_fetch_command(entry['refs'],
+                                         bundle_opts['remote'])
+            tasks[ets_pkg_name] = (cmd, ets_pkg_name)
+        applied = [ets_pkg_name for ets_pkg_name in packages
+                   if ets_pkg_name in tasks]
+        return report(run_in_packages(tasks, make_output(options),
+                                      options['jobs'], options['fail_fast']),
+                      applied)
+
+
+def worktree_main(options, args):
+    """Run the worktree command, with its sub-command and arguments in
+    *args*. Returns the exit status.
+    """
+    if not args or args[0] not in ('add', 'list', 'remove'):
+        print("ets worktree: expected 'add', 'list' or 'remove'")
+        return 2
+    git_args, paths = [], []
+    rest = list(args[1:])
+    while rest:
+        arg = rest.pop(0)
+        if arg in ('-b', '-B', '--reason') and rest:
+            git_args += [arg, rest.pop(0)]
+        elif arg.startswith('-'):
+            git_args.append(arg)
+        else:
+            paths.append(arg)
+    expected = {'add': 2, 'list': 0, 'remove': 1}[args[0]]
+    if len(paths) != expected:
+        print("ets worktree: %s takes %d arguments besides options"
+              % (args[0], expected))
+        return 2
+    try:
+        packages = select_packages(options).order()
+    except ValueError as detail:
+        print("ets worktree: %s" % detail)
+        return 2
+
+    if args[0] == 'list':
+        tasks = dict((ets_pkg_name, (['git', 'worktree', 'list'] + git_args,
+                                     ets_pkg_name))
+                     for ets_pkg_name in packages)
+    else:
+        workspace = os.path.abspath(paths[-1])
+        if args[0] == 'add' and not os.path.isdir(workspace):
+            os.makedirs(workspace)
+        cmd = ['git', 'worktree', args[0]] + git_args
+        tasks = dict(
+            (ets_pkg_name,
+             (cmd + [os.path.join(workspace, ets_pkg_name)] + paths[:-1],
+              ets_pkg_name))
+            for ets_pkg_name in packages)
+    results = run_in_packages(tasks, make_output(options), options['jobs'],
+                              options['fail_fast'])
+    if args[0] == 'remove' and os.path.isdir(workspace):
+        # Remove the workspace itself once its packages are gone, leaving
+        # behind only the files ets keeps there.
+        leftover = [name for name in os.listdir(workspace)
+                    if not name.startswith('.ets')]
+        if not leftover:
+            shutil.rmtree(workspace)
+    return report(results, packages)
+
+
+def git_summary(ets_pkg_name):
+    """Return a dict summarizing the package's git status: its branch,
+    commit, upstream branch, the numbers of commits ahead of and behind the
+    upstream, and the numbers of staged, modified, untracked and conflicted
+    files. If git fails, the dict holds the error message instead.
+    """
+    summary = {'branch': '', 'commit': '', 'upstream': '', 'ahead': 0,
+               'behind': 0, 'staged': 0, 'modified': 0, 'untracked': 0,
+               'conflicts': 0}
+    try:
+        lines = subprocess.check_output(
+            ['git', '--no-optional-locks', 'status', '--porcelain=v2',
+             '--branch'],
+            cwd=ets_pkg_name, stderr=subprocess.PIPE,
+            universal_newlines=True).splitlines()
+    except OSError as detail:
+        return {'error': str(detail)}
+    except subprocess.CalledProcessError as detail:
+        return {'error': detail.stderr.strip()}
+
+    for line in lines:
+        if line.startswith('# branch.oid '):
+            summary['commit'] = line.split()[2]
+        elif line.startswith('# branch.head '):
+            summary['branch'] = line.split()[2]
+        elif line.startswith('# branch.upstream '):
+            summary['upstream'] = line.split()[2]
+        elif line.startswith('# branch.ab '):
+            ahead, behind = line.split()[2:4]
+            summary['ahead'], summary['behind'] = int(ahead), -int(behind)
+        elif line[:2] in ('1 ', '2 '):
+            if line[2] != '.':
+                summary['staged'] += 1
+            if line[3] != '.':
+                summary['modified'] += 1
+        elif line.startswith('u '):
+            summary['conflicts'] += 1
+        elif line.startswith('? '):
+            summary['untracked'] += 1
+    return summary
+
+
+def status_summary(packages, jobs):
+    """Return a dict mapping each of the *packages* to its git_summary,
+    querying up to *jobs* packages concurrently.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        return dict(zip(packages, executor.map(git_summary, packages)))
+
+
+def print_status_table(summaries):
+    """Print the git status summaries of the packages as a table."""
+    print("%-20s %-20s %7s %7s %6s %8s %9s %9s" % (
+        'Package', 'Branch', 'Ahead', 'Behind', 'Staged', 'Modified',
+        'Untracked', 'Conflicts'))
+    for ets_pkg_name, summary in summaries.items():
+        if 'error' in summary:
+            print("%-20s error: %s" % (ets_pkg_name, summary['error']))
+            continue
+        branch = summary['branch']
+        if branch == '(detached)':
+            branch = summary['commit'][:12]
+        print("%-20s %-20s %7s %7s %6d %8d %9d %9d" % (
+            ets_pkg_name, branch,
+            summary['ahead'] if summary['upstream'] else '-',
+            summary['behind'] if summary['upstream'] else '-',
+            summary['staged'], summary['modified'], summary['untracked'],
+            summary['conflicts']))
+
+
 def main():
-    if len(sys.argv) < 2 or sys.argv[1].startswith('-'):
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
         print(usage % (aliases, ets_package_names))
         return
 
-    arg1 = sys.argv[1]
-    clone = bool(arg1 == 'clone')
+    try:
+        options, args = parse_options(sys.argv[1:], ets_options,
+                                      default_options)
+        if options['jobs'] < 1:
+            raise ValueError("option -j requires a positive integer")
+    except ValueError as detail:
+        print("ets: %s" % detail)
+        print(usage % (aliases, ets_package_names))
+        return 2
+    if not args:
+        print(usage % (aliases, ets_package_names))
+        return 2
+    if options['root']:
+        try:
+            os.chdir(options['root'])
+        except OSError as detail:
+            print("ets: %s" % detail)
+            return 2
+
+    arg1 = args[0]
+    try:
+        packages = requested_packages(options)
+    except ValueError as detail:
+        print("ets: %s" % detail)
+        return 2
 
-    if not clone:
-        if arg1 in alias_dict:
-            cmd = alias_dict[arg1] + sys.argv[2:]
-            if cmd[0] == 'python':
-                cmd[0] = sys.executable
-        else:
-            cmd = sys.argv[1:]
+    if arg1 == 'clone':
+        try:
+            clone_opts, extra = parse_options(args[1:], clone_options,
+                                              default_clone_options,
+                                              passthrough=True)
+        except ValueError as detail:
+            print("ets clone: %s" % detail)
+            return 2
+        tasks = dict((ets_pkg_name,
+                      (clone_command(ets_pkg_name, clone_opts, extra), None))
+                     for ets_pkg_name in packages)
+        return report(run_in_packages(tasks, make_output(options),
+                                      options['jobs'], options['fail_fast']))
+
+    if arg1 == 'mirror':
+        try:
+            mirror_opts, extra = parse_options(args[1:], mirror_options,
+                                               default_mirror_options)
+        except ValueError as detail:
+            print("ets mirror: %s" % detail)
+            return 2
+        if extra:
+            print("ets mirror: unexpected arguments %s" % ' '.join(extra))
+            return 2
+        if not os.path.isdir(mirror_opts['mirror_dir']):
+            os.makedirs(mirror_opts['mirror_dir'])
+        tasks = dict((ets_pkg_name,
+                      (mirror_command(ets_pkg_name, mirror_opts), None))
+                     for ets_pkg_name in packages)
+        return report(run_in_packages(tasks, make_output(options),
+                                      options['jobs'], options['fail_fast']))
 
-    for ets_pkg_name in ets_package_names.split():
-        if clone:
-            print("Cloning package %s" % ets_pkg_name)
-            if '--ssh' in sys.argv:
-                pkg_url = ets_ssh % ets_pkg_name
+    if arg1 == 'status' and set(args[1:]) & set(status_options):
+        try:
+            status_opts, extra = parse_options(args[1:], status_options,
+                                               default_status_options)
+            if extra:
+                raise ValueError("unexpected arguments %s" % ' '.join(extra))
+            snapshot = None
+            if status_opts['daemon'] and not options['changed_since']:
+                import ets_daemon
+                snapshot = ets_daemon.query_status()
+            if snapshot is None:
+                graph = select_packages(options)
             else:
-                pkg_url = ets_https % ets_pkg_name
-            print("URL: %s" % pkg_url)
-            subprocess.check_call(['git', 'clone', pkg_url, ets_pkg_name])
+                # Select from the packages which the daemon is watching.
+                graph = DependencyGraph(snapshot['dependencies'])
+                packages = requested_packages(options, graph)
+                graph = graph.subgraph(
+                    [name for name in packages
+                     if name in snapshot['packages']])
+        except ValueError as detail:
+            print("ets status: %s" % detail)
+            return 2
+        packages = graph.order()
+        if snapshot is None:
+            jobs = options['jobs'] if options['jobs'] > 1 else len(packages)
+            summaries = status_summary(packages, jobs)
         else:
-            print("Running command %r in package %s" % (cmd, ets_pkg_name))
-            try:
-                subprocess.check_call(cmd, cwd=ets_pkg_name)
-            except (OSError, subprocess.CalledProcessError) as detail:
-                print("   Error running command in package %s:\n   %s" % (
-                                      ets_pkg_name, detail))
-                input("   Press enter to process remaining packages.")
+            summaries = dict((ets_pkg_name, snapshot['packages'][ets_pkg_name])
+                             for ets_pkg_name in packages)
+        if status_opts['json']:
+            print(json.dumps(summaries, indent=2))
+        else:
+            print_status_table(summaries)
+            if snapshot is not None:
+                print("From the ets daemon, last updated %.1fs ago"
+                      % max(0, time.time() - snapshot['updated']))
+        return 1 if any('error' in summary
+                        for summary in summaries.values()) else 0
+
+    if arg1 == 'wheel':
+        try:
+            graph = select_packages(options)
+        except ValueError as detail:
+            print("ets wheel: %s" % detail)
+            return 2
+        builds = WheelBuilds(options['wheelhouse'], args[1:],
+                             options['force'])
+        tasks = dict((ets_pkg_name, builds.task(ets_pkg_name))
+                     for ets_pkg_name in graph.packages)
+        results = run_tasks(tasks, graph, make_output(options),
+                            options['jobs'], options['fail_fast'],
+                            builds.finished)
+        return report(results, graph.order())
+
+    if arg1 == 'daemon':
+        import ets_daemon
+        return ets_daemon.daemon_main(options, args[1:])
+
+    if arg1 == 'worktree':
+        return worktree_main(options, args[1:])
+
+    if arg1 == 'bundle':
+        return bundle_main(options, args[1:])
+
+    if arg1 == 'test':
+        import ets_testing
+        return ets_testing.test_packages(options, args[1:])
+
+    if arg1 in alias_dict:
+        cmd = alias_dict[arg1] + args[1:]
+        if cmd[0] == 'python':
+            cmd[0] = sys.executable
+    else:
+        cmd = args
+
+    try:
+        graph = select_packages(options)
+    except ValueError as detail:
+        print("ets: %s" % detail)
+        return 2
+    packages = selected = graph.order()
+
+    if arg1 in incremental_aliases:
+        # Rebuild the changed packages and everything downstream of them.
+        # The state is keyed by the full command, since eg. a different
+        # Python or extra arguments produce a different build.
+        key = ' '.join(cmd)
+        state = load_state()
+        with ThreadPoolExecutor(max_workers=options['jobs']) as executor:
+            current = dict(zip(packages, executor.map(package_state,
+                                                      packages)))
+        recorded = state.get(key, {})
+        changed = [ets_pkg_name for ets_pkg_name in packages
+                   if options['force'] or current[ets_pkg_name] is None or
+                   recorded.get(ets_pkg_name) != current[ets_pkg_name]]
+        rebuild = graph.downstream(changed)
+        selected = [ets_pkg_name for ets_pkg_name in packages
+                    if ets_pkg_name in rebuild]
+        for ets_pkg_name in packages:
+            if ets_pkg_name not in rebuild:
+                print("Skipping unchanged package %s" % ets_pkg_name)
+        if len(selected) < len(packages):
+            print()
+
+    tasks = dict((ets_pkg_name, (cmd, ets_pkg_name))
+                 for ets_pkg_name in selected)
+    wheels = {}
+    if (arg1 == 'install' and not args[1:] and options['use_wheels'] and
+            not options['batch']):
+        # Install from the wheelhouse where possible, rather than compiling.
+        with ThreadPoolExecutor(max_workers=options['jobs']) as executor:
+            keys = dict(zip(selected, executor.map(wheel_key, selected)))
+        for ets_pkg_name in selected:
+            wheels[ets_pkg_name] = cached_wheels(
+                ets_pkg_name, keys[ets_pkg_name], options['wheelhouse'])
+            if wheels[ets_pkg_name]:
+                tasks[ets_pkg_name] = (
+                    [sys.executable, '-m', 'pip', 'install', '--no-deps',
+                     '--force-reinstall'] + wheels[ets_pkg_name],
+                    ets_pkg_name)
+    output = make_output(options)
+    if options['batch'] and arg1 in batch_aliases:
+        results = run_batch(arg1, selected, args[1:], options, output)
+    elif arg1 == 'build' and options['jobs'] > 1:
+        jobserver = Jobserver(options['jobs'], options['max_load'],
+                              options['job_memory'], '--parallel')
+        try:
+            results = run_tasks(tasks,
+                                DependencyGraph(graph.dependencies, selected),
+                                output, options['jobs'], options['fail_fast'],
+                                jobserver=jobserver)
+        finally:
+            jobserver.close()
+    elif arg1 in scheduled_aliases:
+        results = run_tasks(tasks,
+                            DependencyGraph(graph.dependencies, selected),
+                            output, options['jobs'], options['fail_fast'])
+    else:
+        results = run_in_packages(tasks, output, options['jobs'],
+                                  options['fail_fast'])
+
+    for ets_pkg_name in selected:
+        result = results[ets_pkg_name]
+        if wheels.get(ets_pkg_name) and result['status'] == 'ok':
+            result['detail'] = 'installed from wheel'
+
+    if arg1 in incremental_aliases:
+        # Record the state after the build, so that any output it writes
+        # which git does not ignore, eg. a generated version.py, does not
+        # make the next run build the package again.
+        built = [ets_pkg_name for ets_pkg_name in selected
+                 if results[ets_pkg_name]['status'] == 'ok']
+        with ThreadPoolExecutor(max_workers=options['jobs']) as executor:
+            current.update(zip(built, executor.map(package_state, built)))
+        for ets_pkg_name in selected:
+            if results[ets_pkg_name]['status'] != 'ok':
+                recorded.pop(ets_pkg_name, None)
+            elif current[ets_pkg_name] is not None:
+                recorded[ets_pkg_name] = current[ets_pkg_name]
+        state[key] = recorded
+        save_state(state)
+        for ets_pkg_name in packages:
+            if ets_pkg_name not in rebuild:
+                results[ets_pkg_name] = {'status': 'unchanged'}
+
+    return report(results, packages)
+
+
+def batch_command(alias, packages, extra_args, options):
+    """Return the single pip command which installs all the *packages*,
+    editable for the develop alias, with the given extra pip arguments and
+    the package index selected by the ets *options*.
+    """
+    cmd = [sys.executable, '-m', 'pip', 'install', '--no-build-isolation']
+    if options['find_links']:
+        cmd += ['--find-links', options['find_links']]
+    if options['index_url']:
+        cmd += ['--index-url', options['index_url']]
+    for ets_pkg_name in packages:
+        if alias == 'develop':
+            cmd.append('-e')
+        cmd.append(os.path.join('.', ets_pkg_name))
+    return cmd + extra_args
+
+
+def run_batch(alias, packages, extra_args, options, output):
+    """Install all the *packages* with one pip command, so that the
+    dependencies of the whole suite are resolved once, and the ETS
+    requirements are met by the checkouts themselves. Returns a dict
+    mapping each package to its result dict, which is the result of the
+    whole batch.
+    """
+    if not packages:
+        return {}
+    result = output.run('batch', batch_command(alias, packages, extra_args,
+                                               options), None)
+    if result['status'] == 'ok':
+        result['detail'] = 'batch of %d packages' % len(packages)
+    return dict((ets_pkg_name, dict(result)) for ets_pkg_name in packages)
+
+
+def make_output(options):
+    """Return the PackageOutput selected by the ets *options*."""
+    if options['stream']:
+        mode = 'stream'
+    elif options['jobs'] > 1:
+        mode = 'block'
+    elif options['log_dir']:
+        # The output must be captured to be logged.
+        mode = 'stream'
+    else:
+        mode = 'direct'
+    if options['log_dir'] and not os.path.isdir(options['log_dir']):
+        os.makedirs(options['log_dir'])
+    return PackageOutput(mode, options['log_dir'], options['compress_logs'],
+                         options['metrics'], options['trace'])
+
+
+def report(results, packages=None):
+    """Print a summary table of the *results*, a dict mapping package names
+    to result dicts, in the order of *packages*, and return the exit status
+    for the whole run.
+    """
+    if packages is None:
+        packages = list(results)
+    packages = [name for name in packages if name in results]
+    if not packages:
+        return 0
+
+    print("%-20s %-10s %9s  %s" % ('Package', 'Status', 'Time', 'Detail'))
+    for ets_pkg_name in packages:
+        result = results[ets_pkg_name]
+        seconds = result.get('seconds')
+        print("%-20s %-10s %9s  %s" % (
+            ets_pkg_name, result['status'],
+            '' if seconds is None else '%.1fs' % seconds,
+            result.get('detail', '')))
+
+    timed = [name for name in packages
+             if results[name].get('seconds') is not None]
+    if len(timed) > 1:
+        print("Slowest packages:")
+        for ets_pkg_name in sorted(
+                timed, key=lambda name: -results[name]['seconds'])[:5]:
+            result = results[ets_pkg_name]
+            line = "   %-20s %9.1fs wall" % (ets_pkg_name, result['seconds'])
+            if 'user' in result:
+                line += " %9.1fs cpu %9.1f MB max RSS" % (
+                    result['user'] + result['sys'],
+                    result['max_rss_kb'] / 1024.0)
+            print(line)
 
-        print()
+    bad = [name for name in packages
+           if results[name]['status'] not in succeeded]
+    if bad:
+        print("Command did not succeed in %d of %d packages: %s" % (
+            len(bad), len(packages), ', '.join(bad)))
+        return 1
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,430 @@
+#! /usr/bin/env python
+"""Benchmarks the ets and ets_docs commands in this source tree against
+synthetic packages, without any network access. The packages are generated
+as local git repositories, with a configurable dependency graph, history
+depth and number of files, and the commands are timed at each of several
+numbers of jobs. The results are saved as JSON, so that the runs of two
+versions of ets may be compared.
+"""
+
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from ets import parse_options
+
+usage = """\
+Usage: ets_bench.py -h | --help | run [run options]
+       | compare [--threshold PERCENT] OLD.json NEW.json
+   -h, --help  Print this message.
+
+   run         Generate the synthetic packages in a temporary directory,
+               clone them into a workspace with ets, and time each command at
+               each number of jobs. The run options are:
+               --packages N
+                           Generate N packages, by default 15.
+               --graph SHAPE
+                           The shape of the dependency graph: chain (each
+                           package depends on the one before), tree (each
+                           package depends on one earlier package), layered
+                           (each package depends on up to --deps packages of
+                           the layer before), or random (each depends on up
+                           to --deps earlier packages). The default is tree.
+               --deps K    The most dependencies of a package, by default 2.
+               --commits N The number of commits in each package's history,
+                           by default 50.
+               --files N   The number of modules in each package, by default
+                           20.
+               --jobs N[,N...]
+                           The numbers of jobs to time each command at, by
+                           default 1,2,4,8.
+               --repeat N  Time each command N times, and keep the median,
+                           by default 3.
+               --commands NAME[,NAME...]
+                           The commands to time, out of clone, status, fetch,
+                           develop, develop-batch and docs. By default, all
+                           of them.
+               --seed N    The seed of the random dependency graphs.
+               --label TEXT
+                           A label for the run, by default the git commit of
+                           this source tree.
+               --output FILE
+                           Write the results to FILE, by default
+                           ets_bench.json.
+               --keep DIR  Generate everything in DIR, and keep it.
+               The develop commands install the packages into a virtual
+               environment made for the run, which sees the site-packages
+               of the Python running this script.
+
+   compare     Print the ratio of the new to the old median time of each
+               command, and return a non-zero exit status if any is slower
+               by more than PERCENT per cent, by default 10.
+
+   Example:
+      python ets_bench.py run --packages 30 --jobs 1,4 --output new.json
+      python ets_bench.py compare old.json new.json
+"""
+
+# The commands which may be timed, and their arguments, in which {jobs} is
+# replaced by the number of jobs. Each is run by ets, but for docs, which is
+# run by ets_docs.
+bench_commands = [
+    ('clone', ['-j', '{jobs}', 'clone', '--url', '{url}']),
+    ('status', ['-j', '{jobs}', 'status', '--summary']),
+    ('fetch', ['-j', '{jobs}', 'fetch']),
+    ('develop', ['-j', '{jobs}', '--force', 'develop']),
+    ('develop-batch', ['--force', '--batch', 'develop', '--no-index']),
+    ('docs', ['-j', '{jobs}', '--no-cache', 'html']),
+]
+
+# Options which may follow the run command.
+run_options = {
+    '--packages': ('packages', True),
+    '--graph': ('graph', True),
+    '--deps': ('deps', True),
+    '--commits': ('commits', True),
+    '--files': ('files', True),
+    '--jobs': ('jobs', True),
+    '--repeat': ('repeat', True),
+    '--commands': ('commands', True),
+    '--seed': ('seed', True),
+    '--label': ('label', True),
+    '--output': ('output', True),
+    '--keep': ('keep', True),
+}
+
+default_run_options = {
+    'packages': 15,
+    'graph': 'tree',
+    'deps': 2,
+    'commits': 50,
+    'files': 20,
+    'jobs': '1,2,4,8',
+    'repeat': 3,
+    'commands': ','.join(name for name, args in bench_commands),
+    'seed': 0,
+    'label': '',
+    'output': 'ets_bench.json',
+    'keep': '',
+}
+
+# Options which may follow the compare command.
+compare_options = {
+    '--threshold': ('threshold', True),
+}
+
+default_compare_options = {
+    'threshold': 10,
+}
+
+setup_template = """\
+from setuptools import setup
+
+setup(
+    name=%(name)r,
+    version='1.0',
+    packages=[%(name)r],
+    install_requires=%(requires)r,
+)
+"""
+
+makefile = """\
+SPHINXOPTS ?=
+
+html:
+\tsphinx-build -q -b html $(SPHINXOPTS) source build/html
+"""
+
+conf_template = """\
+project = %(name)r
+extensions = []
+"""
+
+index_template = """\
+%(title)s
+
+.. toctree::
+
+%(modules)s
+"""
+
+
+def dependency_graph(count, shape, max_deps, seed=0):
+    """Return a dict mapping each of *count* package names to a list of the
+    names of its dependencies, in a graph of the given *shape*. Each
+    package depends only on the packages before it, so there is no cycle.
+    """
+    rng = random.Random(seed)
+    names = ['pkg%03d' % i for i in range(count)]
+    graph = {}
+    if shape == 'layered':
+        width = max(1, int(round(count ** 0.5)))
+        for i, name in enumerate(names):
+            layer = i // width
+            previous = names[max(0, layer - 1) * width:layer * width]
+            graph[name] = sorted(rng.sample(previous,
+                                            min(max_deps, len(previous))))
+        return graph
+    for i, name in enumerate(names):
+        if i == 0:
+            graph[name] = []
+        elif shape == 'chain':
+            graph[name] = [names[i - 1]]
+        elif shape == 'tree':
+            graph[name] = [names[rng.randrange(i)]]
+        elif shape == 'random':
+            graph[name] = sorted(rng.sample(
+                names[:i], rng.randint(0, min(max_deps, i))))
+        else:
+            raise ValueError("unknown graph shape %r" % shape)
+    return graph
+
+
+def fast_import_stream(name, requires, commits, files):
+    """Return the git fast-import stream of the history of package *name*,
+    with *commits* commits, the last of which holds *files* modules, a
+    setup.py requiring the packages *requires*, and the docs.
+    """
+    chunks = []
+
+    def blob(path, text):
+        data = text.encode()
+        chunks.append(b'M 644 inline %s\ndata %d\n%s\n'
+                      % (path.encode(), len(data), data))
+
+    for number in range(1, commits + 1):
+        message = ('commit %d of %s' % (number, name)).encode()
+        chunks.append(b'commit refs/heads/master\n'
+                      b'committer Bench <bench@example.com> %d +0000\n'
+                      b'data %d\n%s\n'
+                      % (1000000000 + number, len(message), message))
+        if number == 1:
+            blob('setup.py', setup_template % {'name': name,
+                                               'requires': requires})
+            blob('%s/__init__.py' % name, '')
+            blob('docs/Makefile', makefile)
+            blob('docs/source/conf.py', conf_template % {'name': name})
+            modules = ''.join('   %s_%d\n' % (name, index)
+                              for index in range(files))
+            blob('docs/source/index.rst', index_template % {
+                'title': name + '\n' + '=' * len(name), 'modules': modules})
+            for index in range(files):
+                title = '%s.module_%d' % (name, index)
+                blob('docs/source/%s_%d.rst' % (name, index),
+                     '%s\n%s\n\nSome text.\n' % (title, '=' * len(title)))
+        # Each commit changes one module.
+        index = number % files
+        blob('%s/module_%d.py' % (name, index),
+             '"""Module %d, as of commit %d."""\n\n'
+             'def function_%d():\n    return %d\n'
+             % (index, number, index, number))
+    return b''.join(chunks)
+
+
+def generate(root, graph, commits, files):
+    """Create a bare git repository for each package of *graph* in
+    directory *root*, named PKG.git.
+    """
+    for name, requires in graph.items():
+        path = os.path.join(root, name + '.git')
+        subprocess.check_call(['git', 'init', '--quiet', '--bare', path])
+        proc = subprocess.Popen(['git', '--git-dir', path, 'fast-import',
+                                 '--quiet'], stdin=subprocess.PIPE)
+        proc.communicate(fast_import_stream(name, requires, commits, files))
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, 'fast-import')
+
+
+def source_label():
+    """Return the git commit of this source tree, or 'unknown'."""
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def time_command(python, script, args, cwd, env):
+    """Run the ets *script* with *args* in directory *cwd*, and return its
+    wall time in seconds, or None if it failed.
+    """
+    start = time.time()
+    returncode = subprocess.call([python, script] + args, cwd=cwd, env=env,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL)
+    seconds = time.time() - start
+    return seconds if returncode == 0 else None
+
+
+def run(opts):
+    """Generate the synthetic packages, time the commands selected by the
+    run options *opts*, and save and return the results.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    ets_script = os.path.join(here, 'ets.py')
+    docs_script = os.path.join(here, 'ets_docs.py')
+    jobs_list = [int(jobs) for jobs in opts['jobs'].split(',')]
+    commands = opts['commands'].split(',')
+    unknown = set(commands) - set(name for name, args in bench_commands)
+    if unknown:
+        raise ValueError("unknown command %s" % ', '.join(sorted(unknown)))
+
+    root = opts['keep'] or tempfile.mkdtemp(prefix='ets_bench-')
+    try:
+        graph = dependency_graph(opts['packages'], opts['graph'],
+                                 opts['deps'], opts['seed'])
+        print("Generating %d packages in %s" % (len(graph), root))
+        upstream = os.path.join(root, 'upstream')
+        os.makedirs(upstream)
+        generate(upstream, graph, opts['commits'], opts['files'])
+
+        python = sys.executable
+        if set(commands) & set(['develop', 'develop-batch']):
+            venv = os.path.join(root, 'venv')
+            subprocess.check_call([sys.executable, '-m', 'venv',
+                                   '--system-site-packages', venv])
+            python = os.path.join(venv, 'Scripts' if os.name == 'nt'
+                                  else 'bin', os.path.basename(
+                                      sys.executable))
+        env = dict(os.environ, ETS_PACKAGES=' '.join(graph))
+        url = 'file://%s/%%s.git' % upstream.replace(os.sep, '/')
+
+        results = []
+        for name, args in bench_commands:
+            if name not in commands:
+                continue
+            # develop-batch runs a single pip command, so takes no jobs.
+            for jobs in (jobs_list if '{jobs}' in args else [1]):
+                cmd_args = [arg.format(jobs=jobs, url=url) for arg in args]
+                times = []
+                for repeat in range(opts['repeat']):
+                    workspace = os.path.join(root, 'workspace')
+                    if name == 'clone' and os.path.isdir(workspace):
+                        shutil.rmtree(workspace)
+                    if not os.path.isdir(workspace):
+                        os.makedirs(workspace)
+                        if name != 'clone':
+                            subprocess.check_call(
+                                [python, ets_script, '-j', '8', 'clone',
+                                 '--url', url], cwd=workspace, env=env,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+                    if name == 'docs':
+                        # Start each docs build afresh.
+                        for ets_pkg_name in graph:
+                            shutil.rmtree(os.path.join(
+                                workspace, ets_pkg_name, 'docs', 'build'),
+                                ignore_errors=True)
+                    script = docs_script if name == 'docs' else ets_script
+                    times.append(time_command(python, script, cmd_args,
+                                              workspace, env))
+                ok = None not in times
+                median = statistics.median(times) if ok else None
+                results.append({'command': name, 'jobs': jobs, 'ok': ok,
+                                'times': times, 'median': median})
+                print("%-14s -j %-3d %s" % (
+                    name, jobs, '%.2fs' % median if ok else 'failed'))
+    finally:
+        if not opts['keep']:
+            shutil.rmtree(root, ignore_errors=True)
+
+    data = {
+        'label': opts['label'] or source_label(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': dict((key, opts[key]) for key in (
+            'packages', 'graph', 'deps', 'commits', 'files', 'repeat',
+            'seed')),
+        'dependencies': graph,
+        'results': results,
+    }
+    with open(opts['output'], 'w') as fp:
+        json.dump(data, fp, indent=1)
+    print_speedups(results)
+    print("Results written to %s" % opts['output'])
+    return data
+
+
+def print_speedups(results):
+    """Print the speed-up of each command with more jobs over one job."""
+    serial = dict((result['command'], result['median'])
+                  for result in results
+                  if result['jobs'] == 1 and result['ok'])
+    for result in results:
+        base = serial.get(result['command'])
+        if result['jobs'] > 1 and result['ok'] and base:
+            print("%-14s -j %-3d %.1fx faster than -j 1" % (
+                result['command'], result['jobs'], base / result['median']))
+
+
+def compare(old, new, threshold):
+    """Print the ratio of each command's median time in the results *new*
+    to that in *old*, and return the number of regressions by more than
+    *threshold* per cent.
+    """
+    old_results = dict(((result['command'], result['jobs']), result)
+                       for result in old['results'])
+    print("Comparing %s (old) with %s (new)" % (old['label'], new['label']))
+    if old['config'] != new['config']:
+        print("Warning: the runs used different configurations")
+    print("%-14s %5s %9s %9s %7s" % ('Command', 'Jobs', 'Old', 'New',
+                                     'Ratio'))
+    regressions = 0
+    for result in new['results']:
+        before = old_results.get((result['command'], result['jobs']))
+        if before is None or not (before['ok'] and result['ok']):
+            continue
+        ratio = result['median'] / before['median']
+        flag = ''
+        if ratio > 1 + threshold / 100.0:
+            flag = '  slower'
+            regressions += 1
+        print("%-14s %5d %8.2fs %8.2fs %6.2fx%s" % (
+            result['command'], result['jobs'], before['median'],
+            result['median'], ratio, flag))
+    return regressions
+
+
+def main():
+    args = sys.argv[1:]
+    if not args or args[0] in ('-h', '--help'):
+        print(usage)
+        return 0 if args else 2
+
+    try:
+        if args[0] == 'run':
+            opts, extra = parse_options(args[1:], run_options,
+                                        default_run_options)
+            if extra:
+                raise ValueError("unexpected arguments %s" % ' '.join(extra))
+            run(opts)
+            return 0
+        if args[0] == 'compare':
+            opts, extra = parse_options(args[1:], compare_options,
+                                        default_compare_options)
+            if len(extra) != 2:
+                raise ValueError("compare takes two result files")
+            runs = []
+            for path in extra:
+                with open(path) as fp:
+                    runs.append(json.load(fp))
+            return 1 if compare(runs[0], runs[1], opts['threshold']) else 0
+        raise ValueError("unknown command %r" % args[0])
+    except (IOError, ValueError, subprocess.CalledProcessError) as detail:
+        print("ets_bench: %s" % detail)
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,401 @@
+#! /usr/bin/env python
+"""Keeps the git status of the ETS packages in a workspace up to date, as the
+'ets daemon' command, and serves it to 'ets status --summary' over a Unix
+socket in the workspace. The package directories are watched with inotify
+where it is available, and polled otherwise, so that only the packages which
+change are scanned again. Optionally, an incremental alias such as develop is
+run whenever a package's working tree changes.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ets
+from ets import (git_summary, incremental_aliases, package_state,
+                 parse_options, select_packages)
+
+# The socket through which the daemon serves a workspace, in the workspace.
+socket_name = '.ets_daemon.sock'
+
+# Options which may follow the daemon command.
+daemon_options = {
+    '--poll': ('poll', True),
+    '--rebuild': ('rebuild', True),
+}
+
+default_daemon_options = {
+    'poll': 0.0,
+    'rebuild': '',
+}
+
+# The inotify event flags, from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+watch_mask = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+
+# The layout of the header of an inotify event: wd, mask, cookie and len.
+event_header = struct.Struct('iIII')
+
+# How long to wait for further changes before scanning a changed package.
+settle_time = 0.2
+
+
+class Inotify(object):
+    """ Watches directory trees with the Linux inotify API, through ctypes.
+    Raises OSError if inotify is not available.
+    """
+
+    def __init__(self):
+        name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or name is None:
+            raise OSError("inotify is not available")
+        self.libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        # The package and path watched by each watch descriptor.
+        self.watches = {}
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, ets_pkg_name, path):
+        """ Watch the directory *path* of the package. Raises OSError if it
+        cannot be watched, unless it no longer exists.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                         watch_mask)
+        if wd >= 0:
+            self.watches[wd] = (ets_pkg_name, path)
+            return
+        error = ctypes.get_errno()
+        if error in (errno.ENOENT, errno.ENOTDIR):
+            return
+        if error == errno.ENOSPC:
+            raise OSError(error, "the inotify watch limit was reached, see "
+                          "/proc/sys/fs/inotify/max_user_watches")
+        raise OSError(error, "cannot watch %s: %s"
+                      % (path, os.strerror(error)))
+
+    def add_package(self, ets_pkg_name, path=None):
+        """ Watch the package's working tree, and the parts of its git
+        directories which change with its HEAD, index and branches. Watches
+        *path* and the directories below it instead, if given. Directories
+        which git ignores, such as build, are not watched, since they do
+        not change the package's status.
+        """
+        top = path or ets_pkg_name
+        ignored = ignored_dirs(ets_pkg_name, top)
+        for dirpath, dirnames, filenames in os.walk(top):
+            if os.path.relpath(dirpath, ets_pkg_name) in ignored:
+                dirnames[:] = []
+                continue
+            self.add_watch(ets_pkg_name, dirpath)
+            if '.git' in dirnames:
+                dirnames.remove('.git')
+        if path is None:
+            for git_dir in git_dirs(ets_pkg_name):
+                self.add_watch(ets_pkg_name, git_dir)
+                for refs_path, _, _ in os.walk(os.path.join(git_dir,
+                                                            'refs')):
+                    self.add_watch(ets_pkg_name, refs_path)
+
+    def read(self, timeout):
+        """ Wait up to *timeout* seconds for events, and return the set of
+        packages which changed, or None if events were lost.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = event_header.unpack_from(data, offset)
+            name = data[offset + event_header.size:
+                        offset + event_header.size + length].rstrip(b'\0')
+            offset += event_header.size + length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if wd not in self.watches:
+                continue
+            ets_pkg_name, path = self.watches[wd]
+            changed.add(ets_pkg_name)
+            if mask & IN_CREATE and mask & IN_ISDIR:
+                # Watch the new directory, and any made inside it already.
+                self.add_package(ets_pkg_name,
+                                 os.path.join(path, os.fsdecode(name)))
+        return changed
+
+
+def git_dirs(ets_pkg_name):
+    """Return the absolute paths of the package's git directory, holding
+    its HEAD and index, and of the common directory holding its branches.
+    These differ for a worktree, whose .git is a file. Returns an empty
+    list if git fails.
+    """
+    try:
+        lines = subprocess.check_output(
+            ['git', 'rev-parse', '--absolute-git-dir', '--git-common-dir'],
+            cwd=ets_pkg_name, stderr=subprocess.DEVNULL,
+            universal_newlines=True).splitlines()
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    # The common directory may be given relative to the package.
+    return sorted(set(os.path.abspath(os.path.join(ets_pkg_name, line))
+                      for line in lines))
+
+
+def ignored_dirs(ets_pkg_name, path):
+    """Return the set of directories at or below *path* in the package which
+    git ignores, relative to the package.
+    """
+    try:
+        lines = subprocess.check_output(
+            ['git', '--no-optional-locks', 'ls-files', '--others',
+             '--ignored', '--exclude-standard', '--directory', '-z', '--',
+             os.path.relpath(path, ets_pkg_name)],
+            cwd=ets_pkg_name, stderr=subprocess.DEVNULL,
+            universal_newlines=True).split('\0')
+    except (OSError, subprocess.CalledProcessError):
+        return set()
+    return set(os.path.normpath(line) for line in lines
+               if line.endswith('/'))
+
+
+class StatusCache(object):
+    """ The latest git status summary of each package, kept up to date by
+    the daemon and read by its clients.
+    """
+
+    def __init__(self, graph, jobs):
+        self.graph = graph
+        self.packages = graph.order()
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.summaries = {}
+        self.updated = {}
+
+    def refresh(self, packages):
+        """ Scan the *packages* again, concurrently. """
+        packages = [name for name in self.packages if name in packages]
+        if not packages:
+            return
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            summaries = list(executor.map(git_summary, packages))
+        now = time.time()
+        with self.lock:
+            for ets_pkg_name, summary in zip(packages, summaries):
+                self.summaries[ets_pkg_name] = summary
+                self.updated[ets_pkg_name] = now
+
+    def snapshot(self):
+        """ Return the cached summaries, and the graph of the packages, as
+        sent to clients.
+        """
+        with self.lock:
+            return {'packages': dict(self.summaries),
+                    'updated': max(self.updated.values() or [0]),
+                    'dependencies': self.graph.dependencies,
+                    'pid': os.getpid()}
+
+
+class Rebuilder(object):
+    """ Runs an incremental alias in the workspace whenever it is asked to,
+    one run at a time. A request made during a run starts another run once
+    it is over.
+    """
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.wanted = threading.Event()
+        self.states = {}
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def changed(self, packages):
+        """ Start a run if the working tree of any of the *packages* has
+        changed, rather than just files which git ignores.
+        """
+        for ets_pkg_name in packages:
+            state = package_state(ets_pkg_name)
+            if state != self.states.get(ets_pkg_name):
+                self.states[ets_pkg_name] = state
+                self.wanted.set()
+
+    def run(self):
+        while True:
+            self.wanted.wait()
+            self.wanted.clear()
+            print("Running %s" % ' '.join(self.cmd))
+            sys.stdout.flush()
+            subprocess.call(self.cmd)
+
+
+class StatusHandler(socketserver.StreamRequestHandler):
+    """ Answers a 'status' request with the cached summaries, as JSON. """
+
+    def handle(self):
+        request = self.rfile.readline().strip()
+        if request == b'status':
+            reply = self.server.cache.snapshot()
+        else:
+            reply = {'error': 'unknown request %r' % request.decode()}
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+def query_status(path=socket_name, timeout=1.0):
+    """Return the status snapshot served by the daemon of the workspace in
+    the current directory, or None if no daemon is running.
+    """
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(b'status\n')
+            with sock.makefile('rb') as fp:
+                reply = json.loads(fp.readline().decode())
+    except (OSError, ValueError):
+        return None
+    return reply if 'packages' in reply else None
+
+
+def watch(cache, poll, rebuilder):
+    """Keep the *cache* up to date, until interrupted. The packages are
+    watched with inotify, unless *poll* is set or inotify is not available,
+    in which case they are all scanned every *poll* seconds. If a directory
+    cannot be watched, eg. because the inotify watch limit is reached, the
+    daemon falls back to polling, rather than serve a stale status.
+    """
+    if not poll:
+        try:
+            watch_events(cache, rebuilder)
+        except OSError as detail:
+            print("Polling every 2 seconds, since %s" % detail)
+            sys.stdout.flush()
+            poll = 2.0
+    while True:
+        time.sleep(poll)
+        cache.refresh(cache.packages)
+        if rebuilder is not None:
+            rebuilder.changed(cache.packages)
+
+
+def watch_events(cache, rebuilder):
+    """Keep the *cache* up to date with inotify, until interrupted. Raises
+    OSError if inotify is not available, or stops working.
+    """
+    inotify = Inotify()
+    try:
+        for ets_pkg_name in cache.packages:
+            inotify.add_package(ets_pkg_name)
+        print("Watching %d directories" % len(inotify.watches))
+        sys.stdout.flush()
+        while True:
+            changed = inotify.read(None)
+            # Gather the rest of a burst of changes before scanning.
+            while changed is not None:
+                more = inotify.read(settle_time)
+                if not more:
+                    break
+                changed |= more
+            if changed is None:
+                changed = set(cache.packages)
+            cache.refresh(changed)
+            if rebuilder is not None:
+                rebuilder.changed(changed)
+    finally:
+        inotify.close()
+
+
+def daemon_main(options, args):
+    """Run the daemon for the workspace in the current directory, with the
+    daemon options in *args*, until interrupted. Returns the exit status.
+    """
+    try:
+        daemon_opts, extra = parse_options(args, daemon_options,
+                                           default_daemon_options)
+        if extra:
+            raise ValueError("unexpected arguments %s" % ' '.join(extra))
+        if (daemon_opts['rebuild'] and
+                daemon_opts['rebuild'] not in incremental_aliases):
+            raise ValueError("--rebuild takes one of %s"
+                             % ', '.join(incremental_aliases))
+        graph = select_packages(options)
+    except ValueError as detail:
+        print("ets daemon: %s" % detail)
+        return 2
+    if not hasattr(socket, 'AF_UNIX'):
+        print("ets daemon: Unix sockets are not available")
+        return 2
+    if query_status() is not None:
+        print("ets daemon: a daemon is already serving this workspace")
+        return 1
+    if os.path.exists(socket_name):
+        os.remove(socket_name)
+
+    cache = StatusCache(graph, max(options['jobs'], len(graph.packages), 1))
+    cache.refresh(cache.packages)
+    rebuilder = None
+    if daemon_opts['rebuild']:
+        cmd = [sys.executable, os.path.abspath(ets.__file__),
+               '-j', str(options['jobs'])]
+        for option in ('only', 'downstream_of'):
+            if options[option]:
+                cmd += ['--' + option.replace('_', '-'), options[option]]
+        rebuilder = Rebuilder(cmd + [daemon_opts['rebuild']])
+        rebuilder.changed(cache.packages)
+
+    server = socketserver.ThreadingUnixStreamServer(socket_name,
+                                                    StatusHandler)
+    server.daemon_threads = True
+    server.cache = cache
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    # Remove the socket on termination, as on an interrupt.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Serving the status of %d packages on %s"
+          % (len(cache.packages), os.path.abspath(socket_name)))
+    sys.stdout.flush()
+    try:
+        watch(cache, daemon_opts['poll'], rebuilder)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        if os.path.exists(socket_name):
+            os.remove(socket_name)
+    return 0
@@ -1,32 +1,459 @@
+#! /usr/bin/env python
 """
 Extract dependency info from ETS setup files.
 Should be run from the ETS root directory, which contains the
 directories for each ETS package.
+
+The setup_data.py, setup.py, setup.cfg and pyproject.toml files of each
+package are read statically, without running any of their code. The results
+are cached in the file .ets_depends_cache.json, keyed by the modification
+time, size and content hash of those files, so repeated queries only re-read
+the packages whose setup files have changed.
 """
+
+import ast
+import configparser
+import hashlib
+import json
 import os
-from ets import ets_package_names
+import re
+import sys
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+usage = """\
+Usage: ets_depends -h | --help | [--json | --dot] [--no-cache] [PACKAGE ...]
+   -h, --help  Print this message.
+   --json      Print the dependency information as JSON.
+   --dot       Print the graph of ETS installation dependencies in Graphviz
+               DOT format.
+   --no-cache  Ignore, and do not update, the cache of extracted data.
+
+   By default, the dependencies of all ETS packages are printed as text.
+"""
+
 INDENT = '  '
 
-for pkg_name in ets_package_names.split():
-    setup_data = dict(__name__='', __file__='setup_data.py')
+# The files read for each package, in order of precedence.
+setup_files = ['setup_data.py', 'setup.py', 'setup.cfg', 'pyproject.toml']
+
+cache_file = '.ets_depends_cache.json'
+
+# Bumped whenever the format of the extracted data changes, to invalidate
+# the cache.
+cache_version = 1
+
+
+def requirement_name(requirement):
+    """Return the normalized project name of a requirement string, eg.
+    'traits' for 'Traits >= 4.5.0.dev'.
+    """
+    match = re.match(r'\s*([A-Za-z0-9][A-Za-z0-9._-]*)', requirement)
+    if match is None:
+        return None
+    return re.sub(r'[-_.]+', '-', match.group(1)).lower()
+
+
+def evaluate(node, namespace):
+    """Evaluate the expression *node* using only literals, the names already
+    evaluated in *namespace*, string formatting and concatenation, simple
+    comprehensions and dict() calls. Raises ValueError for anything else.
+    """
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        items = [evaluate(item, namespace) for item in node.elts]
+        return {ast.List: list, ast.Tuple: tuple, ast.Set: set}[
+            type(node)](items)
+    if isinstance(node, ast.Dict):
+        result = {}
+        for key, value in zip(node.keys, node.values):
+            if key is None:
+                result.update(evaluate(value, namespace))
+            else:
+                result[evaluate(key, namespace)] = evaluate(value, namespace)
+        return result
+    if isinstance(node, ast.Name):
+        if node.id in namespace:
+            return namespace[node.id]
+        raise ValueError("unknown name %r" % node.id)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Mod)):
+        left = evaluate(node.left, namespace)
+        right = evaluate(node.right, namespace)
+        if isinstance(node.op, ast.Add):
+            return left + right
+        if isinstance(left, str):
+            return left % right
+    if isinstance(node, ast.ListComp) and len(node.generators) == 1:
+        generator = node.generators[0]
+        if not generator.ifs and not generator.is_async:
+            result = []
+            for item in evaluate(generator.iter, namespace):
+                scope = dict(namespace)
+                bind(generator.target, item, scope)
+                result.append(evaluate(node.elt, scope))
+            return result
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+            node.func.id == 'dict' and len(node.args) <= 1):
+        result = dict(evaluate(node.args[0], namespace)) if node.args else {}
+        for keyword in node.keywords:
+            if keyword.arg is None:
+                result.update(evaluate(keyword.value, namespace))
+            else:
+                result[keyword.arg] = evaluate(keyword.value, namespace)
+        return result
+    raise ValueError("cannot evaluate %s statically" % type(node).__name__)
+
+
+def bind(target, value, namespace):
+    """Bind *value* to the assignment *target* in *namespace*."""
+    if isinstance(target, ast.Name):
+        namespace[target.id] = value
+    elif isinstance(target, (ast.Tuple, ast.List)):
+        values = list(value)
+        if len(values) != len(target.elts):
+            raise ValueError("cannot unpack %d values" % len(values))
+        for item, item_value in zip(target.elts, values):
+            bind(item, item_value, namespace)
+    else:
+        raise ValueError("cannot assign to %s" % type(target).__name__)
+
+
+def read_python(path):
+    """Return the metadata found statically in a setup_data.py or setup.py
+    file: the INFO dict, any module level install_requires or
+    extras_require, and the keywords of any setup() call.
+    """
+    with open(path, 'rb') as fp:
+        tree = ast.parse(fp.read(), path)
+
+    namespace = {}
+    info = {}
+    for stmt in tree.body:
+        if isinstance(stmt, ast.Assign):
+            try:
+                value = evaluate(stmt.value, namespace)
+            except (ValueError, TypeError, KeyError):
+                continue
+            for target in stmt.targets:
+                try:
+                    bind(target, value, namespace)
+                except (ValueError, TypeError):
+                    pass
+
+    if isinstance(namespace.get('INFO'), dict):
+        info.update(namespace['INFO'])
+    for key in ('install_requires', 'extras_require'):
+        if key in namespace:
+            info.setdefault(key, namespace[key])
+
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Call) and
+                getattr(node.func, 'id', getattr(node.func, 'attr', None))
+                == 'setup'):
+            for keyword in node.keywords:
+                if keyword.arg in ('name', 'version', 'install_requires',
+                                   'extras_require'):
+                    try:
+                        value = evaluate(keyword.value, namespace)
+                    except (ValueError, TypeError, KeyError):
+                        continue
+                    info.setdefault(keyword.arg, value)
+    return info
+
+
+def read_setup_cfg(path):
+    """Return the metadata found in a setup.cfg file."""
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read(path)
+    info = {}
+    if parser.has_option('metadata', 'name'):
+        info['name'] = parser.get('metadata', 'name')
+    if parser.has_option('metadata', 'version'):
+        info['version'] = parser.get('metadata', 'version')
+    if parser.has_option('options', 'install_requires'):
+        info['install_requires'] = [
+            line.strip() for line in
+            parser.get('options', 'install_requires').splitlines()
+            if line.strip()]
+    if parser.has_section('options.extras_require'):
+        info['extras_require'] = dict(
+            (key, [line.strip() for line in value.splitlines()
+                   if line.strip()])
+            for key, value in parser.items('options.extras_require'))
+    return info
+
+
+def read_pyproject(path):
+    """Return the metadata found in the [project] table of a pyproject.toml
+    file, or nothing if no TOML parser is available.
+    """
+    if tomllib is None:
+        return {}
+    with open(path, 'rb') as fp:
+        project = tomllib.load(fp).get('project', {})
+    info = {}
+    for key in ('name', 'version'):
+        if key in project:
+            info[key] = project[key]
+    if 'dependencies' in project:
+        info['install_requires'] = project['dependencies']
+    if 'optional-dependencies' in project:
+        info['extras_require'] = project['optional-dependencies']
+    return info
+
+
+readers = {
+    'setup_data.py': read_python,
+    'setup.py': read_python,
+    'setup.cfg': read_setup_cfg,
+    'pyproject.toml': read_pyproject,
+}
+
+
+def is_string_list(value):
+    """Return whether *value* is a list or tuple of strings."""
+    return (isinstance(value, (list, tuple)) and
+            all(isinstance(item, str) for item in value))
+
+
+def extract(pkg_dir):
+    """Return the metadata of the package in *pkg_dir*, merged from its setup
+    files in order of precedence, or None if it has no setup files.
+    """
+    info = None
+    for name in setup_files:
+        path = os.path.join(pkg_dir, name)
+        if not os.path.isfile(path):
+            continue
+        try:
+            found = readers[name](path)
+        except (SyntaxError, ValueError, configparser.Error) as detail:
+            found = {}
+            sys.stderr.write("ets_depends: cannot read %s: %s\n" % (
+                path, detail))
+        if info is None:
+            info = {}
+        for key, value in found.items():
+            info.setdefault(key, value)
+    if info is None:
+        return None
+
+    requires = info.get('install_requires') or []
+    if isinstance(requires, str):
+        requires = requires.splitlines()
+    if not is_string_list(requires):
+        sys.stderr.write("ets_depends: ignoring install_requires of %s, "
+                         "which is not a list of strings\n" % pkg_dir)
+        requires = []
+    extras = info.get('extras_require') or {}
+    if isinstance(extras, dict):
+        extras = dict((key, [value] if isinstance(value, str) else value)
+                      for key, value in extras.items())
+    if not (isinstance(extras, dict) and
+            all(is_string_list(value) for value in extras.values())):
+        sys.stderr.write("ets_depends: ignoring extras_require of %s, "
+                         "which is not a dict of lists of strings\n"
+                         % pkg_dir)
+        extras = {}
+    return {
+        'name': str(info.get('name', os.path.basename(pkg_dir))),
+        'version': str(info.get('version', '')),
+        'install_requires': [req.strip() for req in requires
+                             if req.strip()],
+        'extras_require': dict((str(key), list(value))
+                               for key, value in extras.items()),
+    }
+
+
+def file_signature(path, digest=False):
+    """Return the modification time and size of the file at *path*, and its
+    SHA-256 hash if *digest* is set.
+    """
+    stat = os.stat(path)
+    signature = {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+    if digest:
+        with open(path, 'rb') as fp:
+            signature['sha256'] = hashlib.sha256(fp.read()).hexdigest()
+    return signature
+
+
+def load_cache():
+    """Return the cached metadata, or an empty cache."""
     try:
-        execfile(os.path.join(pkg_name,'setup_data.py'), setup_data)
-        INFO = setup_data['INFO']
-        print '%s %s' % (INFO['name'], INFO['version'])
-        print INDENT + 'ETS installation dependencies:'
-        for item in INFO['install_requires']:
-            print INDENT*2 + str(item)
-        if 'extras_require' not in INFO:
+        with open(cache_file) as fp:
+            cache = json.load(fp)
+    except (IOError, ValueError):
+        return {}
+    if cache.get('version') != cache_version:
+        return {}
+    return cache.get('packages', {})
+
+
+def save_cache(packages):
+    """Write the cached metadata."""
+    with open(cache_file + '.tmp', 'w') as fp:
+        json.dump({'version': cache_version, 'packages': packages}, fp,
+                  indent=1, sort_keys=True)
+    os.replace(cache_file + '.tmp', cache_file)
+
+
+def cached_extract(pkg_dir, entry):
+    """Return the package's metadata and its new cache entry, reusing the
+    metadata in the old cache *entry* if the package's setup files are
+    unchanged. A file whose modification time or size has changed is
+    checked by its content hash before the package is read again.
+    """
+    paths = [name for name in setup_files
+             if os.path.isfile(os.path.join(pkg_dir, name))]
+    files = (entry or {}).get('files', {})
+    signatures = {}
+    for name in paths:
+        path = os.path.join(pkg_dir, name)
+        signature = file_signature(path)
+        old = files.get(name)
+        if old is not None and old['mtime'] == signature['mtime'] and \
+                old['size'] == signature['size']:
+            signature['sha256'] = old['sha256']
+        else:
+            signature = file_signature(path, digest=True)
+        signatures[name] = signature
+
+    if entry is not None and set(files) == set(signatures) and all(
+            files[name]['sha256'] == signatures[name]['sha256']
+            for name in signatures):
+        info = entry['info']
+    else:
+        info = extract(pkg_dir)
+    return info, {'files': signatures, 'info': info}
+
+
+def read_packages(packages, root='.', use_cache=True):
+    """Return a dict mapping each of the *packages* in directory *root* to
+    its metadata, or to None if the package has no setup files.
+    """
+    cache = load_cache() if use_cache else {}
+    results = {}
+    changed = False
+    for pkg_name in packages:
+        pkg_dir = os.path.join(root, pkg_name)
+        key = os.path.abspath(pkg_dir)
+        info, entry = cached_extract(pkg_dir, cache.get(key))
+        if entry != cache.get(key):
+            cache[key] = entry
+            changed = True
+        results[pkg_name] = info
+    if use_cache and changed:
+        save_cache(cache)
+    return results
+
+
+def dependency_graph(metadata):
+    """Return a dict mapping each package in *metadata*, as returned by
+    read_packages, to the sorted names of the other packages among them
+    which it requires to be installed.
+    """
+    by_name = {}
+    for pkg_name, info in metadata.items():
+        by_name[requirement_name(pkg_name)] = pkg_name
+        if info is not None:
+            by_name[requirement_name(info['name'])] = pkg_name
+    graph = {}
+    for pkg_name, info in metadata.items():
+        if info is None:
             continue
-        print INDENT + 'Other dependencies:'
-        for (key,value) in INFO['extras_require'].items():
-            if value:
-                print '%s%s' % ( INDENT*2, key)
-                try:
-                    for sub_item in value:
-                        print INDENT*3,sub_item
-                except TypeError:
-                    print INDENT*3,value
-    except (IOError,), ermsg:
-        print pkg_name
-        print INDENT + str(ermsg)
+        deps = set()
+        for requirement in info['install_requires']:
+            dep = by_name.get(requirement_name(requirement))
+            if dep is not None and dep != pkg_name:
+                deps.add(dep)
+        graph[pkg_name] = sorted(deps)
+    return graph
+
+
+def to_dot(graph):
+    """Return the dependency *graph* in Graphviz DOT format, with an edge from
+    each package to each of its dependencies.
+    """
+    lines = ['digraph ets {']
+    for pkg_name in graph:
+        lines.append('    "%s";' % pkg_name)
+    for pkg_name, deps in graph.items():
+        for dep in deps:
+            lines.append('    "%s" -> "%s";' % (pkg_name, dep))
+    lines.append('}')
+    return '\n'.join(lines)
+
+
+def to_text(metadata):
+    """Return the metadata as text, in the format of ets_depends.log."""
+    lines = []
+    for pkg_name, info in metadata.items():
+        if info is None:
+            lines.append(pkg_name)
+            lines.append(INDENT + 'No setup files found')
+            continue
+        lines.append('%s %s' % (info['name'], info['version']))
+        lines.append(INDENT + 'ETS installation dependencies:')
+        for item in info['install_requires']:
+            lines.append(INDENT * 2 + item)
+        extras = dict((key, value)
+                      for key, value in info['extras_require'].items()
+                      if value)
+        if extras:
+            lines.append(INDENT + 'Other dependencies:')
+            for key, value in extras.items():
+                lines.append(INDENT * 2 + key)
+                for sub_item in value:
+                    lines.append(INDENT * 3 + sub_item)
+    return '\n'.join(lines)
+
+
+def main():
+    args = sys.argv[1:]
+    if '-h' in args or '--help' in args:
+        print(usage)
+        return 0
+    output_format = 'text'
+    use_cache = True
+    packages = []
+    for arg in args:
+        if arg in ('--json', '--dot'):
+            output_format = arg[2:]
+        elif arg == '--no-cache':
+            use_cache = False
+        elif arg.startswith('-'):
+            print("ets_depends: unknown option %r" % arg)
+            print(usage)
+            return 2
+        else:
+            packages.append(arg)
+    if not packages:
+        from ets import ets_package_names
+        packages = ets_package_names.split()
+
+    metadata = read_packages(packages, use_cache=use_cache)
+    graph = dependency_graph(metadata)
+    if output_format == 'json':
+        print(json.dumps({
+            'packages': dict(
+                (pkg_name, dict(info, dependencies=graph[pkg_name]))
+                for pkg_name, info in metadata.items() if info is not None),
+            'missing': [pkg_name for pkg_name, info in metadata.items()
+                        if info is None],
+        }, indent=2))
+    elif output_format == 'dot':
+        print(to_dot(graph))
+    else:
+        print(to_text(metadata))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,19 +4,78 @@ Performs documentation building, check in, updating, etc of all actively
 maintained ETS packages.
 """
 
+import functools
+import hashlib
 import sys
 import os
+import shutil
 import subprocess
-from distutils.dir_util import copy_tree
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ets import (DependencyGraph, default_options, ets_options, make_output,
+                 parse_options, report, run_tasks, select_packages)
 
 usage = """\
-Usage: ets_docs -h | --help | update [PROJ] | COMMAND [args] | ALIAS [args]
+Usage: ets_docs -h | --help | [options] update [PROJ ...]
+       | [options] COMMAND [args] | [options] ALIAS [args]
    -h, --help  Print this message.
 
+   Options, which must precede the command:
+   -j N, --jobs N
+               Use a budget of N concurrent jobs, split between building
+               several packages at once and Sphinx's own parallel reading
+               (-j) within each package. The output of each package is
+               buffered and printed as one block.
+   --sphinx-jobs N
+               Give each package N of the jobs, and so build up to
+               (jobs / N) packages at once. By default, as many packages as
+               possible are built at once, and any jobs left over are shared
+               between them.
+   -C DIR, --root DIR
+               Run in the workspace DIR instead of the current directory.
+   --only PKG[,PKG...]
+               Process only the named packages.
+   --metrics FILE
+               Append the wall time, CPU time, peak memory and exit status of
+               the build of each package to FILE, as lines of JSON.
+   --trace FILE
+               Write a Chrome trace of the builds to FILE.
+   --downstream-of PKG[,PKG...]
+               Process only the named packages and the packages which depend
+               on them.
+   --changed-since REF
+               Process only the packages with commits since the git ref REF,
+               and the packages which depend on them.
+   --inventory-dir DIR
+               Keep the intersphinx inventory (objects.inv) of each package
+               built by the html alias in DIR, which defaults to
+               .ets_docs/inventories. Packages are built in dependency order,
+               and intersphinx references to the other ETS packages are
+               resolved against these local inventories before falling back
+               to the remote ones.
+   --cache-dir DIR
+               Keep the docs/build directory of each successful Sphinx build
+               in DIR, keyed by a hash of the package's documentation, Python
+               and configuration files, the build command and the local
+               inventories used. A build whose key is in the cache is
+               restored from it instead of being run. Defaults to
+               $ETS_DOCS_CACHE, or ~/.cache/ets/docs.
+   --cache-size MB
+               Evict the least recently used builds when the cache grows
+               beyond MB megabytes. The default is 2048.
+   --no-cache  Neither use nor update the build cache.
+   --stream, --log-dir DIR, --compress-logs, --keep-going, --fail-fast
+               These options are as for the ets command.
+
    update      This command performs a 'remote update', ie it updates the
-               live website from the repository.  If your remote username
-               is different than your local username, you may specify the
-               remote one here.
+               live website from the built HTML of each package, or of the
+               given packages. The HTML is committed directly onto the
+               gh-pages branch, without checking it out, so the working
+               copy is left alone. Only the files whose content has changed
+               are added, and the branch is then pushed to origin. With
+               -j N, up to N packages are updated concurrently.
 
    COMMAND     Run this shell command, with any following arguments, inside
                each package's documentation sub-directory. If any command
@@ -38,7 +97,8 @@ Usage: ets_docs -h | --help | update [PROJ] | COMMAND [args] | ALIAS [args]
         ets_docs update traits # Updates the gh-pages branch.
 
 
-   The ETS packages referenced, in order of processing, are:\n%s
+   The ETS packages referenced are those of the ets command which have a
+   docs sub-directory, processed in dependency order.
    """
 
 aliases = """\n
@@ -46,113 +106,546 @@ aliases = """\n
       latex    make latex
       """
 
-ets_package_names = """\
-      traits             pyface             traitsui
-      codetools          etsdevtools        scimath
-      enable             apptools           envisage
-      chaco              mayavi             blockcanvas
-      """
+# Options which may precede the command.
+docs_options = dict((name, ets_options[name]) for name in [
+    '-j', '--jobs', '-C', '--root', '--only', '--downstream-of',
+    '--changed-since', '--stream', '--log-dir', '--compress-logs',
+    '--metrics', '--trace', '--keep-going', '--fail-fast'])
+docs_options['--sphinx-jobs'] = ('sphinx_jobs', True)
+docs_options['--inventory-dir'] = ('inventory_dir', True)
+docs_options['--cache-dir'] = ('cache_dir', True)
+docs_options['--cache-size'] = ('cache_size', True)
+docs_options['--no-cache'] = ('cache_dir', False, '')
+
+default_docs_options = dict(
+    default_options, sphinx_jobs=0,
+    inventory_dir=os.path.join('.ets_docs', 'inventories'),
+    cache_dir=os.environ.get('ETS_DOCS_CACHE') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'ets', 'docs'),
+    cache_size=2048)
+
+# The directories, relative to a package, which are left out of the hash of
+# its documentation sources.
+excluded_dirs = ['build', 'dist', os.path.join('docs', 'build')]
+
+# The configuration files which are included in the hash.
+config_files = ['setup.py', 'setup_data.py', 'setup.cfg', 'pyproject.toml']
+
+# Bumped whenever the way the docs are built changes, to invalidate the cache.
+docs_cache_version = 1
+
+# Aliases which run a Sphinx build through make.
+sphinx_aliases = ['html', 'latex']
+
+# The branch which holds the published HTML.
+pages_branch = 'gh-pages'
+
+# The built HTML directories of each package, and where they are published on
+# the gh-pages branch.
+published_html = {
+    'mayavi': [('docs/build/tvtk/html', 'tvtk'),
+               ('docs/build/mayavi/html', 'mayavi')],
+}
+default_published_html = [('docs/build/html', '')]
 
 alias_dict = {}
 for line in aliases.split('\n'):
     tokens = line.split()
     if tokens:
-         alias_dict[tokens[0]] = tokens[1:]
-
-
-def main():
-    if len(sys.argv) < 2 or sys.argv[1].startswith('-'):
-        print usage % (aliases, ets_package_names)
-        return
+        alias_dict[tokens[0]] = tokens[1:]
 
-    arg1 = sys.argv[1]
 
-    # Update the gh-pages branch
-    if arg1 == 'update':
-        if 2 < len(sys.argv):
-            ets_packages = sys.argv[2:]
-        else:
-            ets_packages = ets_package_names.split()
+# The Sphinx configuration wrapper, which runs a package's own conf.py and
+# then points its intersphinx mapping at the local inventories.
+conf_wrapper = """\
+# Generated by ets_docs; do not edit.
+import os
 
-        for ets_pkg_name in ets_packages:
-            print "Updating documentation branch for {0}...".format(ets_pkg_name)
+_conf_file = %(conf_file)r
+_inventories = %(inventories)r
+
+_cwd = os.getcwd()
+os.chdir(os.path.dirname(_conf_file))
+try:
+    __file__ = _conf_file
+    with open(_conf_file, 'rb') as _fp:
+        exec(compile(_fp.read(), _conf_file, 'exec'))
+finally:
+    os.chdir(_cwd)
+
+# Paths in the configuration are relative to the package's own conf.py.
+def _rebase(path):
+    if '://' in path:
+        return path
+    return os.path.join(os.path.dirname(_conf_file), path)
+
+for _name in ('templates_path', 'html_static_path', 'html_extra_path',
+              'html_theme_path', 'locale_dirs', 'latex_additional_files'):
+    if _name in globals():
+        globals()[_name] = [_rebase(_path) for _path in globals()[_name]]
+for _name in ('html_logo', 'html_favicon', 'latex_logo'):
+    if globals().get(_name):
+        globals()[_name] = _rebase(globals()[_name])
+
+for _key, _value in list(globals().get('intersphinx_mapping', {}).items()):
+    if not isinstance(_value, (tuple, list)) or len(_value) != 2:
+        continue
+    _uri, _inv = _value
+    _parts = _uri.rstrip('/').split('/')[3:]
+    for _name, _path in _inventories.items():
+        if _key == _name or _name in _parts[-1:]:
+            intersphinx_mapping[_key] = (_uri, (_path, _inv))
+            break
+"""
 
-            # Find the current branch, so that we may return to it
-            branches = subprocess.check_output(['git', 'branch'], cwd=ets_pkg_name)
-            current_branch = [line.split()[1] for line in branches.splitlines() if line.startswith('*')]
-            current_branch = current_branch[0]
 
-            # Checkout the gh-pages branch
+def docs_packages(options):
+    """Return the DependencyGraph of the selected ETS packages which have a
+    docs sub-directory.
+    """
+    graph = select_packages(options)
+    # Keep the dependencies which pass through packages without docs.
+    return graph.subgraph([
+        ets_pkg_name for ets_pkg_name in graph.order()
+        if os.path.isdir(os.path.join(ets_pkg_name, 'docs'))])
+
+
+def inventory_names(ets_pkg_name):
+    """Yield the name and path of each intersphinx inventory built by the
+    package's html alias.
+    """
+    for source, prefix in published_html.get(ets_pkg_name,
+                                             default_published_html):
+        yield (prefix or ets_pkg_name,
+               os.path.join(ets_pkg_name, source, 'objects.inv'))
+
+
+def save_inventories(ets_pkg_name, inventory_dir):
+    """Copy the package's freshly built inventories into *inventory_dir*."""
+    for name, path in inventory_names(ets_pkg_name):
+        if os.path.isfile(path):
+            target = os.path.join(inventory_dir, name)
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            shutil.copyfile(path, os.path.join(target, 'objects.inv'))
+
+
+def local_inventories(upstream, inventory_dir):
+    """Return a dict mapping the name of each inventory of the *upstream*
+    packages found in *inventory_dir* to its absolute path.
+    """
+    inventories = {}
+    for ets_pkg_name in upstream:
+        for name, _ in inventory_names(ets_pkg_name):
+            path = os.path.join(inventory_dir, name, 'objects.inv')
+            if os.path.isfile(path):
+                inventories[name] = os.path.abspath(path)
+    return inventories
+
+
+def write_conf_wrapper(ets_pkg_name, inventory_dir, inventories):
+    """Write the Sphinx configuration wrapper which maps the package's
+    intersphinx references to the local *inventories*, and return its
+    directory. Returns None, so that the package's own configuration is
+    used as it is, if there are no local inventories or the package has no
+    docs/source/conf.py.
+    """
+    conf_file = os.path.join(ets_pkg_name, 'docs', 'source', 'conf.py')
+    if not inventories or not os.path.isfile(conf_file):
+        return None
+    conf_dir = os.path.abspath(os.path.join(inventory_dir, os.pardir, 'conf',
+                                            ets_pkg_name))
+    os.makedirs(conf_dir, exist_ok=True)
+    with open(os.path.join(conf_dir, 'conf.py'), 'w') as fp:
+        fp.write(conf_wrapper % {'conf_file': os.path.abspath(conf_file),
+                                 'inventories': inventories})
+    return conf_dir
+
+
+def is_source_file(rel_path):
+    """Return True if the file at *rel_path* within a package can affect
+    the package's documentation.
+    """
+    return (rel_path.startswith('docs' + os.sep) or
+            rel_path.endswith('.py') or
+            os.path.basename(rel_path) in config_files)
+
+
+def source_hash(ets_pkg_name, cmd, inventories):
+    """Return the hash identifying a Sphinx build of the package by *cmd*:
+    the content of its documentation, Python and configuration files, and
+    of the local *inventories* it is built against.
+    """
+    digest = hashlib.sha256(repr((docs_cache_version, cmd)).encode())
+    for dirpath, dirnames, filenames in os.walk(ets_pkg_name):
+        rel_dir = os.path.relpath(dirpath, ets_pkg_name)
+        dirnames[:] = sorted(
+            name for name in dirnames
+            if os.path.normpath(os.path.join(rel_dir, name))
+            not in excluded_dirs and name not in ('.git', '__pycache__')
+            and not name.endswith('.egg-info'))
+        for filename in sorted(filenames):
+            rel_path = os.path.normpath(os.path.join(rel_dir, filename))
+            if is_source_file(rel_path):
+                with open(os.path.join(dirpath, filename), 'rb') as fp:
+                    content = hashlib.sha256(fp.read()).digest()
+                digest.update(rel_path.replace(os.sep, '/').encode() + b'\0')
+                digest.update(content)
+    for name, path in sorted(inventories.items()):
+        with open(path, 'rb') as fp:
+            digest.update(name.encode() + b'\0' + fp.read())
+    return digest.hexdigest()
+
+
+def restore_build(ets_pkg_name, cache_dir, key):
+    """Restore the package's docs/build directory from the cache entry
+    *key*, if there is one, and mark the entry as recently used. Returns
+    True on a cache hit.
+    """
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(os.path.join(entry, 'build')):
+        return False
+    try:
+        os.utime(entry)
+        shutil.copytree(os.path.join(entry, 'build'),
+                        os.path.join(ets_pkg_name, 'docs', 'build'),
+                        dirs_exist_ok=True)
+    except OSError:
+        # The entry was evicted meanwhile, or cannot be read: build anyway.
+        return False
+    return True
+
+
+def store_build(ets_pkg_name, cache_dir, key, cache_size):
+    """Copy the package's docs/build directory into the cache entry *key*,
+    then evict the least recently used entries until the cache holds at
+    most *cache_size* megabytes. Raises OSError if the entry cannot be
+    written.
+    """
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        return
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+    try:
+        shutil.copytree(os.path.join(ets_pkg_name, 'docs', 'build'),
+                        os.path.join(tmp, 'build'), symlinks=True)
+        size = sum(os.path.getsize(os.path.join(dirpath, filename))
+                   for dirpath, _, filenames in os.walk(tmp)
+                   for filename in filenames)
+        with open(os.path.join(tmp, 'size'), 'w') as fp:
+            fp.write(str(size))
+        os.rename(tmp, entry)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    evict(cache_dir, cache_size)
+
+
+def evict(cache_dir, cache_size):
+    """Remove the least recently used entries from the cache until it holds
+    at most *cache_size* megabytes.
+    """
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        try:
+            with open(os.path.join(entry, 'size')) as fp:
+                size = int(fp.read())
+            entries.append((os.path.getmtime(entry), size, entry))
+        except (IOError, OSError, ValueError):
+            continue
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    while entries and total > cache_size * 1024 * 1024:
+        _, size, entry = entries.pop(0)
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+class SphinxBuilds(object):
+    """ Prepares the Sphinx build of each package when it is started, once
+    its dependencies have been built, and saves the build's inventories and
+    cache entry when it succeeds. The cache entries are written one at a
+    time in the background, until close() is called.
+    """
+
+    def __init__(self, cmd, sphinx_opts, graph, options, output):
+        self.cmd = cmd
+        self.sphinx_opts = sphinx_opts
+        self.graph = graph
+        self.options = options
+        self.output = output
+        self.keys = {}
+        self.stores = ThreadPoolExecutor(max_workers=1)
+
+    def task(self, ets_pkg_name):
+        """ Return the (cmd, cwd) pair which builds the package's docs, or
+        its result dict if the build was restored from the cache. If the
+        cache or the local inventories cannot be used, the package is built
+        without them.
+        """
+        start = time.time()
+        inventory_dir = self.options['inventory_dir']
+        upstream = [name for name in self.graph.order()
+                    if name in self.graph.upstream([ets_pkg_name])
+                    and name != ets_pkg_name]
+        inventories = local_inventories(upstream, inventory_dir)
+        if self.options['cache_dir']:
             try:
-                subprocess.check_call(['git', 'checkout', 'gh-pages'], cwd=ets_pkg_name)
-            except (OSError, subprocess.CalledProcessError), detail:
-                print "   Error running command in package %s:\n   %s" % (ets_pkg_name, detail)
-                raw_input("   Press enter to process remaining packages.")
-                continue
-
-            # Copy the files over
-            print "Copying files for {0}".format(ets_pkg_name)
-            if ets_pkg_name == 'mayavi':
-                copy_tree(ets_pkg_name + '/docs/build/tvtk/html/',   ets_pkg_name + '/tvtk/')
-                copy_tree(ets_pkg_name + '/docs/build/mayavi/html/', ets_pkg_name + '/mayavi/')
-            else:
-                copy_tree(ets_pkg_name + '/docs/build/html/', ets_pkg_name)
-
-            # Add everything to the repository
+                key = source_hash(ets_pkg_name, self.cmd, inventories)
+                if restore_build(ets_pkg_name, self.options['cache_dir'],
+                                 key):
+                    return {'status': 'cached', 'detail': key[:12],
+                            'seconds': time.time() - start}
+                self.keys[ets_pkg_name] = key
+            except OSError as detail:
+                self.output.message("   Warning: cannot use the docs cache "
+                                    "for package %s: %s"
+                                    % (ets_pkg_name, detail))
+
+        sphinx_opts = list(self.sphinx_opts)
+        try:
+            conf_dir = write_conf_wrapper(ets_pkg_name, inventory_dir,
+                                          inventories)
+        except OSError as detail:
+            self.output.message("   Warning: cannot use the local "
+                                "inventories for package %s: %s"
+                                % (ets_pkg_name, detail))
+            conf_dir = None
+        if conf_dir is not None:
+            sphinx_opts.append('-c ' + conf_dir)
+        return (sphinx_command(self.cmd, sphinx_opts),
+                os.path.join(ets_pkg_name, 'docs'))
+
+    def finished(self, ets_pkg_name, result):
+        """ Save the inventories and cache entry of a successful build. """
+        if result['status'] not in ('ok', 'cached'):
+            return
+        if self.cmd[:2] == ['make', 'html']:
+            save_inventories(ets_pkg_name, self.options['inventory_dir'])
+        if ets_pkg_name in self.keys:
+            self.stores.submit(self.store, ets_pkg_name,
+                               self.keys[ets_pkg_name])
+
+    def store(self, ets_pkg_name, key):
+        """ Add the package's build to the cache. The cache only saves
+        time, so a build which cannot be stored is reported and skipped.
+        """
+        try:
+            store_build(ets_pkg_name, self.options['cache_dir'], key,
+                        self.options['cache_size'])
+        except OSError as detail:
+            self.output.message("   Warning: cannot cache the docs build of "
+                                "package %s: %s" % (ets_pkg_name, detail))
+
+    def close(self):
+        """ Wait for the cache entries still being written. """
+        self.stores.shutdown()
+
+
+def split_jobs(jobs, sphinx_jobs, n_packages):
+    """Split a budget of *jobs* between the number of packages to build at
+    once and the number of Sphinx jobs within each package, for a build of
+    *n_packages*. Returns the pair of numbers.
+    """
+    if sphinx_jobs > 0:
+        return max(1, jobs // sphinx_jobs), sphinx_jobs
+    package_jobs = max(1, min(jobs, n_packages))
+    return package_jobs, max(1, jobs // package_jobs)
+
+
+def sphinx_command(cmd, sphinx_opts):
+    """Return the make *cmd*, with the list of *sphinx_opts* added to its
+    SPHINXOPTS.
+    """
+    if not sphinx_opts or cmd[0] != 'make':
+        return cmd
+    sphinx_opts = ' '.join(sphinx_opts)
+    for i, arg in enumerate(cmd):
+        if arg.startswith('SPHINXOPTS='):
+            return cmd[:i] + ['%s %s' % (arg, sphinx_opts)] + cmd[i + 1:]
+    return cmd + ['SPHINXOPTS=' + sphinx_opts]
+
+
+def git(ets_pkg_name, args, input=None, env=None):
+    """Run a git command in the package and return its stripped output."""
+    return subprocess.check_output(
+        ['git'] + args, cwd=ets_pkg_name, input=input, env=env,
+        stderr=subprocess.PIPE, universal_newlines=True).strip()
+
+
+def blob_hash(data):
+    """Return the git blob hash of the bytes *data*."""
+    header = ('blob %d\0' % len(data)).encode()
+    return hashlib.sha1(header + data).hexdigest()
+
+
+def html_files(ets_pkg_name):
+    """Yield the (path, mode, blob hash) of each file of the package's built
+    HTML, where path is the file's path on the gh-pages branch and the
+    source file on disk.
+    """
+    for source, prefix in published_html.get(ets_pkg_name,
+                                             default_published_html):
+        source_dir = os.path.join(ets_pkg_name, source)
+        if not os.path.isdir(source_dir):
+            raise ValueError("no built HTML in %s" % source_dir)
+        for dirpath, dirnames, filenames in os.walk(source_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                rel_path = os.path.relpath(path, source_dir)
+                if prefix:
+                    rel_path = os.path.join(prefix, rel_path)
+                with open(path, 'rb') as fp:
+                    sha = blob_hash(fp.read())
+                mode = '100755' if os.access(path, os.X_OK) else '100644'
+                yield rel_path.replace(os.sep, '/'), path, mode, sha
+
+
+def publish_docs(ets_pkg_name, output):
+    """Commit the package's built HTML onto its gh-pages branch, without
+    checking the branch out, and push it. Only the files whose content has
+    changed are written to the object store. Returns the ets result dict.
+    """
+    start = time.time()
+    try:
+        parent = ''
+        for ref in ('refs/heads/' + pages_branch,
+                    'refs/remotes/origin/' + pages_branch):
             try:
-                subprocess.check_call(['git', 'add', '.'], cwd=ets_pkg_name)
-            except (OSError, subprocess.CalledProcessError), detail:
-                print "   Error running command in package %s:\n   %s" % (ets_pkg_name, detail)
-                raw_input("   Press enter to process remaining packages.")
-                continue
+                parent = git(ets_pkg_name, ['rev-parse', '--verify',
+                                            ref + '^{commit}'])
+                break
+            except subprocess.CalledProcessError:
+                pass
+        if not parent:
+            raise ValueError("no %s branch" % pages_branch)
+        local_parent = git(ets_pkg_name, ['for-each-ref',
+                                          '--format=%(objectname)',
+                                          'refs/heads/' + pages_branch])
+
+        existing = {}
+        for line in git(ets_pkg_name, ['ls-tree', '-r', '-z', parent]
+                        ).split('\0'):
+            if line:
+                info, path = line.split('\t', 1)
+                mode, _, sha = info.split()
+                existing[path] = (mode, sha)
+
+        changed = [(path, source, mode, sha)
+                   for path, source, mode, sha in html_files(ets_pkg_name)
+                   if existing.get(path) != (mode, sha)]
+        if changed:
+            # The HTML is published as built, without the eol or other
+            # filters which the package's attributes apply to its sources.
+            written = git(ets_pkg_name, ['hash-object', '-w', '--no-filters',
+                                         '--stdin-paths'],
+                          input=''.join(os.path.abspath(source) + '\n'
+                                        for _, source, _, _ in changed))
+            if written.split() != [sha for _, _, _, sha in changed]:
+                raise ValueError("unexpected blob hashes from git")
+            with tempfile.TemporaryDirectory() as tmp:
+                env = dict(os.environ,
+                           GIT_INDEX_FILE=os.path.join(tmp, 'index'))
+                git(ets_pkg_name, ['read-tree', parent], env=env)
+                git(ets_pkg_name, ['update-index', '-z', '--index-info'],
+                    input=''.join('%s %s\t%s\0' % (mode, sha, path)
+                                  for path, _, mode, sha in changed),
+                    env=env)
+                tree = git(ets_pkg_name, ['write-tree'], env=env)
+            commit = git(ets_pkg_name, ['commit-tree', tree, '-p', parent,
+                                        '-m', 'Updated docs.'])
+            git(ets_pkg_name, ['update-ref', 'refs/heads/' + pages_branch,
+                               commit, local_parent or '0' * 40])
+            output.message("Committed %d changed files to %s in package %s"
+                           % (len(changed), pages_branch, ets_pkg_name))
+        else:
+            output.message("Documentation of package %s is unchanged"
+                           % ets_pkg_name)
+        git(ets_pkg_name, ['push', 'origin', 'refs/heads/%s:refs/heads/%s'
+                           % (pages_branch, pages_branch)])
+        result = {'status': 'ok', 'returncode': 0,
+                  'detail': '%d files changed' % len(changed)}
+    except (OSError, ValueError, subprocess.CalledProcessError) as detail:
+        message = (getattr(detail, 'stderr', None) or str(detail)).strip()
+        output.message("   Error updating documentation in package %s:\n   %s"
+                       % (ets_pkg_name, message))
+        result = {'status': 'failed', 'returncode': None,
+                  'detail': message.splitlines()[-1] if message else ''}
+    result['seconds'] = time.time() - start
+    return result
 
-            # Commit to the repo.
-            try:
-                subprocess.check_call(['git', 'commit', '-a', '-m', '"Updated docs."'], cwd=ets_pkg_name)
-            except (OSError, subprocess.CalledProcessError), detail:
-                print "   Error running command in package %s:\n   %s" % (ets_pkg_name, detail)
-                raw_input("   Press enter to process remaining packages.")
-                continue
 
-            # Push these changes.
-            try:
-                subprocess.check_call(['git', 'push'], cwd=ets_pkg_name)
-            except (OSError, subprocess.CalledProcessError), detail:
-                print "   Error running command in package %s:\n   %s" % (ets_pkg_name, detail)
-                raw_input("   Press enter to process remaining packages.")
-                continue
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        print(usage % aliases)
+        return
 
-            # Return to the current branch
-            try:
-                subprocess.check_call(['git', 'checkout', current_branch], cwd=ets_pkg_name)
-            except (OSError, subprocess.CalledProcessError), detail:
-                print "   Error running command in package %s:\n   %s" % (ets_pkg_name, detail)
-                raw_input("   Press enter to process remaining packages.")
-                continue
+    try:
+        options, args = parse_options(sys.argv[1:], docs_options,
+                                      default_docs_options)
+        if options['jobs'] < 1:
+            raise ValueError("option -j requires a positive integer")
+        if not args:
+            raise ValueError("no command given")
+        if options['root']:
+            os.chdir(options['root'])
+        graph = docs_packages(options)
+        ets_packages = graph.order()
+    except (OSError, ValueError) as detail:
+        print("ets_docs: %s" % detail)
+        return 2
+
+    arg1 = args[0]
 
-            print
+    # Update the gh-pages branch
+    if arg1 == 'update':
+        if 1 < len(args):
+            ets_packages = args[1:]
 
-        return
+        output = make_output(options)
+        with ThreadPoolExecutor(max_workers=options['jobs']) as executor:
+            results = dict(zip(ets_packages, executor.map(
+                lambda ets_pkg_name: publish_docs(ets_pkg_name, output),
+                ets_packages)))
+        return report(results, ets_packages)
 
     # Determine command from either alias or command line
     if arg1 in alias_dict:
-        cmd = alias_dict[arg1] + sys.argv[2:]
+        cmd = alias_dict[arg1] + args[1:]
         if cmd[0] == 'python':
             cmd[0] = sys.executable
     else:
-        cmd = sys.argv[1:]
-
-    # Run the command in each project directory
-    for ets_pkg_name in ets_package_names.split():
-        print "Running command %r in package %s" % (' '.join(cmd), ets_pkg_name)
-
-        try:
-            subprocess.check_call(cmd, cwd=ets_pkg_name + '/docs/')
-            print
-        except (OSError, subprocess.CalledProcessError), detail:
-            print "   Error running command in package %s:\n   %s" % (ets_pkg_name, detail)
-            raw_input("   Press enter to process remaining packages.")
+        cmd = args
+
+    # Run the command in each project directory. Sphinx builds are run in
+    # dependency order, each with its own Sphinx options.
+    package_jobs, sphinx_jobs = split_jobs(
+        options['jobs'], options['sphinx_jobs'], len(ets_packages))
+    options['jobs'] = package_jobs
+    sphinx_opts = ['-j %d' % sphinx_jobs] if sphinx_jobs > 1 else []
+    tasks = dict((ets_pkg_name, (sphinx_command(cmd, sphinx_opts),
+                                 os.path.join(ets_pkg_name, 'docs')))
+                 for ets_pkg_name in ets_packages)
+    output = make_output(options)
+    if arg1 not in sphinx_aliases:
+        results = run_tasks(tasks, DependencyGraph({}, ets_packages), output,
+                            package_jobs, options['fail_fast'])
+        return report(results, ets_packages)
+
+    builds = SphinxBuilds(cmd, sphinx_opts, graph, options, output)
+    for ets_pkg_name in ets_packages:
+        tasks[ets_pkg_name] = functools.partial(builds.task, ets_pkg_name)
+    try:
+        results = run_tasks(tasks, graph, output, package_jobs,
+                            options['fail_fast'], builds.finished)
+    finally:
+        builds.close()
+    return report(results, ets_packages)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
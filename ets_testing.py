@@ -0,0 +1,365 @@
+#! /usr/bin/env python
+"""Runs the test suites of all actively maintained ETS packages, as the
+'ets test' command. Each package's tests are discovered with unittest and run
+in a pool of worker processes, with large suites optionally split into
+several shards. The shards are started longest first, according to the
+durations recorded by earlier runs, and their results are collected into a
+single JUnit XML report.
+
+Run as a script, this module is the worker which runs one shard of the tests
+of the package in the current directory.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+import xml.etree.ElementTree as ElementTree
+
+from ets import (DependencyGraph, make_output, parse_options, report,
+                 run_tasks, select_packages)
+
+# The file recording how long the tests of each package took, per test class.
+history_file = '.ets_test_durations.json'
+
+# Options which may follow the test command.
+test_options = {
+    '--shards': ('shards', True),
+    '--pattern': ('pattern', True),
+    '--junit-xml': ('junit_xml', True),
+}
+
+default_test_options = {
+    'shards': '',
+    'pattern': 'test*.py',
+    'junit_xml': 'ets_tests.xml',
+}
+
+# Options of the worker which runs one shard.
+shard_options = {
+    '--package': ('package', True),
+    '--shard': ('shard', True),
+    '--pattern': ('pattern', True),
+    '--history': ('history', True),
+    '--junit-xml': ('junit_xml', True),
+}
+
+default_shard_options = {
+    'package': '',
+    'shard': '1/1',
+    'pattern': 'test*.py',
+    'history': '',
+    'junit_xml': '',
+}
+
+
+class JUnitResult(unittest.TextTestResult):
+    """ A test result which also records the outcome and run time of each
+    test, for the JUnit XML report.
+    """
+
+    def __init__(self, *args, **kwargs):
+        unittest.TextTestResult.__init__(self, *args, **kwargs)
+        self.records = []
+        self._started = {}
+
+    def startTest(self, test):
+        self._started[test] = time.time()
+        unittest.TextTestResult.startTest(self, test)
+
+    def _record(self, test, outcome, message=''):
+        seconds = time.time() - self._started.pop(test, time.time())
+        test_id = test.id()
+        classname, _, name = test_id.rpartition('.')
+        self.records.append({'classname': classname, 'name': name,
+                             'time': seconds, 'outcome': outcome,
+                             'message': message})
+
+    def addSuccess(self, test):
+        unittest.TextTestResult.addSuccess(self, test)
+        self._record(test, 'passed')
+
+    def addFailure(self, test, err):
+        unittest.TextTestResult.addFailure(self, test, err)
+        self._record(test, 'failure', self.failures[-1][1])
+
+    def addError(self, test, err):
+        unittest.TextTestResult.addError(self, test, err)
+        self._record(test, 'error', self.errors[-1][1])
+
+    def addSkip(self, test, reason):
+        unittest.TextTestResult.addSkip(self, test, reason)
+        self._record(test, 'skipped', reason)
+
+    def addExpectedFailure(self, test, err):
+        unittest.TextTestResult.addExpectedFailure(self, test, err)
+        self._record(test, 'passed')
+
+    def addUnexpectedSuccess(self, test):
+        unittest.TextTestResult.addUnexpectedSuccess(self, test)
+        self._record(test, 'failure', 'unexpected success')
+
+
+def test_units(suite):
+    """Return a dict mapping the name of each test class in *suite* to a
+    suite of its tests. The tests of a class are always run together, so
+    that its class fixtures are set up only once.
+    """
+    units = {}
+    todo = [suite]
+    while todo:
+        test = todo.pop(0)
+        if isinstance(test, unittest.TestSuite):
+            todo[:0] = list(test)
+        else:
+            classname = test.id().rpartition('.')[0]
+            units.setdefault(classname, unittest.TestSuite()).addTest(test)
+    return units
+
+
+def shard_suite(suite, index, count, durations):
+    """Return the tests of *suite* in shard *index* (counting from 1) of
+    *count*. The test classes are dealt longest first, by their recorded
+    *durations*, to the shard with the least work so far. Classes with no
+    recorded duration are counted as taking the average time.
+    """
+    units = test_units(suite)
+    known = [durations[name] for name in units if name in durations]
+    default = sum(known) / len(known) if known else 1.0
+    weights = dict((name, durations.get(name, default)) for name in units)
+    loads = [0.0] * count
+    shard = unittest.TestSuite()
+    for name in sorted(units, key=lambda name: (-weights[name], name)):
+        target = loads.index(min(loads))
+        loads[target] += weights[name]
+        if target == index - 1:
+            shard.addTest(units[name])
+    return shard
+
+
+def junit_testcase(record):
+    """Return the JUnit XML element of a test *record*."""
+    element = ElementTree.Element('testcase', {
+        'classname': record['classname'], 'name': record['name'],
+        'time': '%.3f' % record['time']})
+    if record['outcome'] != 'passed':
+        child = ElementTree.SubElement(element, record['outcome'], {
+            'message': (record['message'].strip().splitlines() or [''])[-1]})
+        if record['outcome'] != 'skipped':
+            child.text = record['message']
+    return element
+
+
+def junit_testsuite(name, testcases):
+    """Return a JUnit XML testsuite element named *name*, holding the
+    *testcases* elements, with its totals filled in.
+    """
+    suite = ElementTree.Element('testsuite', {'name': name})
+    suite.extend(testcases)
+    totals = dict((outcome, 0) for outcome in ('failure', 'error', 'skipped'))
+    seconds = 0.0
+    for testcase in testcases:
+        seconds += float(testcase.get('time', 0))
+        for child in testcase:
+            totals[child.tag] += 1
+    suite.set('tests', str(len(testcases)))
+    suite.set('failures', str(totals['failure']))
+    suite.set('errors', str(totals['error']))
+    suite.set('skipped', str(totals['skipped']))
+    suite.set('time', '%.3f' % seconds)
+    return suite
+
+
+def run_shard(args):
+    """Run one shard of the tests of the package in the current directory,
+    as given by the shard options in *args*, and write its results to a
+    JUnit XML file. Returns the exit status.
+    """
+    opts, extra = parse_options(args, shard_options, default_shard_options)
+    index, count = [int(part) for part in opts['shard'].split('/')]
+    durations = {}
+    if opts['history']:
+        durations = load_history(opts['history']).get(opts['package'], {})
+
+    suite = unittest.TestLoader().discover('.', opts['pattern'], '.')
+    if count > 1:
+        suite = shard_suite(suite, index, count, durations)
+    runner = unittest.TextTestRunner(resultclass=JUnitResult, verbosity=1)
+    result = runner.run(suite)
+
+    if opts['junit_xml']:
+        testsuite = junit_testsuite(
+            opts['package'],
+            [junit_testcase(record) for record in result.records])
+        ElementTree.ElementTree(testsuite).write(
+            opts['junit_xml'], encoding='utf-8', xml_declaration=True)
+    return 0 if result.wasSuccessful() else 1
+
+
+def load_history(path=history_file):
+    """Return the recorded test durations, a dict mapping each package to
+    a dict of the run time of each of its test classes.
+    """
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_history(history, path=history_file):
+    """Write the recorded test durations."""
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(history, fp, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def parse_shards(value):
+    """Return a dict mapping package names to numbers of shards, from
+    *value*, a comma separated list of PKG=N items. Raises ValueError for a
+    malformed item.
+    """
+    shards = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        name, _, count = item.partition('=')
+        try:
+            shards[name.strip()] = int(count)
+        except ValueError:
+            raise ValueError("malformed shard count %r" % item)
+        if shards[name.strip()] < 1:
+            raise ValueError("malformed shard count %r" % item)
+    return shards
+
+
+class TestRuns(object):
+    """ The shards of the test runs of each package, for use with
+    run_tasks, and the collection of their results.
+    """
+
+    def __init__(self, packages, shards, test_opts, history, tmp_dir):
+        self.test_opts = test_opts
+        self.history = history
+        self.tmp_dir = tmp_dir
+        self.history_path = os.path.abspath(history_file)
+        # The shards of each package, as (package, index, count) by name.
+        self.shards = {}
+        for ets_pkg_name in packages:
+            count = shards.get(ets_pkg_name, 1)
+            for index in range(1, count + 1):
+                name = ets_pkg_name
+                if count > 1:
+                    name = '%s[%d]' % (ets_pkg_name, index)
+                self.shards[name] = (ets_pkg_name, index, count)
+        self.testcases = dict((name, []) for name in packages)
+        self.collected = set()
+
+    def estimate(self, name):
+        """ Return the expected run time of the shard *name*, or None if
+        its package has no recorded durations.
+        """
+        ets_pkg_name, index, count = self.shards[name]
+        if ets_pkg_name not in self.history:
+            return None
+        return sum(self.history[ets_pkg_name].values()) / count
+
+    def order(self):
+        """ Return the shard names, longest first. Shards whose run time is
+        unknown are started first, since they may be the longest of all.
+        """
+        def key(name):
+            estimate = self.estimate(name)
+            return (estimate is not None, -(estimate or 0))
+        return sorted(self.shards, key=key)
+
+    def junit_path(self, name):
+        return os.path.join(self.tmp_dir, name + '.xml')
+
+    def task(self, name):
+        """ Return the (cmd, cwd) pair which runs the shard *name*."""
+        ets_pkg_name, index, count = self.shards[name]
+        cmd = [sys.executable, os.path.abspath(__file__),
+               '--package', ets_pkg_name, '--shard', '%d/%d' % (index, count),
+               '--pattern', self.test_opts['pattern'],
+               '--history', self.history_path,
+               '--junit-xml', self.junit_path(name)]
+        return cmd, ets_pkg_name
+
+    def finished(self, name, result):
+        """ Collect the test results of the shard *name*, and summarize them
+        in its result dict.
+        """
+        ets_pkg_name = self.shards[name][0]
+        try:
+            testcases = list(ElementTree.parse(self.junit_path(name))
+                             .getroot().iter('testcase'))
+        except (IOError, ElementTree.ParseError):
+            return
+        self.testcases[ets_pkg_name].extend(testcases)
+        self.collected.add(ets_pkg_name)
+        suite = junit_testsuite(name, testcases)
+        result['detail'] = '%s tests, %s failures, %s errors' % (
+            suite.get('tests'), suite.get('failures'), suite.get('errors'))
+
+    def update_history(self):
+        """ Record the durations of the test classes which were run. """
+        for ets_pkg_name in self.collected:
+            durations = {}
+            for testcase in self.testcases[ets_pkg_name]:
+                classname = testcase.get('classname')
+                durations[classname] = (durations.get(classname, 0.0) +
+                                        float(testcase.get('time', 0)))
+            self.history.setdefault(ets_pkg_name, {}).update(durations)
+        save_history(self.history)
+
+    def write_junit(self, path):
+        """ Write the results of every package to the JUnit XML file *path*.
+        """
+        root = ElementTree.Element('testsuites')
+        for ets_pkg_name, testcases in self.testcases.items():
+            root.append(junit_testsuite(ets_pkg_name, testcases))
+        for total in ('tests', 'failures', 'errors', 'skipped'):
+            root.set(total, str(sum(int(suite.get(total))
+                                    for suite in root)))
+        root.set('time', '%.3f' % sum(float(suite.get('time'))
+                                      for suite in root))
+        ElementTree.ElementTree(root).write(path, encoding='utf-8',
+                                            xml_declaration=True)
+        print("Ran %s tests: %s failures, %s errors, %s skipped. "
+              "Results written to %s" % (
+                  root.get('tests'), root.get('failures'),
+                  root.get('errors'), root.get('skipped'), path))
+
+
+def test_packages(options, args):
+    """Run the tests of the packages selected by the ets *options*, with the
+    test options in *args*. Returns the exit status.
+    """
+    try:
+        test_opts, extra = parse_options(args, test_options,
+                                         default_test_options)
+        if extra:
+            raise ValueError("unexpected arguments %s" % ' '.join(extra))
+        shards = parse_shards(test_opts['shards'])
+        packages = select_packages(options).order()
+    except ValueError as detail:
+        print("ets test: %s" % detail)
+        return 2
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        runs = TestRuns(packages, shards, test_opts, load_history(), tmp_dir)
+        names = runs.order()
+        tasks = dict((name, runs.task(name)) for name in names)
+        results = run_tasks(tasks, DependencyGraph({}, names),
+                            make_output(options), options['jobs'],
+                            options['fail_fast'], runs.finished)
+        runs.update_history()
+        runs.write_junit(test_opts['junit_xml'])
+    return report(results, list(runs.shards))
+
+
+if __name__ == "__main__":
+    sys.exit(run_shard(sys.argv[1:]))
@@ -41,10 +41,12 @@ setup(
     license = 'BSD',
     maintainer = 'ETS Developers',
     maintainer_email = 'enthought-dev@enthought.com',
-    py_modules = ["ets", "ets_docs"],
+    py_modules = ["ets", "ets_docs", "ets_depends", "ets_testing",
+                  "ets_daemon"],
     entry_points = dict(console_scripts=[
             "ets = ets:main",
             "ets-docs = ets_docs:main",
+            "ets-depends = ets_depends:main",
     ]),
     platforms = ["Windows", "Linux", "Mac OS-X", "Unix", "Solaris"],
     url = 'http://code.enthought.com/projects/tool-suite.php',
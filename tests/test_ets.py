@@ -0,0 +1,373 @@
+"""Tests of the ets command, run against small local git repositories, so
+that no network access is needed.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ETS = os.path.join(os.path.dirname(HERE), 'ets.py')
+
+
+def git(*args, **kwargs):
+    """Run git with *args*, and return its output."""
+    return subprocess.check_output(
+        ('git', '-c', 'init.defaultBranch=main') + args,
+        universal_newlines=True, stderr=subprocess.STDOUT, **kwargs).strip()
+
+
+def make_repo(path, files={'README.txt': 'readme\n'}):
+    """Create a git repository at *path* with one commit of *files*."""
+    os.makedirs(path)
+    git('init', '-q', path)
+    git('-C', path, 'config', 'user.name', 'ets')
+    git('-C', path, 'config', 'user.email', 'ets@example.com')
+    for name, content in files.items():
+        with open(os.path.join(path, name), 'w') as fp:
+            fp.write(content)
+    git('-C', path, 'add', '.')
+    git('-C', path, 'commit', '-q', '-m', 'Initial commit')
+
+
+def commit_file(path, name, content):
+    """Write *content* to the file *name* of the repository at *path*, and
+    commit it.
+    """
+    with open(os.path.join(path, name), 'w') as fp:
+        fp.write(content)
+    git('-C', path, 'add', name)
+    git('-C', path, 'commit', '-q', '-m', 'Change %s' % name)
+
+
+class EtsTestCase(unittest.TestCase):
+    """ Runs ets in a temporary workspace holding the given packages. """
+
+    packages = ['traits', 'pyface']
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.workspace = os.path.join(self.tmp, 'workspace')
+        os.makedirs(self.workspace)
+
+    def run_ets(self, *args, **kwargs):
+        """Run ets with *args* in the workspace, and return its exit status
+        and output.
+        """
+        env = dict(os.environ, ETS_PACKAGES=' '.join(self.packages))
+        proc = subprocess.run(
+            [sys.executable, ETS] + list(args),
+            cwd=kwargs.get('cwd', self.workspace), env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        return proc.returncode, proc.stdout
+
+
+class TestUsage(EtsTestCase):
+
+    def test_help(self):
+        status, output = self.run_ets('-h')
+        self.assertEqual(status, 0)
+        self.assertIn('Usage: ets', output)
+        self.assertIn('file:///srv/git/%s.git', output)
+        self.assertIn('pyface', output)
+
+    def test_no_arguments(self):
+        status, output = self.run_ets()
+        self.assertEqual(status, 0)
+        self.assertIn('Usage: ets', output)
+
+    def test_unknown_option(self):
+        status, output = self.run_ets('--bogus')
+        self.assertEqual(status, 2)
+        self.assertIn("ets: unknown option '--bogus'", output)
+        self.assertIn('Usage: ets', output)
+
+    def test_jobs_must_be_positive(self):
+        for jobs in ('0', '-1'):
+            status, output = self.run_ets('-j', jobs, 'fetch')
+            self.assertEqual(status, 2)
+            self.assertIn('ets: option -j requires a positive integer',
+                          output)
+            self.assertNotIn('Traceback', output)
+
+
+class TestClone(EtsTestCase):
+
+    def setUp(self):
+        EtsTestCase.setUp(self)
+        self.upstream = os.path.join(self.tmp, 'upstream')
+        for ets_pkg_name in self.packages:
+            make_repo(os.path.join(self.upstream, ets_pkg_name + '.git'))
+        self.url = 'file://' + self.upstream + '/%s.git'
+        self.mirror_dir = os.path.join(self.tmp, 'mirrors')
+
+    def test_clone(self):
+        status, output = self.run_ets('clone', '--url', self.url)
+        self.assertEqual(status, 0, output)
+        for ets_pkg_name in self.packages:
+            self.assertTrue(os.path.isfile(os.path.join(
+                self.workspace, ets_pkg_name, 'README.txt')))
+
+    def test_clone_from_mirror(self):
+        status, output = self.run_ets('mirror', '--url', self.url,
+                                      '--mirror-dir', self.mirror_dir)
+        self.assertEqual(status, 0, output)
+        status, output = self.run_ets('clone', '--url', self.url,
+                                      '--mirror-dir', self.mirror_dir)
+        self.assertEqual(status, 0, output)
+        alternates = os.path.join(self.workspace, 'traits', '.git',
+                                  'objects', 'info', 'alternates')
+        with open(alternates) as fp:
+            self.assertIn(os.path.join(self.mirror_dir, 'traits.git'),
+                          fp.read())
+
+    def test_mirror_keeps_deleted_branches(self):
+        traits = os.path.join(self.upstream, 'traits.git')
+        git('-C', traits, 'branch', 'feature')
+        self.run_ets('mirror', '--url', self.url,
+                     '--mirror-dir', self.mirror_dir)
+        git('-C', traits, 'branch', '-D', 'feature')
+        status, output = self.run_ets('mirror', '--url', self.url,
+                                      '--mirror-dir', self.mirror_dir)
+        self.assertEqual(status, 0, output)
+        self.assertIn('feature', git('--git-dir', os.path.join(
+            self.mirror_dir, 'traits.git'), 'branch', '--list'))
+
+
+class TestIncremental(EtsTestCase):
+
+    def setUp(self):
+        EtsTestCase.setUp(self)
+        # A setup.py whose build writes a file which git does not ignore.
+        setup = ("import sys\n"
+                 "if 'build' in sys.argv:\n"
+                 "    open('version.py', 'w').write('version = 1\\n')\n")
+        for ets_pkg_name in self.packages:
+            make_repo(os.path.join(self.workspace, ets_pkg_name),
+                      {'setup.py': setup})
+
+    def test_build_output_does_not_trigger_rebuild(self):
+        status, output = self.run_ets('build')
+        self.assertEqual(status, 0, output)
+        status, output = self.run_ets('build')
+        self.assertEqual(status, 0, output)
+        for ets_pkg_name in self.packages:
+            self.assertIn('Skipping unchanged package %s' % ets_pkg_name,
+                          output)
+
+    def test_change_triggers_rebuild(self):
+        self.run_ets('build')
+        commit_file(os.path.join(self.workspace, 'pyface'), 'api.py', '')
+        status, output = self.run_ets('build')
+        self.assertEqual(status, 0, output)
+        self.assertIn('Skipping unchanged package traits', output)
+        self.assertNotIn('Skipping unchanged package pyface', output)
+
+
+class TestBundle(EtsTestCase):
+
+    def setUp(self):
+        EtsTestCase.setUp(self)
+        # The host without network access, with clones of the packages.
+        self.offline = os.path.join(self.tmp, 'offline')
+        for ets_pkg_name in self.packages:
+            make_repo(os.path.join(self.workspace, ets_pkg_name))
+            git('clone', '-q', os.path.join(self.workspace, ets_pkg_name),
+                os.path.join(self.offline, ets_pkg_name))
+        self.out = os.path.join(self.tmp, 'bundles')
+        status, output = self.run_ets('bundle', 'create', '-o', self.out)
+        self.assertEqual(status, 0, output)
+
+    def sync(self):
+        """Bundle the changes since the last bundle, apply them on the
+        offline host, and return the manifest.
+        """
+        shutil.rmtree(self.out)
+        status, output = self.run_ets('bundle', 'create', '-o', self.out)
+        self.assertEqual(status, 0, output)
+        status, output = self.run_ets('bundle', 'apply', self.out,
+                                      cwd=self.offline)
+        self.assertEqual(status, 0, output)
+        with open(os.path.join(self.out, 'manifest.json')) as fp:
+            return json.load(fp)
+
+    def test_new_commits(self):
+        traits = os.path.join(self.workspace, 'traits')
+        commit_file(traits, 'api.py', '')
+        manifest = self.sync()
+        self.assertEqual(list(manifest), ['traits'])
+        self.assertEqual(manifest['traits']['bundle'], 'traits.bundle')
+        self.assertEqual(
+            git('-C', os.path.join(self.offline, 'traits'), 'rev-parse',
+                'origin/main'),
+            git('-C', traits, 'rev-parse', 'main'))
+
+    def test_new_tag_on_sent_commit(self):
+        traits = os.path.join(self.workspace, 'traits')
+        git('-C', traits, 'tag', 'v1')
+        git('-C', traits, 'branch', 'maint')
+        manifest = self.sync()
+        self.assertIsNone(manifest['traits']['bundle'])
+        offline = os.path.join(self.offline, 'traits')
+        self.assertEqual(git('-C', offline, 'rev-parse', 'v1'),
+                         git('-C', traits, 'rev-parse', 'v1'))
+        self.assertEqual(git('-C', offline, 'rev-parse', 'origin/maint'),
+                         git('-C', traits, 'rev-parse', 'maint'))
+        # The sync point has advanced, so there is nothing left to send.
+        self.assertEqual(self.sync(), {})
+
+
+class TestSelection(EtsTestCase):
+
+    packages = ['traits', 'pyface', 'traitsui']
+
+    def setUp(self):
+        EtsTestCase.setUp(self)
+        for ets_pkg_name in self.packages:
+            make_repo(os.path.join(self.workspace, ets_pkg_name))
+            git('-C', os.path.join(self.workspace, ets_pkg_name), 'tag', 'v1')
+
+    def selected(self, *args):
+        """Return the packages which ets status selects with the options
+        *args*, and its output.
+        """
+        status, output = self.run_ets(*(args + ('status', '--summary',
+                                                '--json', '--no-daemon')))
+        self.assertEqual(status, 0, output)
+        summaries = json.loads(output[output.index('{'):])
+        return sorted(summaries), output
+
+    def test_downstream_of(self):
+        selected, output = self.selected('--downstream-of', 'pyface')
+        self.assertEqual(selected, ['pyface', 'traitsui'])
+
+    def test_downstream_of_with_only(self):
+        selected, output = self.selected('--downstream-of', 'traits',
+                                         '--only', 'traits,traitsui')
+        self.assertEqual(selected, ['traits', 'traitsui'])
+
+    def test_changed_since(self):
+        commit_file(os.path.join(self.workspace, 'pyface'), 'api.py', '')
+        selected, output = self.selected('--changed-since', 'v1')
+        self.assertEqual(selected, ['pyface', 'traitsui'])
+        selected, output = self.selected('--changed-since', 'v1',
+                                         '--only', 'traits,pyface')
+        self.assertEqual(selected, ['pyface'])
+
+    def test_changed_since_missing_ref(self):
+        git('-C', os.path.join(self.workspace, 'traitsui'), 'tag', '-d',
+            'v1')
+        selected, output = self.selected('--changed-since', 'v1')
+        self.assertEqual(selected, ['traitsui'])
+        self.assertIn('Selecting packages without v1: traitsui', output)
+
+
+class TestWorktree(EtsTestCase):
+
+    def setUp(self):
+        EtsTestCase.setUp(self)
+        for ets_pkg_name in self.packages:
+            make_repo(os.path.join(self.workspace, ets_pkg_name))
+        self.worktrees = os.path.join(self.tmp, 'worktrees')
+
+    def test_add_and_remove(self):
+        status, output = self.run_ets('worktree', 'add', '-b', 'feature',
+                                      'main', self.worktrees)
+        self.assertEqual(status, 0, output)
+        for ets_pkg_name in self.packages:
+            worktree = os.path.join(self.worktrees, ets_pkg_name)
+            self.assertEqual(git('-C', worktree, 'branch', '--show-current'),
+                             'feature')
+        status, output = self.run_ets('worktree', 'list')
+        self.assertEqual(status, 0, output)
+        self.assertIn(os.path.join(self.worktrees, 'pyface'), output)
+
+        with open(os.path.join(self.worktrees, 'traits', 'api.py'), 'w'):
+            pass
+        status, output = self.run_ets('worktree', 'remove', '--force',
+                                      self.worktrees)
+        self.assertEqual(status, 0, output)
+        self.assertFalse(os.path.exists(self.worktrees))
+        self.assertEqual(
+            git('-C', os.path.join(self.workspace, 'traits'), 'worktree',
+                'list').count('\n'), 0)
+
+    def test_option_values(self):
+        # The value of --reason is not taken for the branch or directory.
+        status, output = self.run_ets('worktree', 'add', '--detach',
+                                      '--lock', '--reason', 'offline',
+                                      'main', self.worktrees)
+        self.assertEqual(status, 0, output)
+        self.assertIn('locked offline', git(
+            '-C', os.path.join(self.workspace, 'traits'), 'worktree',
+            'list', '--porcelain'))
+
+    def test_wrong_arguments(self):
+        status, output = self.run_ets('worktree', 'remove')
+        self.assertEqual(status, 2)
+        self.assertIn('ets worktree: remove takes 1 arguments besides '
+                      'options', output)
+        status, output = self.run_ets('worktree', 'add', 'main')
+        self.assertEqual(status, 2)
+        self.assertIn('ets worktree: add takes 2 arguments', output)
+        status, output = self.run_ets('worktree', 'prune')
+        self.assertEqual(status, 2)
+        self.assertIn("ets worktree: expected 'add', 'list' or 'remove'",
+                      output)
+
+
+class TestStatusSummary(EtsTestCase):
+
+    def setUp(self):
+        EtsTestCase.setUp(self)
+        self.upstream = os.path.join(self.tmp, 'upstream')
+        for ets_pkg_name in self.packages:
+            make_repo(os.path.join(self.upstream, ets_pkg_name))
+            clone = os.path.join(self.workspace, ets_pkg_name)
+            git('clone', '-q', os.path.join(self.upstream, ets_pkg_name),
+                clone)
+            git('-C', clone, 'config', 'user.name', 'ets')
+            git('-C', clone, 'config', 'user.email', 'ets@example.com')
+
+    def test_json_summary(self):
+        traits = os.path.join(self.workspace, 'traits')
+        commit_file(os.path.join(self.upstream, 'traits'), 'api.py',
+                    'upstream\n')
+        commit_file(traits, 'api.py', 'local\n')
+        commit_file(traits, 'has_traits.py', '')
+        git('-C', traits, 'fetch', '-q')
+        commit = git('-C', traits, 'rev-parse', 'HEAD')
+        # A merge which stops with api.py in conflict.
+        with self.assertRaises(subprocess.CalledProcessError):
+            git('-C', traits, 'merge', '-q', 'origin/main')
+        with open(os.path.join(traits, 'trait_types.py'), 'w') as fp:
+            fp.write('')
+        git('-C', traits, 'add', 'trait_types.py')
+        with open(os.path.join(traits, 'README.txt'), 'a') as fp:
+            fp.write('more\n')
+        with open(os.path.join(traits, 'notes.txt'), 'w') as fp:
+            fp.write('')
+
+        status, output = self.run_ets('status', '--summary', '--json',
+                                      '--no-daemon')
+        self.assertEqual(status, 0, output)
+        summaries = json.loads(output)
+        self.assertEqual(summaries['traits'], {
+            'branch': 'main', 'commit': commit, 'upstream': 'origin/main',
+            'ahead': 2, 'behind': 1, 'staged': 1, 'modified': 1,
+            'untracked': 1, 'conflicts': 1})
+        pyface = summaries['pyface']
+        self.assertEqual((pyface['ahead'], pyface['behind'], pyface['staged'],
+                          pyface['modified'], pyface['untracked'],
+                          pyface['conflicts']), (0, 0, 0, 0, 0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
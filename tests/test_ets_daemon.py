@@ -0,0 +1,92 @@
+"""Tests of the directory watching of the ets daemon."""
+
+import ctypes
+import errno
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from ets_daemon import Inotify  # noqa: E402
+from test_ets import git, make_repo  # noqa: E402
+
+try:
+    Inotify().close()
+except OSError:
+    have_inotify = False
+else:
+    have_inotify = True
+
+
+class FullLibc(object):
+    """ Stands in for libc once the inotify watch limit is reached. """
+
+    def inotify_add_watch(self, fd, path, mask):
+        ctypes.set_errno(errno.ENOSPC)
+        return -1
+
+
+@unittest.skipUnless(have_inotify, 'inotify is not available')
+class TestInotify(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.pkg = os.path.join(tmp.name, 'traits')
+        make_repo(self.pkg, {'.gitignore': 'build/\n*.egg-info/\n'})
+        for name in ('traits/api', 'build/lib/traits', 'traits.egg-info'):
+            os.makedirs(os.path.join(self.pkg, name))
+        self.inotify = Inotify()
+        self.addCleanup(self.inotify.close)
+
+    def watched(self):
+        return sorted(os.path.relpath(path, self.pkg)
+                      for _, path in self.inotify.watches.values())
+
+    def test_ignored_directories_are_not_watched(self):
+        self.inotify.add_package(self.pkg)
+        watched = self.watched()
+        self.assertIn('traits/api', watched)
+        self.assertIn('.git', watched)
+        self.assertNotIn('build', watched)
+        self.assertNotIn('build/lib', watched)
+        self.assertNotIn('traits.egg-info', watched)
+
+    def test_new_directory_is_watched(self):
+        self.inotify.add_package(self.pkg)
+        os.makedirs(os.path.join(self.pkg, 'docs', 'source'))
+        os.makedirs(os.path.join(self.pkg, 'build', 'temp'))
+        self.assertEqual(self.inotify.read(1.0), {self.pkg})
+        watched = self.watched()
+        self.assertIn('docs', watched)
+        self.assertIn('docs/source', watched)
+        self.assertNotIn('build/temp', watched)
+
+    def test_worktree(self):
+        # A worktree's .git is a file, pointing into the main repository.
+        worktree = os.path.join(os.path.dirname(self.pkg), 'wt', 'traits')
+        git('-C', self.pkg, 'worktree', 'add', '-q', '-b', 'feature',
+            worktree)
+        self.inotify.add_package(worktree)
+        watched = self.watched()
+        self.assertIn('.git', watched)
+        self.assertIn(os.path.join('.git', 'worktrees', 'traits'), watched)
+        self.assertIn(os.path.join('.git', 'refs', 'heads'), watched)
+
+        self.assertEqual(self.inotify.read(0.2), set())
+        git('-C', worktree, 'commit', '-q', '--allow-empty', '-m', 'Empty')
+        self.assertEqual(self.inotify.read(1.0), {worktree})
+
+    def test_watch_limit(self):
+        self.inotify.libc = FullLibc()
+        with self.assertRaises(OSError) as context:
+            self.inotify.add_package(self.pkg)
+        self.assertEqual(context.exception.errno, errno.ENOSPC)
+        self.assertIn('max_user_watches', str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
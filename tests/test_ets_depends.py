@@ -0,0 +1,67 @@
+"""Tests of the static metadata extraction of ets_depends."""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from ets_depends import extract  # noqa: E402
+
+
+class TestExtract(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.pkg_dir = tmp.name
+
+    def extract_setup(self, source):
+        """Return the metadata extracted from a setup.py holding *source*,
+        and the warnings written.
+        """
+        with open(os.path.join(self.pkg_dir, 'setup.py'), 'w') as fp:
+            fp.write(source)
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            info = extract(self.pkg_dir)
+        return info, stderr.getvalue()
+
+    def test_requirements(self):
+        info, warnings = self.extract_setup(
+            "from setuptools import setup\n"
+            "setup(name='pyface', version='7.0',\n"
+            "      install_requires=['traits>=6', 'importlib-metadata'],\n"
+            "      extras_require={'qt': 'pyside2', 'wx': ['wxPython']})\n")
+        self.assertEqual(warnings, '')
+        self.assertEqual(info, {
+            'name': 'pyface', 'version': '7.0',
+            'install_requires': ['traits>=6', 'importlib-metadata'],
+            'extras_require': {'qt': ['pyside2'], 'wx': ['wxPython']}})
+
+    def test_malformed_extras_require(self):
+        info, warnings = self.extract_setup(
+            "from setuptools import setup\n"
+            "setup(name='pyface', install_requires=['traits'],\n"
+            "      extras_require=['pyside2'])\n")
+        self.assertIn('ignoring extras_require', warnings)
+        self.assertEqual(info['install_requires'], ['traits'])
+        self.assertEqual(info['extras_require'], {})
+
+    def test_malformed_install_requires(self):
+        info, warnings = self.extract_setup(
+            "from setuptools import setup\n"
+            "setup(name='pyface', install_requires={'traits': 6},\n"
+            "      extras_require={'qt': [1]})\n")
+        self.assertIn('ignoring install_requires', warnings)
+        self.assertIn('ignoring extras_require', warnings)
+        self.assertEqual(info['install_requires'], [])
+        self.assertEqual(info['extras_require'], {})
+
+
+if __name__ == '__main__':
+    unittest.main()
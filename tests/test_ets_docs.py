@@ -0,0 +1,191 @@
+"""Tests of the documentation publishing and caching of ets_docs."""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from ets import DependencyGraph  # noqa: E402
+from ets_docs import (SphinxBuilds, pages_branch,  # noqa: E402
+                      publish_docs, write_conf_wrapper)
+from test_ets import git, make_repo  # noqa: E402
+
+try:
+    import sphinx  # noqa: F401
+except ImportError:
+    have_sphinx = False
+else:
+    have_sphinx = True
+
+
+class Messages(object):
+    """ Collects the messages printed by the ets_docs functions. """
+
+    def __init__(self):
+        self.messages = []
+
+    def message(self, text):
+        self.messages.append(text)
+
+
+class TestPublishDocs(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.origin = os.path.join(tmp.name, 'origin.git')
+        self.pkg = os.path.join(tmp.name, 'traits')
+        make_repo(self.pkg, {'.gitattributes': '* text eol=crlf\n'})
+        git('init', '-q', '--bare', self.origin)
+        git('-C', self.pkg, 'remote', 'add', 'origin', self.origin)
+        git('-C', self.pkg, 'checkout', '-q', '--orphan', pages_branch)
+        git('-C', self.pkg, 'commit', '-q', '--allow-empty', '-m', 'Pages')
+        git('-C', self.pkg, 'push', '-q', 'origin', pages_branch)
+        git('-C', self.pkg, 'checkout', '-q', 'main')
+
+        html_dir = os.path.join(self.pkg, 'docs', 'build', 'html')
+        os.makedirs(html_dir)
+        # Sphinx may write CRLF line endings, which git's text attributes
+        # would otherwise convert.
+        with open(os.path.join(html_dir, 'index.html'), 'w',
+                  newline='') as fp:
+            fp.write('<html>\r\nTraits\r\n</html>\r\n')
+
+    def test_publish_ignores_eol_attributes(self):
+        output = Messages()
+        result = publish_docs(self.pkg, output)
+        self.assertEqual(result['status'], 'ok', output.messages)
+        self.assertEqual(result['detail'], '1 files changed')
+        content = subprocess.check_output(
+            ['git', '--git-dir', self.origin, 'show',
+             pages_branch + ':index.html'])
+        self.assertEqual(content, b'<html>\r\nTraits\r\n</html>\r\n')
+
+    def test_publish_unchanged(self):
+        publish_docs(self.pkg, Messages())
+        result = publish_docs(self.pkg, Messages())
+        self.assertEqual(result['status'], 'ok')
+        self.assertEqual(result['detail'], '0 files changed')
+
+
+class TestConfWrapper(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.pkg = os.path.join(tmp.name, 'traits')
+        os.makedirs(os.path.join(self.pkg, 'docs', 'source'))
+        with open(os.path.join(self.pkg, 'docs', 'source', 'conf.py'),
+                  'w') as fp:
+            fp.write("project = 'traits'\n")
+        self.inventory_dir = os.path.join(tmp.name, 'inventories')
+
+    def test_no_local_inventories(self):
+        self.assertIsNone(write_conf_wrapper(self.pkg, self.inventory_dir,
+                                             {}))
+
+    def test_local_inventories(self):
+        inventories = {'traits': os.path.join(self.inventory_dir, 'traits',
+                                              'objects.inv')}
+        conf_dir = write_conf_wrapper(self.pkg, self.inventory_dir,
+                                      inventories)
+        with open(os.path.join(conf_dir, 'conf.py')) as fp:
+            self.assertIn(inventories['traits'], fp.read())
+
+    @unittest.skipUnless(have_sphinx, 'Sphinx is not available')
+    def test_build_with_relative_paths(self):
+        source = os.path.join(self.pkg, 'docs', 'source')
+        theme_dir = os.path.join(source, '_theme', 'mytheme')
+        os.makedirs(theme_dir)
+        with open(os.path.join(theme_dir, 'theme.conf'), 'w') as fp:
+            fp.write("[theme]\ninherit = basic\n")
+        os.makedirs(os.path.join(source, '_templates'))
+        with open(os.path.join(source, 'conf.py'), 'w') as fp:
+            fp.write("project = 'traits'\n"
+                     "extensions = ['sphinx.ext.intersphinx']\n"
+                     "intersphinx_mapping = {\n"
+                     "    'traits': ('https://docs.enthought.com/traits',"
+                     " None)}\n"
+                     "templates_path = ['_templates']\n"
+                     "html_theme = 'mytheme'\n"
+                     "html_theme_path = ['_theme']\n")
+        with open(os.path.join(source, 'index.rst'), 'w') as fp:
+            fp.write("Traits\n======\n")
+        # An empty inventory, as if built by an upstream package.
+        inventory = os.path.join(self.inventory_dir, 'traits', 'objects.inv')
+        os.makedirs(os.path.dirname(inventory))
+        with open(inventory, 'wb') as fp:
+            fp.write(b'# Sphinx inventory version 2\n# Project: traits\n'
+                     b'# Version: \n# The remainder of this file is '
+                     b'compressed using zlib.\n' + zlib.compress(b''))
+        conf_dir = write_conf_wrapper(self.pkg, self.inventory_dir,
+                                      {'traits': inventory})
+        build = os.path.join(self.pkg, 'docs', 'build', 'html')
+        proc = subprocess.run(
+            [sys.executable, '-m', 'sphinx', '-q', '-b', 'html', '-c',
+             conf_dir, source, build],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+        self.assertTrue(os.path.isfile(os.path.join(build, 'index.html')))
+
+
+class TestBuildCache(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.pkg = os.path.join(tmp.name, 'traits')
+        os.makedirs(os.path.join(self.pkg, 'docs', 'build', 'html'))
+        with open(os.path.join(self.pkg, 'docs', 'build', 'html',
+                               'index.html'), 'w') as fp:
+            fp.write('<html></html>\n')
+        self.options = {'inventory_dir': os.path.join(tmp.name, 'inv'),
+                        'cache_dir': os.path.join(tmp.name, 'cache'),
+                        'cache_size': 100}
+
+    def build(self, output):
+        """Run a successful build of the package through SphinxBuilds, and
+        return its task.
+        """
+        builds = SphinxBuilds(['make', 'latex'], [],
+                              DependencyGraph({self.pkg: []}), self.options,
+                              output)
+        task = builds.task(self.pkg)
+        builds.finished(self.pkg, {'status': 'ok'})
+        builds.close()
+        return task
+
+    def test_cached_build(self):
+        task = self.build(Messages())
+        self.assertEqual(task[0][:2], ['make', 'latex'])
+        task = self.build(Messages())
+        self.assertEqual(task['status'], 'cached')
+
+    def test_unreadable_source(self):
+        os.symlink(os.path.join(self.pkg, 'missing.py'),
+                   os.path.join(self.pkg, 'broken.py'))
+        output = Messages()
+        task = self.build(output)
+        self.assertEqual(task[0][:2], ['make', 'latex'])
+        self.assertIn('Warning: cannot use the docs cache for package',
+                      output.messages[0])
+
+    def test_unwritable_cache(self):
+        # A file where the cache directory should be.
+        with open(self.options['cache_dir'], 'w'):
+            pass
+        output = Messages()
+        self.build(output)
+        self.assertEqual(len(output.messages), 1)
+        self.assertIn('Warning: cannot cache the docs build',
+                      output.messages[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
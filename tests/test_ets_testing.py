@@ -0,0 +1,137 @@
+"""Tests of the sharding of test suites and the merging of their JUnit XML
+reports by ets_testing.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ElementTree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# Imported as a module, so that its test_* functions are not collected.
+import ets_testing  # noqa: E402
+
+
+def make_suite(tests):
+    """Return a suite of test classes, from *tests*, a dict mapping each
+    class name to the number of its tests.
+    """
+    suite = unittest.TestSuite()
+    for classname, count in sorted(tests.items()):
+        methods = dict(('test_%d' % i, lambda self: None)
+                       for i in range(count))
+        cls = type(classname, (unittest.TestCase,), methods)
+        suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(cls))
+    return suite
+
+
+def classnames(suite):
+    """Return the sorted names of the test classes in *suite*."""
+    return sorted(name.rpartition('.')[2]
+                  for name in ets_testing.test_units(suite))
+
+
+class TestShardSuite(unittest.TestCase):
+
+    def durations(self, **times):
+        return dict((__name__ + '.' + name, seconds)
+                    for name, seconds in times.items())
+
+    def test_longest_first_to_least_loaded(self):
+        suite = make_suite({'A': 2, 'B': 1, 'C': 3, 'D': 1})
+        durations = self.durations(A=10, B=6, C=5, D=1)
+        first = ets_testing.shard_suite(suite, 1, 2, durations)
+        second = ets_testing.shard_suite(suite, 2, 2, durations)
+        self.assertEqual(classnames(first), ['A', 'D'])
+        self.assertEqual(classnames(second), ['B', 'C'])
+        # The tests of a class are kept together.
+        self.assertEqual(first.countTestCases() + second.countTestCases(),
+                         suite.countTestCases())
+        self.assertEqual(first.countTestCases(), 3)
+
+    def test_unknown_duration_is_average(self):
+        suite = make_suite({'A': 1, 'B': 1, 'C': 1})
+        durations = self.durations(A=10, B=2)
+        self.assertEqual(
+            classnames(ets_testing.shard_suite(suite, 2, 2, durations)),
+            ['B', 'C'])
+
+    def test_single_shard(self):
+        suite = make_suite({'A': 1, 'B': 2})
+        shard = ets_testing.shard_suite(suite, 1, 1, {})
+        self.assertEqual(shard.countTestCases(), 3)
+
+
+class TestJUnit(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.runs = ets_testing.TestRuns(
+            ['traits', 'pyface'], {'traits': 2}, {'pattern': 'test*.py'},
+            {}, self.tmp)
+
+    def write_shard(self, name, records):
+        """Write the JUnit XML report of the shard *name*, as by its
+        worker, from the test *records*.
+        """
+        testsuite = ets_testing.junit_testsuite(
+            name, [ets_testing.junit_testcase(record) for record in records])
+        ElementTree.ElementTree(testsuite).write(
+            self.runs.junit_path(name), encoding='utf-8',
+            xml_declaration=True)
+
+    def record(self, name, outcome='passed', seconds=0.5, message=''):
+        return {'classname': 'tests.TestTraits', 'name': name,
+                'time': seconds, 'outcome': outcome, 'message': message}
+
+    def test_merged_totals(self):
+        self.assertEqual(sorted(self.runs.shards),
+                         ['pyface', 'traits[1]', 'traits[2]'])
+        self.write_shard('traits[1]', [
+            self.record('test_a'),
+            self.record('test_b', 'failure',
+                        message='Traceback\nAssertionError: 1 != 2\n')])
+        self.write_shard('traits[2]', [
+            self.record('test_c', 'skipped', message='no Qt'),
+            self.record('test_d', 'error', 1.25, 'Traceback\nKeyError\n')])
+        self.write_shard('pyface', [self.record('test_e')])
+        results = {}
+        for name in self.runs.shards:
+            results[name] = {'status': 'ok'}
+            self.runs.finished(name, results[name])
+        self.assertEqual(results['traits[1]']['detail'],
+                         '2 tests, 1 failures, 0 errors')
+        self.assertEqual(results['traits[2]']['detail'],
+                         '2 tests, 0 failures, 1 errors')
+
+        path = os.path.join(self.tmp, 'ets_tests.xml')
+        self.runs.write_junit(path)
+        root = ElementTree.parse(path).getroot()
+        self.assertEqual(dict(root.attrib), {
+            'tests': '5', 'failures': '1', 'errors': '1', 'skipped': '1',
+            'time': '3.250'})
+        suites = dict((suite.get('name'), suite) for suite in root)
+        self.assertEqual(suites['traits'].get('tests'), '4')
+        self.assertEqual(suites['pyface'].get('tests'), '1')
+        failure = suites['traits'].find('testcase/failure')
+        self.assertEqual(failure.get('message'), 'AssertionError: 1 != 2')
+        self.assertIn('Traceback', failure.text)
+        self.assertIsNone(suites['traits'].find('testcase/skipped').text)
+
+    def test_missing_report(self):
+        # A shard which crashed before writing its report.
+        self.write_shard('pyface', [self.record('test_e')])
+        result = {'status': 'failed'}
+        self.runs.finished('traits[1]', result)
+        self.assertNotIn('detail', result)
+        self.runs.finished('pyface', {'status': 'ok'})
+        self.assertEqual(self.runs.collected, set(['pyface']))
+
+
+if __name__ == '__main__':
+    unittest.main()
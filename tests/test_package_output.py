@@ -0,0 +1,90 @@
+"""Tests of the metrics and trace files written by PackageOutput."""
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from ets import PackageOutput  # noqa: E402
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.metrics = os.path.join(self.tmp, 'metrics.jsonl')
+        self.trace = os.path.join(self.tmp, 'trace.json')
+
+    def load_trace(self):
+        with open(self.trace) as fp:
+            return json.load(fp)
+
+    def test_metrics_lines(self):
+        output = PackageOutput('direct', metrics=self.metrics)
+        output.run('traits', [sys.executable, '-c', 'pass'], self.tmp)
+        output.run('pyface', [sys.executable, '-c', 'raise SystemExit(3)'],
+                   self.tmp)
+        with open(self.metrics) as fp:
+            entries = [json.loads(line) for line in fp]
+        self.assertEqual([(entry['package'], entry['status'],
+                           entry['returncode']) for entry in entries],
+                         [('traits', 'ok', 0), ('pyface', 'failed', 3)])
+        self.assertEqual(entries[0]['command'],
+                         [sys.executable, '-c', 'pass'])
+        for entry in entries:
+            self.assertGreaterEqual(entry['start'], output.start)
+            self.assertGreaterEqual(entry['seconds'], 0)
+            if hasattr(os, 'wait4'):
+                self.assertGreater(entry['max_rss_kb'], 0)
+                self.assertIn('user', entry)
+                self.assertIn('sys', entry)
+        self.assertFalse(os.path.exists(self.trace))
+
+    def test_trace_events(self):
+        output = PackageOutput('direct', trace=self.trace)
+        output.start = 100.0
+        output.record('traits', ['make'], 101.5,
+                      {'status': 'ok', 'returncode': 0, 'seconds': 2.25,
+                       'detail': ''})
+        thread = threading.Thread(target=output.record, args=(
+            'pyface', ['make'], 102.0,
+            {'status': 'failed', 'returncode': 2, 'seconds': 0.5}))
+        thread.start()
+        thread.join()
+        output.record('traitsui', ['make'], 103.75,
+                      {'status': 'ok', 'returncode': 0, 'seconds': 1.0})
+
+        trace = self.load_trace()
+        self.assertEqual(trace['displayTimeUnit'], 'ms')
+        events = trace['traceEvents']
+        self.assertEqual(events[0], {
+            'name': 'traits', 'cat': 'ok', 'ph': 'X', 'pid': 1, 'tid': 1,
+            'ts': 1500000, 'dur': 2250000,
+            'args': {'package': 'traits', 'command': ['make'],
+                     'start': 101.5, 'status': 'ok', 'returncode': 0,
+                     'seconds': 2.25}})
+        # Each thread has its own lane.
+        self.assertEqual([(event['name'], event['cat'], event['tid'])
+                          for event in events],
+                         [('traits', 'ok', 1), ('pyface', 'failed', 2),
+                          ('traitsui', 'ok', 1)])
+        self.assertEqual(events[2]['ts'], 3750000)
+        self.assertFalse(os.path.exists(self.trace + '.tmp'))
+
+    def test_nothing_recorded(self):
+        output = PackageOutput('direct')
+        output.record('traits', ['make'], output.start,
+                      {'status': 'ok', 'returncode': 0, 'seconds': 1.0})
+        self.assertEqual(output.events, [])
+        self.assertEqual(os.listdir(self.tmp), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,283 @@
+"""Tests of the package graph and the scheduling of package commands, which
+run no package commands.
+"""
+
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import ets  # noqa: E402
+import ets_depends  # noqa: E402
+from ets import (DependencyCycleError, DependencyGraph,  # noqa: E402
+                 Jobserver, run_tasks, select_packages)
+
+
+class FakeOutput(object):
+    """ Stands in for PackageOutput, recording the commands run instead of
+    running them. A command whose first word is 'false' fails.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = []
+        self.commands = {}
+        self.environ = {}
+        self.messages = []
+
+    def run(self, name, cmd, cwd, env=None, pass_fds=()):
+        with self.lock:
+            self.started.append(name)
+            self.commands[name] = cmd
+            self.environ[name] = env
+        if cmd[0] == 'false':
+            return {'status': 'failed', 'returncode': 1}
+        return {'status': 'ok', 'returncode': 0}
+
+    def message(self, text):
+        with self.lock:
+            self.messages.append(text)
+
+
+class TestDependencyGraph(unittest.TestCase):
+
+    def test_order(self):
+        graph = DependencyGraph({'traitsui': ['pyface'],
+                                 'pyface': ['traits'], 'traits': []})
+        self.assertEqual(graph.order(), ['traits', 'pyface', 'traitsui'])
+
+    def test_order_keeps_given_order(self):
+        # Of the packages which are ready, the earliest given comes first.
+        graph = DependencyGraph({'pyface': ['traits'], 'encore': [],
+                                 'traits': [], 'casuarius': []},
+                                ['pyface', 'encore', 'traits', 'casuarius'])
+        self.assertEqual(graph.order(),
+                         ['encore', 'traits', 'pyface', 'casuarius'])
+
+    def test_dependencies_outside_packages(self):
+        graph = DependencyGraph({'traitsui': ['pyface', 'traits'],
+                                 'pyface': ['traits']},
+                                ['traitsui', 'pyface'])
+        self.assertEqual(graph.dependencies['traitsui'], ['pyface'])
+        self.assertEqual(graph.order(), ['pyface', 'traitsui'])
+
+    def test_cycle(self):
+        # chaco leads into the cycle without being part of it.
+        graph = DependencyGraph(
+            {'chaco': ['enable'], 'traits': [], 'pyface': ['traitsui'],
+             'traitsui': ['enable', 'traits'], 'enable': ['pyface']},
+            ['chaco', 'traits', 'pyface', 'traitsui', 'enable'])
+        with self.assertRaises(DependencyCycleError) as cm:
+            graph.order()
+        self.assertEqual(cm.exception.cycle,
+                         ['enable', 'pyface', 'traitsui', 'enable'])
+        self.assertEqual(str(cm.exception),
+                         'dependency cycle: enable -> pyface -> traitsui '
+                         '-> enable')
+        self.assertIsInstance(cm.exception, ValueError)
+
+    def test_subgraph(self):
+        graph = DependencyGraph({'traits': [], 'pyface': ['traits'],
+                                 'traitsui': ['pyface'],
+                                 'enable': ['traitsui'], 'chaco': ['enable'],
+                                 'encore': []})
+        subgraph = graph.subgraph(['chaco', 'encore', 'traits', 'traitsui'])
+        self.assertEqual(subgraph.packages,
+                         ['traits', 'traitsui', 'chaco', 'encore'])
+        # Dependencies through the packages left out are kept.
+        self.assertEqual(subgraph.dependencies['traitsui'], ['traits'])
+        self.assertEqual(sorted(subgraph.dependencies['chaco']),
+                         ['traits', 'traitsui'])
+        self.assertEqual(subgraph.dependencies['encore'], [])
+        self.assertEqual(subgraph.order(),
+                         ['traits', 'traitsui', 'chaco', 'encore'])
+
+
+class TestSelectPackages(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        for ets_pkg_name in ('traits', 'pyface'):
+            os.makedirs(os.path.join(self.root, ets_pkg_name))
+        patcher = mock.patch.object(ets_depends, 'cache_file', os.path.join(
+            self.root, '.ets_depends_cache.json'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_missing_packages(self):
+        options = {'only': 'traitsui,pyface,traits', 'downstream_of': '',
+                   'changed_since': ''}
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            graph = select_packages(options, self.root)
+        self.assertEqual(stdout.getvalue(),
+                         'Skipping missing packages: traitsui\n\n')
+        self.assertEqual(graph.order(), ['traits', 'pyface'])
+        self.assertEqual(graph.dependencies['pyface'], ['traits'])
+
+    def test_unknown_package(self):
+        options = {'only': 'traits,bogus', 'downstream_of': '',
+                   'changed_since': ''}
+        with self.assertRaises(ValueError) as cm:
+            select_packages(options, self.root)
+        self.assertEqual(str(cm.exception), 'unknown package bogus')
+
+
+class TestRunTasks(unittest.TestCase):
+
+    def test_skip_only_downstream_of_failure(self):
+        graph = DependencyGraph({'traits': [], 'pyface': ['traits'],
+                                 'traitsui': ['pyface'], 'encore': [],
+                                 'scimath': ['encore']})
+        output = FakeOutput()
+        tasks = dict((name, (['true'], name)) for name in graph.packages)
+        tasks['traits'] = (['false'], 'traits')
+        results = run_tasks(tasks, graph, output, jobs=2)
+        self.assertEqual(results['traits']['status'], 'failed')
+        self.assertEqual(results['pyface'], {'status': 'skipped',
+                                             'detail': 'depends on traits'})
+        self.assertEqual(results['traitsui'], {'status': 'skipped',
+                                               'detail': 'depends on pyface'})
+        self.assertEqual(results['encore']['status'], 'ok')
+        self.assertEqual(results['scimath']['status'], 'ok')
+        self.assertEqual(sorted(output.started),
+                         ['encore', 'scimath', 'traits'])
+
+    def test_failing_task_function(self):
+        def broken():
+            raise OSError("cannot read broken.py")
+        graph = DependencyGraph({'traits': [], 'pyface': ['traits'],
+                                 'encore': []})
+        output = FakeOutput()
+        results = run_tasks({'traits': broken,
+                             'pyface': (['true'], 'pyface'),
+                             'encore': lambda: (['true'], 'encore')},
+                            graph, output, jobs=2)
+        self.assertEqual(results['traits'], {
+            'status': 'failed', 'detail': 'cannot read broken.py'})
+        self.assertEqual(results['pyface']['status'], 'skipped')
+        self.assertEqual(results['encore']['status'], 'ok')
+        self.assertIn('Error preparing package traits', output.messages[0])
+
+
+class TestJobserver(unittest.TestCase):
+
+    def setUp(self):
+        self.jobserver = Jobserver(4, parallel_option='--parallel')
+        self.addCleanup(self.jobserver.close)
+
+    def test_acquire_and_release(self):
+        jobserver = self.jobserver
+        first = jobserver.acquire(3, 0)
+        self.assertEqual(len(first), 3)
+        second = jobserver.acquire(3, 1)
+        self.assertEqual(len(second), 1)
+        self.assertEqual(jobserver.acquire(1, 2), b'')
+        jobserver.release(first)
+        jobserver.release(second)
+        self.assertEqual(len(jobserver.acquire(8, 0)), 4)
+
+    def test_load_limit(self):
+        self.jobserver.max_load = 2.0
+        with mock.patch('os.getloadavg', return_value=(3.0, 3.0, 3.0)):
+            self.assertEqual(self.jobserver.limit(4, 1), 0)
+            # A package is always started when nothing is running.
+            self.assertEqual(self.jobserver.limit(4, 0), 1)
+        with mock.patch('os.getloadavg', return_value=(1.0, 1.0, 1.0)):
+            self.assertEqual(self.jobserver.limit(4, 1), 4)
+
+    def test_memory_limit(self):
+        self.jobserver.job_memory = 512
+        with mock.patch.object(ets, 'available_memory', return_value=1100):
+            self.assertEqual(self.jobserver.limit(4, 1), 2)
+        with mock.patch.object(ets, 'available_memory', return_value=100):
+            self.assertEqual(self.jobserver.limit(4, 1), 0)
+            self.assertEqual(self.jobserver.limit(4, 0), 1)
+        with mock.patch.object(ets, 'available_memory', return_value=None):
+            self.assertEqual(self.jobserver.limit(4, 1), 4)
+
+    def test_command(self):
+        cmd = ['python', 'setup.py', 'build']
+        self.assertEqual(self.jobserver.command(cmd, b'+'), cmd)
+        self.assertEqual(self.jobserver.command(cmd, b'+++'),
+                         cmd + ['--parallel=3'])
+        self.jobserver.parallel_option = None
+        self.assertEqual(self.jobserver.command(cmd, b'+++'), cmd)
+
+    def test_environ(self):
+        read_fd, write_fd = self.jobserver.fds
+        makeflags = self.jobserver.environ()['MAKEFLAGS']
+        self.assertEqual(makeflags.split(), [
+            '-j4', '--jobserver-fds=%d,%d' % (read_fd, write_fd),
+            '--jobserver-auth=%d,%d' % (read_fd, write_fd)])
+
+        # A child, as make would, takes a token through the descriptors in
+        # MAKEFLAGS, and hands back two.
+        child = ("import os\n"
+                 "flags = os.environ['MAKEFLAGS'].split()[1]\n"
+                 "r, w = map(int, flags.split('=')[1].split(','))\n"
+                 "token = os.read(r, 1)\n"
+                 "os.write(w, token * 2)\n")
+        subprocess.check_call([sys.executable, '-c', child],
+                              env=self.jobserver.environ(),
+                              pass_fds=self.jobserver.fds)
+        self.assertEqual(len(self.jobserver.acquire(8, 0)), 5)
+
+
+class TestRunTasksWithJobserver(unittest.TestCase):
+
+    def setUp(self):
+        self.jobserver = Jobserver(4, parallel_option='--parallel')
+        self.addCleanup(self.jobserver.close)
+
+    def test_single_package_gets_every_token(self):
+        output = FakeOutput()
+        results = run_tasks({'traits': (['build'], 'traits')},
+                            DependencyGraph({'traits': []}), output, jobs=4,
+                            jobserver=self.jobserver)
+        self.assertEqual(results['traits']['status'], 'ok')
+        self.assertEqual(output.commands['traits'],
+                         ['build', '--parallel=4'])
+        self.assertIn('MAKEFLAGS', output.environ['traits'])
+        # Every token is back in the pipe.
+        self.assertEqual(len(self.jobserver.acquire(8, 0)), 4)
+
+    def test_tokens_are_shared(self):
+        names = ['traits', 'encore', 'casuarius', 'pyface']
+        output = FakeOutput()
+        graph = DependencyGraph(dict((name, []) for name in names))
+        results = run_tasks(dict((name, (['build'], name)) for name in names),
+                            graph, output, jobs=4, jobserver=self.jobserver)
+        self.assertEqual(set(output.started), set(names))
+        for name in names:
+            self.assertEqual(results[name]['status'], 'ok')
+        self.assertEqual(len(self.jobserver.acquire(8, 0)), 4)
+
+    def test_no_tokens_left(self):
+        # The tokens were lost, eg. by a killed sub-make.
+        self.jobserver.acquire(4, 0)
+        output = FakeOutput()
+        results = run_tasks({'traits': (['build'], 'traits'),
+                             'pyface': (['build'], 'pyface')},
+                            DependencyGraph({'traits': [],
+                                             'pyface': ['traits']}),
+                            output, jobs=2, jobserver=self.jobserver)
+        self.assertEqual(output.started, [])
+        for name in ('traits', 'pyface'):
+            self.assertEqual(results[name], {
+                'status': 'not run', 'detail': 'no jobserver tokens left'})
+        self.assertIn('no tokens left', output.messages[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""Tests of the wheelhouse of built wheels, with the builds themselves
+simulated.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from ets import (WheelBuilds, cached_wheels, wheel_key,  # noqa: E402
+                 wheel_path)
+from test_ets import git, make_repo  # noqa: E402
+
+
+class TestWheelhouse(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        # Packages are named relative to the workspace, as by ets.
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmp.name)
+        self.pkg = 'traits'
+        make_repo(self.pkg)
+        self.wheelhouse = 'wheelhouse'
+
+    def write(self, name, content):
+        with open(os.path.join(self.pkg, name), 'w') as fp:
+            fp.write(content)
+
+    def start(self, force=False):
+        """Start the package's wheel build, and return the WheelBuilds and
+        the task's command or result.
+        """
+        builds = WheelBuilds(self.wheelhouse, [], force)
+        return builds, builds.task(self.pkg)()
+
+    def build(self, status='ok'):
+        """Run a wheel build of the package which ends with *status*, and
+        return its result.
+        """
+        builds, (cmd, cwd) = self.start()
+        self.assertEqual(cwd, self.pkg)
+        # Stand in for pip, writing the wheel into the build directory.
+        build_dir = cmd[cmd.index('--wheel-dir') + 1]
+        with open(os.path.join(build_dir, 'traits-1.0-py3-none-any.whl'),
+                  'w') as fp:
+            fp.write('wheel\n')
+        result = {'status': status}
+        builds.finished(self.pkg, result)
+        return result
+
+    def test_key_of_dirty_tree(self):
+        head = git('-C', self.pkg, 'rev-parse', 'HEAD')
+        self.assertEqual(wheel_key(self.pkg), head)
+        self.write('README.txt', 'changed\n')
+        changed = wheel_key(self.pkg)
+        self.assertTrue(changed.startswith(head + '-'))
+        self.write('api.py', '')
+        self.assertNotIn(wheel_key(self.pkg), (head, changed))
+        os.remove(os.path.join(self.pkg, 'api.py'))
+        self.assertEqual(wheel_key(self.pkg), changed)
+        self.write('README.txt', 'readme\n')
+        self.assertEqual(wheel_key(self.pkg), head)
+
+    def test_cached_wheel(self):
+        result = self.build()
+        self.assertEqual(result['detail'], 'traits-1.0-py3-none-any.whl')
+        key = wheel_key(self.pkg)
+        self.assertEqual(cached_wheels(self.pkg, key, self.wheelhouse), [
+            os.path.join(wheel_path(self.pkg, key, self.wheelhouse),
+                         'traits-1.0-py3-none-any.whl')])
+
+        builds, result = self.start()
+        self.assertEqual(result, {'status': 'cached',
+                                  'detail': 'traits-1.0-py3-none-any.whl'})
+        builds, task = self.start(force=True)
+        self.assertIn('--wheel-dir', task[0])
+        builds.finished(self.pkg, {'status': 'failed'})
+
+        # A change to the working tree needs a new wheel.
+        self.write('api.py', '')
+        builds, task = self.start()
+        self.assertIn('--wheel-dir', task[0])
+        builds.finished(self.pkg, {'status': 'failed'})
+
+    def test_failed_build(self):
+        self.build(status='failed')
+        key = wheel_key(self.pkg)
+        path = wheel_path(self.pkg, key, self.wheelhouse)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(os.listdir(os.path.dirname(path)), [])
+        self.assertEqual(cached_wheels(self.pkg, key, self.wheelhouse), [])
+
+
+if __name__ == '__main__':
+    unittest.main()